@@ -0,0 +1,277 @@
+from __future__ import print_function, division
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+from .dataframe_schema import (_get_flags_dtype, expand_dataframe,
+                               get_stored_columns)
+
+
+# Column with one bit per named quality cut (see comptools.io.get_quality_cuts)
+QUALITY_CUTS_COLUMN = 'quality_cuts'
+
+# Low-cardinality columns that get a bitmap for each of their values
+_bitmap_columns = ['sim', 'MC_comp', 'MC_comp_class', 'comp_group_2',
+                   'comp_group_3', 'comp_group_4']
+
+
+def pack_cut_masks(cut_masks):
+    '''Packs boolean cut masks into one unsigned integer per event
+
+    Parameters
+    ----------
+    cut_masks : OrderedDict
+        Boolean mask of events passing each cut (see
+        ``comptools.cuts.evaluate_cuts``). The i-th cut is stored in bit i.
+
+    Returns
+    -------
+    packed : numpy.ndarray
+        Packed cut bits for each event.
+    '''
+    cut_dtype = _get_flags_dtype(len(cut_masks))
+    n_events = len(next(iter(cut_masks.values()))) if cut_masks else 0
+    packed = np.zeros(n_events, dtype=cut_dtype)
+    for bit, mask in enumerate(cut_masks.values()):
+        packed |= np.asarray(mask).astype(cut_dtype) << cut_dtype(bit)
+
+    return packed
+
+
+def get_cut_mask(packed, cut_names, cuts):
+    '''Returns a mask of the events passing all of the given cuts
+
+    Parameters
+    ----------
+    packed : array_like
+        Packed cut bits (see ``pack_cut_masks``).
+    cut_names : list
+        Names of the packed cuts, in bit order.
+    cuts : list
+        Names of the cuts to require.
+
+    Returns
+    -------
+    mask : numpy.ndarray
+        Boolean array of events passing every cut in ``cuts``.
+    '''
+    packed = np.asarray(packed)
+    required = 0
+    for cut in cuts:
+        if cut not in cut_names:
+            raise ValueError('Invalid cut name, {}, entered'.format(cut))
+        required |= 1 << cut_names.index(cut)
+    required = packed.dtype.type(required)
+
+    return (packed & required) == required
+
+
+def save_cut_names(store, cut_names, key='dataframe'):
+    '''Saves the names of the packed cut bits with a HDFStore table
+    '''
+    store.get_storer(key).attrs.comp_cut_names = list(cut_names)
+
+
+def read_cut_names(df_file, key='dataframe'):
+    '''Reads the names of the packed cut bits stored with a DataFrame file
+
+    Returns None if the file was saved without packed cut bits.
+    '''
+    with pd.HDFStore(df_file, mode='r') as store:
+        attrs = store.get_storer(key).attrs
+        cut_names = getattr(attrs, 'comp_cut_names', None)
+
+    return cut_names
+
+
+def _to_builtin(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def build_bitmap_index(store, schema=None, cut_names=None, columns=None,
+                       chunksize=1000000, key='dataframe'):
+    '''Builds bitmap indexes for the categorical columns of a DataFrame file
+
+    Parameters
+    ----------
+    store : pandas.HDFStore
+        Open HDFStore with a processed DataFrame table at ``key``.
+    schema : dict, optional
+        Schema of the stored DataFrame (see comptools.dataframe_schema).
+    cut_names : list, optional
+        Names of the packed quality cut bits. If given, a bitmap of the
+        events passing each cut is also built (default is None).
+    columns : list, optional
+        Categorical columns to index (default is None, every stored
+        column of ``sim``, ``MC_comp``, ``MC_comp_class``, and
+        ``comp_group_*``).
+    chunksize : int, optional
+        Number of rows to read at a time (default is 1000000).
+    key : str, optional
+        Table key (default is 'dataframe').
+
+    Returns
+    -------
+    bitmap_index : OrderedDict
+        Mapping from ``(column, value)`` to a ``numpy.packbits`` array of
+        the events with that value. Cut bitmaps use
+        ``(QUALITY_CUTS_COLUMN, cut_name)`` keys.
+    n_rows : int
+        Number of rows in the DataFrame.
+    '''
+    if schema is not None:
+        all_columns = schema['columns']
+    else:
+        all_columns = list(store.select(key, start=0, stop=0).columns)
+    if columns is None:
+        columns = [c for c in _bitmap_columns if c in all_columns]
+    if cut_names is not None:
+        columns = columns + [QUALITY_CUTS_COLUMN]
+    # packbits of chunks can only be concatenated on byte boundaries
+    chunksize = max(8, chunksize - chunksize % 8)
+
+    bitmaps = OrderedDict()
+    n_rows = store.get_storer(key).nrows
+    for start in range(0, n_rows, chunksize):
+        df = store.select(key, start=start, stop=start + chunksize,
+                          columns=get_stored_columns(columns, schema))
+        df = expand_dataframe(df, schema, columns=columns)
+        masks = OrderedDict()
+        for column in columns:
+            if column == QUALITY_CUTS_COLUMN:
+                for cut in cut_names:
+                    masks[(column, cut)] = get_cut_mask(df[column].values,
+                                                        cut_names, [cut])
+                continue
+            values = df[column].values
+            for value in pd.unique(values):
+                masks[(column, _to_builtin(value))] = values == value
+        for bitmap_key in set(bitmaps) | set(masks):
+            if bitmap_key not in bitmaps:
+                # Value not seen in previous chunks
+                bitmaps[bitmap_key] = [np.zeros(start // 8, dtype=np.uint8)]
+            mask = masks.get(bitmap_key, np.zeros(len(df), dtype=bool))
+            bitmaps[bitmap_key].append(np.packbits(mask))
+
+    bitmap_index = OrderedDict()
+    for bitmap_key in sorted(bitmaps, key=lambda k: (k[0], str(k[1]))):
+        bitmap_index[bitmap_key] = np.concatenate(bitmaps[bitmap_key])
+
+    return bitmap_index, n_rows
+
+
+def save_bitmap_index(store, bitmap_index, n_rows, key='bitmap_index'):
+    '''Saves bitmap indexes to a HDFStore
+
+    Parameters
+    ----------
+    store : pandas.HDFStore
+        Output HDFStore.
+    bitmap_index : OrderedDict
+        Bitmap indexes (see ``build_bitmap_index``).
+    n_rows : int
+        Number of indexed rows.
+    key : str, optional
+        Key to store the bitmaps under (default is 'bitmap_index').
+    '''
+    n_bytes = (n_rows + 7) // 8
+    bitmaps = np.zeros((n_bytes, len(bitmap_index)), dtype=np.uint8)
+    for idx, bitmap in enumerate(bitmap_index.values()):
+        bitmaps[:, idx] = bitmap
+    df_bitmaps = pd.DataFrame(bitmaps, columns=['bitmap_{}'.format(i)
+                                                for i in range(bitmaps.shape[1])])
+    if key in store:
+        store.remove(key)
+    store.put(key, df_bitmaps, format='fixed')
+    attrs = store.get_storer(key).attrs
+    attrs.comp_bitmap_keys = list(bitmap_index.keys())
+    attrs.comp_n_rows = n_rows
+
+
+def read_bitmap_index(df_file, key='bitmap_index'):
+    '''Reads the bitmap indexes stored with a DataFrame file
+
+    Parameters
+    ----------
+    df_file : path
+        Path to processed DataFrame HDF5 file.
+    key : str, optional
+        Key the bitmaps are stored under (default is 'bitmap_index').
+
+    Returns
+    -------
+    bitmap_index : OrderedDict or None
+        Bitmap indexes (see ``build_bitmap_index``). None if the file has
+        no bitmap indexes.
+    n_rows : int or None
+        Number of indexed rows.
+    '''
+    with pd.HDFStore(df_file, mode='r') as store:
+        if key not in store:
+            return None, None
+        df_bitmaps = store[key]
+        attrs = store.get_storer(key).attrs
+        bitmap_keys = attrs.comp_bitmap_keys
+        n_rows = attrs.comp_n_rows
+
+    bitmap_index = OrderedDict()
+    for bitmap_key, column in zip(bitmap_keys, df_bitmaps.columns):
+        bitmap_index[tuple(bitmap_key)] = df_bitmaps[column].values
+
+    return bitmap_index, n_rows
+
+
+def select_rows(bitmap_index, n_rows, cuts=None, **selection):
+    '''Returns the rows passing cuts and categorical selections
+
+    Parameters
+    ----------
+    bitmap_index : OrderedDict
+        Bitmap indexes (see ``read_bitmap_index``).
+    n_rows : int
+        Number of indexed rows.
+    cuts : list, optional
+        Names of the quality cuts events must pass (default is None).
+    **selection
+        Column values to select, e.g. ``MC_comp='Fe56Nucleus'``. A list of
+        values selects events with any of them.
+
+    Returns
+    -------
+    rows : numpy.ndarray
+        Sorted row positions of the selected events.
+
+    Examples
+    --------
+    Select iron events passing the standard cuts except ``max_qfrac_1_60``:
+
+    >>> import comptools as comp
+    >>> from comptools.bitmap_index import read_bitmap_index, select_rows
+    >>> df_file = ...  # doctest: +SKIP
+    >>> bitmap_index, n_rows = read_bitmap_index(df_file)  # doctest: +SKIP
+    >>> cuts = [cut for cut in comp.io.get_quality_cut_flow(dataprocessing=True)
+    ...         if cut != 'max_qfrac_1_60']
+    >>> rows = select_rows(bitmap_index, n_rows, cuts=cuts,
+    ...                    MC_comp='Fe56Nucleus')  # doctest: +SKIP
+
+    '''
+    n_bytes = (n_rows + 7) // 8
+    selected = np.full(n_bytes, 255, dtype=np.uint8)
+    for cut in cuts or []:
+        try:
+            selected &= bitmap_index[(QUALITY_CUTS_COLUMN, cut)]
+        except KeyError:
+            raise ValueError('Invalid cut name, {}, entered'.format(cut))
+    for column, values in selection.items():
+        if not isinstance(values, (list, tuple, set, np.ndarray)):
+            values = [values]
+        if not any(key[0] == column for key in bitmap_index):
+            raise ValueError('No bitmap index for column {}'.format(column))
+        column_bitmap = np.zeros(n_bytes, dtype=np.uint8)
+        for value in values:
+            bitmap = bitmap_index.get((column, _to_builtin(value)))
+            if bitmap is not None:
+                column_bitmap |= bitmap
+        selected &= column_bitmap
+
+    return np.flatnonzero(np.unpackbits(selected)[:n_rows])
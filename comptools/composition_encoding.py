@@ -2,6 +2,7 @@
 from __future__ import print_function, division
 from collections import OrderedDict
 import numpy as np
+import pandas as pd
 
 
 _two_group_labels = OrderedDict()
@@ -17,18 +18,45 @@ _three_group_labels['O16Nucleus'] = 'intermediate'
 _three_group_labels['Fe56Nucleus'] = 'heavy'
 
 
+def _get_indexer(values, categories):
+    """Returns the position of each value in categories (-1 if missing)
+
+    Only the distinct values are looked up, so Categorical inputs are
+    mapped without touching the individual strings.
+    """
+    if isinstance(values, pd.Series):
+        values = values.values
+    if isinstance(values, pd.Categorical):
+        codes, uniques = values.codes, values.categories
+    else:
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object).ravel())
+    table = np.append(pd.Index(categories).get_indexer(uniques), -1)
+
+    # Missing values have code -1, which picks the appended -1
+    return table[codes]
+
+
 def composition_group_labels(compositions, num_groups=2):
     if num_groups == 2:
         comp_to_group = _two_group_labels
     elif num_groups == 3:
         comp_to_group = _three_group_labels
     elif num_groups == 4:
-        return compositions
+        comp_to_group = OrderedDict((c, c) for c in _two_group_labels)
     else:
         raise ValueError('Invalid number of groups entered. '
                          'Must be 2, 3, or 4.')
 
-    return [comp_to_group[c] for c in compositions]
+    # Map each composition to its group with a lookup table of codes
+    groups = get_comp_list(num_groups=num_groups)
+    code_table = np.array([groups.index(g) for g in comp_to_group.values()],
+                          dtype=np.int8)
+    comp_codes = _get_indexer(compositions, list(comp_to_group.keys()))
+    if np.any(comp_codes == -1):
+        raise KeyError('Incorrect composition entered')
+
+    return pd.Categorical.from_codes(code_table[comp_codes],
+                                     categories=groups)
 
 
 _two_group_encoding = OrderedDict()
@@ -63,21 +91,29 @@ def _get_group_encoding_dict(num_groups=2):
 
 def encode_composition_groups(groups, num_groups=2):
     group_to_label = _get_group_encoding_dict(num_groups=num_groups)
-    return [group_to_label[g] for g in groups]
+    label_table = np.array(list(group_to_label.values()))
+    group_codes = _get_indexer(groups, list(group_to_label.keys()))
+    if np.any(group_codes == -1):
+        raise KeyError('Incorrect composition group entered')
+
+    return label_table[group_codes]
 
 
 def decode_composition_groups(labels, num_groups=2):
     group_to_label = _get_group_encoding_dict(num_groups=num_groups)
-    label_to_group = {value: key for key, value in group_to_label.items()}
-    try:
-        groups = np.empty_like(labels, dtype=object)
-        for idx, label in enumerate(labels):
-            groups[idx] = label_to_group[label]
-        return groups
-        # return np.array([label_to_group[l] for l in labels], dtype=str)
-    except KeyError:
+    group_table = np.empty(max(group_to_label.values()) + 1, dtype=object)
+    for group, label in group_to_label.items():
+        group_table[label] = group
+
+    labels = np.asarray(labels)
+    with np.errstate(invalid='ignore'):
+        int_labels = labels.astype(int)
+    if not np.all((int_labels == labels) & (int_labels >= 0) &
+                  (int_labels < len(group_table))):
         raise KeyError('Incorrect label entered')
 
+    return group_table[int_labels]
+
 
 def get_comp_list(num_groups=2):
     group_to_label = _get_group_encoding_dict(num_groups=num_groups)
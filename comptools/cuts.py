@@ -0,0 +1,349 @@
+from __future__ import print_function, division
+import re
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+
+_operators = OrderedDict()
+_operators['<='] = np.less_equal
+_operators['>='] = np.greater_equal
+_operators['=='] = np.equal
+_operators['!='] = np.not_equal
+_operators['<'] = np.less
+_operators['>'] = np.greater
+
+_term_regex = re.compile(r'^(~?)\s*([A-Za-z_]\w*)\s*'
+                         r'(?:({})\s*(\S+))?$'.format(
+                             '|'.join(re.escape(op) for op in _operators)))
+
+
+def parse_cut(expression):
+    '''Parses a cut expression into its terms
+
+    A cut expression is one or more terms joined by ``&``. Each term is
+    either a column name (events pass if the column is truthy), a negated
+    column name (e.g. ``'~IceTopMaxSignalInEdge'``), or a comparison of a
+    column with a number (e.g. ``'NStations >= 5'``). An empty expression
+    is passed by every event.
+
+    Parameters
+    ----------
+    expression : str
+        Cut expression.
+
+    Returns
+    -------
+    terms : tuple
+        Tuple of ``(column, operator, threshold, negate)`` terms. The
+        operator and threshold are None for boolean column terms.
+
+    Examples
+    --------
+    >>> from comptools.cuts import parse_cut
+    >>> parse_cut('NChannels_1_60 >= 8 & passed_IceTopQualityCuts')
+    (('NChannels_1_60', '>=', 8.0, False), ('passed_IceTopQualityCuts', None, None, False))
+
+    '''
+    terms = []
+    for term in expression.split('&'):
+        term = term.strip()
+        if not term:
+            if expression.strip():
+                raise ValueError('Invalid cut expression, {}, '
+                                 'entered'.format(expression))
+            continue
+        match = _term_regex.match(term)
+        if match is None:
+            raise ValueError('Invalid cut term, {}, in cut expression '
+                             '{}'.format(term, expression))
+        negate, column, operator, threshold = match.groups()
+        if operator is not None:
+            if negate:
+                raise ValueError('Negated comparisons are not supported, '
+                                 'got {}'.format(term))
+            try:
+                threshold = float(threshold)
+            except ValueError:
+                raise ValueError('Invalid threshold in cut term '
+                                 '{}'.format(term))
+        terms.append((column, operator, threshold, bool(negate)))
+
+    return tuple(terms)
+
+
+def compile_cuts(cuts):
+    '''Parses a declarative cut specification
+
+    Parameters
+    ----------
+    cuts : list or OrderedDict
+        Sequence of ``(name, expression)`` pairs, or a mapping from cut
+        names to cut expressions (see ``parse_cut``). Already compiled cuts
+        are returned unchanged.
+
+    Returns
+    -------
+    compiled_cuts : OrderedDict
+        Mapping from cut names to parsed terms.
+    '''
+    items = cuts.items() if isinstance(cuts, dict) else cuts
+    compiled_cuts = OrderedDict()
+    for name, expression in items:
+        if name in compiled_cuts:
+            raise ValueError('Duplicate cut name, {}, entered'.format(name))
+        if not isinstance(expression, tuple):
+            expression = parse_cut(expression)
+        compiled_cuts[name] = expression
+
+    return compiled_cuts
+
+
+def get_cut_columns(cuts):
+    '''Returns the columns needed to evaluate a cut specification
+
+    Parameters
+    ----------
+    cuts : list or OrderedDict
+        Cut specification (see ``compile_cuts``).
+
+    Returns
+    -------
+    columns : list
+        Columns used by any cut, in order of first use.
+    '''
+    columns = []
+    for terms in compile_cuts(cuts).values():
+        for column, _, _, _ in terms:
+            if column not in columns:
+                columns.append(column)
+
+    return columns
+
+
+def _evaluate_term(df, term):
+    column, operator, threshold, negate = term
+    values = np.asarray(df[column])
+    if operator is None:
+        mask = values.astype(bool)
+    else:
+        with np.errstate(invalid='ignore'):
+            mask = _operators[operator](values, threshold)
+    if negate:
+        mask = ~mask
+
+    return mask
+
+
+def evaluate_cuts(df, cuts, cut_flow=None, term_cache=None):
+    '''Evaluates a set of cuts in a single pass over the needed columns
+
+    Each distinct term (e.g. ``'NStations >= 5'``) is evaluated once, even
+    if it appears in several cuts. Term masks can be shared between calls
+    with ``term_cache``, so evaluating a variation of a cut specification
+    (e.g. a shifted threshold for a systematic study) only scans the
+    columns of the changed terms.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        DataFrame containing all columns used in ``cuts``.
+    cuts : list or OrderedDict
+        Cut specification (see ``compile_cuts``).
+    cut_flow : list, optional
+        Names of the cuts that make up the event selection, in the order
+        they are applied (default is None, all cuts in ``cuts``).
+    term_cache : dict, optional
+        Dictionary of previously evaluated term masks for ``df``. Newly
+        evaluated terms are added to it (default is None, no caching
+        between calls).
+
+    Returns
+    -------
+    selection_mask : numpy.ndarray
+        Boolean array of events passing all cuts in ``cut_flow``.
+    cut_masks : OrderedDict
+        Boolean array of events passing each cut in ``cuts``.
+    cut_flow_table : pandas.DataFrame
+        Fraction of events passing each cut in ``cut_flow`` on its own
+        (``'pass_fraction'``) and together with all preceding cuts
+        (``'cumulative_fraction'``).
+
+    Examples
+    --------
+    >>> import pandas as pd
+    >>> from comptools.cuts import evaluate_cuts
+    >>> df = pd.DataFrame({'NStations': [3, 5, 8],
+    ...                    'max_qfrac_1_60': [0.1, 0.5, 0.2]})
+    >>> cuts = [('NStations', 'NStations >= 5'),
+    ...         ('max_qfrac_1_60', 'max_qfrac_1_60 < 0.3')]
+    >>> selection_mask, cut_masks, cut_flow_table = evaluate_cuts(df, cuts)
+    >>> selection_mask
+    array([False, False,  True])
+
+    '''
+    cuts = compile_cuts(cuts)
+    if cut_flow is None:
+        cut_flow = list(cuts.keys())
+    for name in cut_flow:
+        if name not in cuts:
+            raise ValueError('Invalid cut name, {}, entered'.format(name))
+    if term_cache is None:
+        term_cache = {}
+
+    n_events = len(df)
+    cut_masks = OrderedDict()
+    for name, terms in cuts.items():
+        mask = np.ones(n_events, dtype=bool)
+        for term in terms:
+            if term not in term_cache:
+                term_cache[term] = _evaluate_term(df, term)
+            mask = mask & term_cache[term]
+        cut_masks[name] = mask
+
+    flow_masks = np.empty((len(cut_flow), n_events), dtype=bool)
+    for idx, name in enumerate(cut_flow):
+        flow_masks[idx] = cut_masks[name]
+    cumulative_masks = np.logical_and.accumulate(flow_masks, axis=0)
+    if cut_flow:
+        selection_mask = cumulative_masks[-1]
+    else:
+        selection_mask = np.ones(n_events, dtype=bool)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cut_flow_table = pd.DataFrame(
+            {'pass_fraction': flow_masks.sum(axis=1) / n_events,
+             'cumulative_fraction': cumulative_masks.sum(axis=1) / n_events},
+            index=pd.Index(cut_flow, name='cut'),
+            columns=['pass_fraction', 'cumulative_fraction'])
+
+    return selection_mask, cut_masks, cut_flow_table
+
+
+def _get_threshold_bins(values, operator, thresholds):
+    """Returns the threshold bin of each value
+
+    Bins are chosen such that a value passes the cut at ``thresholds[j]``
+    if its bin is > j (for '>' and '>=') or <= j (for '<' and '<='). NaN
+    values are put in a bin that fails every threshold.
+    """
+    if operator in ['>=', '<']:
+        bins = np.searchsorted(thresholds, values, side='right')
+    elif operator in ['>', '<=']:
+        bins = np.searchsorted(thresholds, values, side='left')
+    else:
+        raise ValueError('Invalid operator, {}, entered. Must be one of '
+                         '<, <=, >, or >='.format(operator))
+    nan_mask = np.isnan(values)
+    bins[nan_mask] = 0 if operator in ['>', '>='] else len(thresholds)
+
+    return bins
+
+
+def scan_cut_thresholds(df, cut_grid, comp_key='comp_group_2',
+                        energy_key=None, energy_bins=None):
+    '''Computes pass fractions and purities over a grid of cut thresholds
+
+    Each event is histogrammed once into its composition, energy bin, and
+    threshold bin of every cut variable. Cumulative sums of this histogram
+    along each cut axis then give the number of events passing every
+    combination of thresholds, so the cost of a scan grows with the number
+    of threshold combinations rather than with the number of events times
+    the number of combinations.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Events to scan, e.g. simulation events passing all cuts that are
+        not being scanned.
+    cut_grid : list
+        List of ``(column, operator, thresholds)`` cut variables, where
+        operator is one of '<', '<=', '>', or '>=' (e.g.
+        ``('NStations', '>=', [3, 4, 5, 6])``).
+    comp_key : str, optional
+        Composition column (default is 'comp_group_2').
+    energy_key : str, optional
+        Energy column to bin events in (default is None, no energy binning).
+    energy_bins : array_like, optional
+        Energy bin edges. Events outside of the bins are ignored. Must be
+        given if ``energy_key`` is given (default is None).
+
+    Returns
+    -------
+    scan : pandas.DataFrame
+        Table indexed by energy bin and the threshold of each cut variable.
+        For each composition ``c``, the ``n_passed_c`` column is the number
+        of events passing all cuts, ``pass_fraction_c`` is the fraction of
+        events in the energy bin passing all cuts, and ``purity_c`` is the
+        fraction of passing events that are of composition ``c``.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> import comptools as comp
+    >>> from comptools.cuts import scan_cut_thresholds
+    >>> df_sim = comp.load_sim(test_size=0)  # doctest: +SKIP
+    >>> cut_grid = [('NStations', '>=', np.arange(3, 10)),
+    ...             ('NChannels_1_60', '>=', np.arange(4, 16)),
+    ...             ('max_qfrac_1_60', '<', np.linspace(0.1, 0.5, 21))]
+    >>> scan = scan_cut_thresholds(df_sim, cut_grid,
+    ...                            energy_key='reco_log_energy',
+    ...                            energy_bins=np.arange(6.0, 8.1, 0.1))  # doctest: +SKIP
+    >>> scan.xs(5, level='NStations >=')  # doctest: +SKIP
+
+    '''
+    if (energy_key is None) != (energy_bins is None):
+        raise ValueError('energy_key and energy_bins must be given together')
+
+    comp_codes, comp_list = pd.factorize(df[comp_key], sort=True)
+    valid_mask = comp_codes >= 0
+    if energy_key is None:
+        n_energy_bins = 1
+        energy_bin_idx = np.zeros(len(df), dtype=int)
+    else:
+        energy_bins = np.asarray(energy_bins)
+        n_energy_bins = len(energy_bins) - 1
+        energy_bin_idx = np.digitize(df[energy_key], energy_bins) - 1
+        valid_mask &= (energy_bin_idx >= 0) & (energy_bin_idx < n_energy_bins)
+
+    shape = [n_energy_bins, len(comp_list)]
+    bin_indices = [energy_bin_idx[valid_mask], comp_codes[valid_mask]]
+    operators, thresholds_list = [], []
+    for column, operator, thresholds in cut_grid:
+        thresholds = np.unique(thresholds).astype(float)
+        values = np.asarray(df[column], dtype=float)[valid_mask]
+        bin_indices.append(_get_threshold_bins(values, operator, thresholds))
+        shape.append(len(thresholds) + 1)
+        operators.append(operator)
+        thresholds_list.append(thresholds)
+
+    flat_idx = np.ravel_multi_index(bin_indices, shape)
+    counts = np.bincount(flat_idx, minlength=np.prod(shape)).reshape(shape)
+    n_total = counts.reshape(shape[:2] + [-1]).sum(axis=-1)
+
+    # Turn per-bin counts into counts passing each threshold
+    for axis, operator in enumerate(operators, 2):
+        if operator in ['>', '>=']:
+            counts = np.flip(np.cumsum(np.flip(counts, axis), axis), axis)
+            counts = np.delete(counts, 0, axis=axis)
+        else:
+            counts = np.cumsum(counts, axis=axis)
+            counts = np.delete(counts, -1, axis=axis)
+
+    # Move composition to the last axis and flatten everything else
+    counts = np.moveaxis(counts, 1, -1).reshape(-1, len(comp_list))
+    n_total = np.repeat(n_total, counts.shape[0] // n_energy_bins, axis=0)
+    n_passed_all = counts.sum(axis=1, keepdims=True)
+
+    data = OrderedDict()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for idx, composition in enumerate(comp_list):
+            data['n_passed_{}'.format(composition)] = counts[:, idx]
+            data['pass_fraction_{}'.format(composition)] = counts[:, idx] / n_total[:, idx]
+            data['purity_{}'.format(composition)] = counts[:, idx] / n_passed_all[:, 0]
+    names = ['energy_bin'] + ['{} {}'.format(column, operator)
+                              for column, operator, _ in cut_grid]
+    index = pd.MultiIndex.from_product([np.arange(n_energy_bins)] +
+                                       thresholds_list, names=names)
+
+    return pd.DataFrame(data, index=index)
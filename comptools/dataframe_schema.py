@@ -0,0 +1,252 @@
+from __future__ import print_function, division
+import numpy as np
+import pandas as pd
+
+from .composition_encoding import get_comp_list
+
+
+SCHEMA_VERSION = 1
+
+# Columns that keep double precision: MJD times (which lose ~0.5 s in
+# float32), energies that are cut on or binned (a float32 value can land
+# on the other side of a bin edge), columns used in quality cuts (see
+# comptools.io.get_quality_cuts), and event weights
+_float64_columns = ['start_time_mjd', 'end_time_mjd',
+                    'MC_energy', 'MC_log_energy', 'lap_energy',
+                    'lap_log_energy', 'reco_energy', 'reco_log_energy',
+                    'eloss_1500_standard', 'max_qfrac_1_60',
+                    'NChannels_1_60', 'NStations',
+                    'FractionContainment_Laputop_IceTop',
+                    'FractionContainment_Laputop_InIce',
+                    'weights']
+
+# Categories for the composition label columns. These are fixed, rather
+# than inferred, so that every appended chunk uses the same encoding.
+_label_categories = {'MC_comp': get_comp_list(num_groups=4),
+                     'MC_comp_class': get_comp_list(num_groups=2),
+                     'comp_group_2': get_comp_list(num_groups=2),
+                     'comp_group_3': get_comp_list(num_groups=3),
+                     'comp_group_4': get_comp_list(num_groups=4),
+                     }
+
+PACKED_FLAGS_COLUMN = 'packed_flags'
+
+
+def _is_flag_column(df, column):
+    dtype = df[column].dtype
+    if dtype == bool:
+        return True
+    if column == 'lap_fitstatus_ok' or column.startswith('passed_'):
+        return np.issubdtype(dtype, np.integer)
+    return False
+
+
+def _get_flags_dtype(num_flags):
+    for dtype in [np.uint8, np.uint16, np.uint32, np.uint64]:
+        if num_flags <= 8 * np.dtype(dtype).itemsize:
+            return dtype
+    raise ValueError('Can\'t pack more than 64 flag columns, '
+                     'got {}'.format(num_flags))
+
+
+def compact_dataframe(df):
+    '''Converts a processed DataFrame to a compact on-disk representation
+
+    Float columns are stored as float32 (except for an allowlist of times,
+    energies, quality cut columns, and weights that need double
+    precision), composition label columns are stored as int8 category
+    codes, and boolean columns (e.g. ``passed_*``) are packed into the
+    bits of a single unsigned integer column. Use ``expand_dataframe``
+    with the returned schema to recover the original DataFrame.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Processed DataFrame (see processing/save_dataframe.py).
+
+    Returns
+    -------
+    df_compact : pandas.DataFrame
+        Compact DataFrame.
+    schema : dict
+        Description of the conversions made. Needed to expand
+        ``df_compact`` back to the original dtypes.
+
+    Examples
+    --------
+    >>> import pandas as pd
+    >>> from comptools.dataframe_schema import (compact_dataframe,
+    ...                                         expand_dataframe)
+    >>> df = pd.DataFrame({'lap_s125': [1.5, 2.5],
+    ...                    'passed_IceTopQualityCuts': [True, False],
+    ...                    'MC_comp': ['PPlus', 'Fe56Nucleus']})
+    >>> df_compact, schema = compact_dataframe(df)
+    >>> df_compact.dtypes
+    lap_s125        float32
+    MC_comp            int8
+    packed_flags      uint8
+    dtype: object
+    >>> expand_dataframe(df_compact, schema).equals(df)
+    True
+
+    '''
+    schema = {'version': SCHEMA_VERSION,
+              'columns': list(df.columns),
+              'dtypes': {},
+              'categories': {},
+              'flags': [],
+              }
+    data = {}
+    flags = []
+    for column in df.columns:
+        values = df[column]
+        dtype = values.dtype
+        if column in _label_categories:
+            categories = _label_categories[column]
+            codes = pd.Categorical(values, categories=categories).codes
+            if ((codes == -1) & values.notnull().values).any():
+                raise ValueError('Column {} contains values not in {}'.format(
+                                 column, categories))
+            data[column] = codes.astype(np.int8)
+            schema['categories'][column] = categories
+            continue
+
+        if _is_flag_column(df, column):
+            if not values.isin([0, 1]).all():
+                raise ValueError('Flag column {} contains values other than '
+                                 '0 and 1'.format(column))
+            flags.append(column)
+        elif dtype == np.float64 and column not in _float64_columns:
+            data[column] = values.values.astype(np.float32)
+        else:
+            data[column] = values.values
+            continue
+        schema['dtypes'][column] = dtype.str
+
+    if flags:
+        flags_dtype = _get_flags_dtype(len(flags))
+        packed = np.zeros(len(df), dtype=flags_dtype)
+        for bit, column in enumerate(flags):
+            packed |= df[column].values.astype(flags_dtype) << flags_dtype(bit)
+        data[PACKED_FLAGS_COLUMN] = packed
+        schema['flags'] = flags
+
+    stored_columns = [c for c in df.columns if c in data]
+    if flags:
+        stored_columns.append(PACKED_FLAGS_COLUMN)
+    df_compact = pd.DataFrame(data, index=df.index, columns=stored_columns)
+
+    return df_compact, schema
+
+
+def expand_dataframe(df, schema, columns=None):
+    '''Converts a compact DataFrame back to its original dtypes
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Compact DataFrame (see ``compact_dataframe``). May contain only a
+        subset of the stored columns (see ``get_stored_columns``).
+    schema : dict or None
+        Schema returned by ``compact_dataframe``. If None, ``df`` is
+        returned unchanged.
+    columns : array_like, optional
+        Columns to return (default is None, all columns in ``schema`` that
+        can be recovered from ``df`` are returned).
+
+    Returns
+    -------
+    df_expanded : pandas.DataFrame
+        DataFrame with the original column dtypes.
+    '''
+    if schema is None:
+        return df if columns is None else df.loc[:, list(columns)]
+
+    if columns is None:
+        columns = [c for c in schema['columns']
+                   if c in df.columns or (c in schema['flags'] and
+                                          PACKED_FLAGS_COLUMN in df.columns)]
+    data = {}
+    for column in columns:
+        if column in schema['flags']:
+            bit = schema['flags'].index(column)
+            packed = df[PACKED_FLAGS_COLUMN].values
+            values = (packed >> packed.dtype.type(bit)) & packed.dtype.type(1)
+        elif column in schema['categories']:
+            categories = schema['categories'][column]
+            values = pd.Categorical.from_codes(df[column].values,
+                                               categories=categories)
+            values = np.asarray(values, dtype=object)
+        else:
+            values = df[column].values
+        if column in schema['dtypes']:
+            values = values.astype(np.dtype(schema['dtypes'][column]))
+        data[column] = values
+
+    return pd.DataFrame(data, index=df.index, columns=list(columns))
+
+
+def get_stored_columns(columns, schema):
+    '''Returns the stored columns needed to recover the requested columns
+
+    Parameters
+    ----------
+    columns : array_like or None
+        Requested (expanded) columns.
+    schema : dict or None
+        Schema returned by ``compact_dataframe``.
+
+    Returns
+    -------
+    stored_columns : list or None
+        Columns to read from the compact DataFrame. None if ``columns``
+        is None.
+    '''
+    if columns is None or schema is None:
+        return None if columns is None else list(columns)
+
+    stored_columns = []
+    for column in columns:
+        if column in schema['flags']:
+            column = PACKED_FLAGS_COLUMN
+        if column not in stored_columns:
+            stored_columns.append(column)
+
+    return stored_columns
+
+
+def save_schema(store, schema, key='dataframe'):
+    '''Saves a DataFrame schema as an attribute of a HDFStore table
+
+    Parameters
+    ----------
+    store : pandas.HDFStore
+        Open HDFStore with a table at ``key``.
+    schema : dict
+        Schema returned by ``compact_dataframe``.
+    key : str, optional
+        Table key (default is 'dataframe').
+    '''
+    store.get_storer(key).attrs.comp_schema = schema
+
+
+def read_schema(df_file, key='dataframe'):
+    '''Reads the DataFrame schema stored with a HDF5 DataFrame file
+
+    Parameters
+    ----------
+    df_file : path
+        Path to HDF5 DataFrame file.
+    key : str, optional
+        Table key (default is 'dataframe').
+
+    Returns
+    -------
+    schema : dict or None
+        Stored schema. None if the file was saved without one.
+    '''
+    with pd.HDFStore(df_file, mode='r') as store:
+        attrs = store.get_storer(key).attrs
+        schema = getattr(attrs, 'comp_schema', None)
+
+    return schema
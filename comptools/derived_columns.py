@@ -0,0 +1,155 @@
+from __future__ import print_function, division
+from collections import OrderedDict
+import numpy as np
+
+
+# Registry of columns that can be computed from other columns. Maps column
+# name to a (dependencies, function) pair, where function takes the
+# dependency columns as numpy arrays and returns the derived column.
+_derived_columns = OrderedDict()
+
+
+def register_derived_column(name, dependencies, func, overwrite=False):
+    '''Registers a column that can be computed on demand
+
+    Parameters
+    ----------
+    name : str
+        Name of the derived column.
+    dependencies : list
+        Names of the columns needed to compute ``name``. These can be
+        stored or other derived columns.
+    func : callable
+        Vectorized function that takes the dependency columns, in order,
+        as numpy arrays and returns the derived column.
+    overwrite : bool, optional
+        Option to replace an already registered column with the same name
+        (default is False).
+
+    Raises
+    ------
+    ValueError
+        If ``name`` is already registered and overwrite is False.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from comptools.derived_columns import register_derived_column
+    >>> register_derived_column('log_s125_over_dEdX', ['log_s125', 'log_dEdX'],
+    ...                         np.subtract)
+
+    '''
+    if name in _derived_columns and not overwrite:
+        raise ValueError('Derived column {} is already registered. Use '
+                         'overwrite=True to replace it.'.format(name))
+    if name in dependencies:
+        raise ValueError('Derived column {} can\'t depend on '
+                         'itself'.format(name))
+    _derived_columns[name] = (list(dependencies), func)
+
+
+def get_derived_columns():
+    '''Returns the names of all registered derived columns
+    '''
+    return list(_derived_columns.keys())
+
+
+def resolve_columns(columns, stored_columns):
+    '''Splits requested columns into columns to read and columns to derive
+
+    Requested columns that are stored are read directly. Registered
+    derived columns that aren't stored are computed from their
+    (recursively resolved) dependencies.
+
+    Parameters
+    ----------
+    columns : array_like
+        Requested columns.
+    stored_columns : array_like
+        Columns stored on disk.
+
+    Returns
+    -------
+    read_columns : list
+        Stored columns to read. Unknown columns are passed through, so
+        that reading them raises the usual error.
+    derived_columns : list
+        Columns to compute, in an order where every column comes after
+        its dependencies.
+    '''
+    stored_columns = set(stored_columns)
+    read_columns, derived_columns = [], []
+
+    def _resolve(column, parents):
+        if column in read_columns or column in derived_columns:
+            return
+        if column in stored_columns or column not in _derived_columns:
+            read_columns.append(column)
+            return
+        if column in parents:
+            raise ValueError('Circular dependency for derived column '
+                             '{}'.format(column))
+        for dependency in _derived_columns[column][0]:
+            _resolve(dependency, parents + [column])
+        derived_columns.append(column)
+
+    for column in columns:
+        _resolve(column, [])
+
+    return read_columns, derived_columns
+
+
+def add_derived_columns(df, columns):
+    '''Adds derived columns to a DataFrame
+
+    Columns already in ``df`` aren't recomputed, so repeated calls on the
+    same DataFrame only compute each derived column once.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        DataFrame containing the dependencies of ``columns``.
+    columns : array_like
+        Registered derived columns to add.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Input DataFrame with the derived columns added.
+    '''
+    read_columns, derived_columns = resolve_columns(columns, df.columns)
+    missing_columns = [c for c in read_columns if c not in df.columns]
+    if missing_columns:
+        raise ValueError('Can\'t compute derived columns {} without '
+                         'columns {}'.format(list(columns), missing_columns))
+    for column in derived_columns:
+        dependencies, func = _derived_columns[column]
+        df[column] = func(*[df[dependency].values
+                            for dependency in dependencies])
+
+    return df
+
+
+def _nan_to_num_log10(values):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.nan_to_num(np.log10(values))
+
+
+def _log10(values):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.log10(values)
+
+
+register_derived_column('MC_log_energy', ['MC_energy'], _nan_to_num_log10)
+register_derived_column('lap_log_energy', ['lap_energy'], _nan_to_num_log10)
+register_derived_column('lap_cos_zenith', ['lap_zenith'], np.cos)
+for dist in ['50', '80', '125', '180', '250', '500']:
+    register_derived_column('log_s' + dist, ['lap_s' + dist], _log10)
+register_derived_column('log_dEdX', ['eloss_1500_standard'], _log10)
+for i in ['1_60']:
+    register_derived_column('InIce_log_charge_' + i, ['InIce_charge_' + i],
+                            _log10)
+    register_derived_column('log_NChannels_' + i, ['NChannels_' + i], _log10)
+    register_derived_column('log_NHits_' + i, ['NHits_' + i], _log10)
+register_derived_column('log_d4r_peak_energy', ['d4r_peak_energy'], _log10)
+register_derived_column('log_d4r_peak_sigma', ['d4r_peak_sigma'], _log10)
@@ -0,0 +1,152 @@
+from __future__ import print_function, division
+from collections import OrderedDict
+import numpy as np
+
+
+# Bit layout of the (non-negative) int64 event key, from most to least
+# significant: dataset ID, run, event, sub-event
+_DATASET_BITS = 7
+_RUN_BITS = 20
+_EVENT_BITS = 31
+_SUB_EVENT_BITS = 5
+
+_SUB_EVENT_SHIFT = 0
+_EVENT_SHIFT = _SUB_EVENT_SHIFT + _SUB_EVENT_BITS
+_RUN_SHIFT = _EVENT_SHIFT + _EVENT_BITS
+_DATASET_SHIFT = _RUN_SHIFT + _RUN_BITS
+
+# Dataset IDs are part of stored event keys. Only ever add new entries,
+# never change existing ones.
+_dataset_ids = OrderedDict()
+# Data detector configurations
+_dataset_ids['IC79.2010'] = 1
+_dataset_ids['IC86.2011'] = 2
+_dataset_ids['IC86.2012'] = 3
+_dataset_ids['IC86.2013'] = 4
+_dataset_ids['IC86.2014'] = 5
+_dataset_ids['IC86.2015'] = 6
+# IC79.2010 simulation sets
+_dataset_ids[7006] = 16
+_dataset_ids[7579] = 17
+_dataset_ids[7241] = 18
+_dataset_ids[7263] = 19
+_dataset_ids[7791] = 20
+_dataset_ids[7242] = 21
+_dataset_ids[7262] = 22
+_dataset_ids[7851] = 23
+_dataset_ids[7007] = 24
+_dataset_ids[7784] = 25
+# IC86.2012 simulation sets
+_dataset_ids[12360] = 32
+_dataset_ids[12362] = 33
+_dataset_ids[12630] = 34
+_dataset_ids[12631] = 35
+
+
+def get_dataset_id(dataset):
+    '''Returns the integer ID used in event keys for a sim set or config
+
+    Parameters
+    ----------
+    dataset : int or str
+        Simulation set number (e.g. 12360) or data detector configuration
+        (e.g. 'IC86.2012').
+
+    Returns
+    -------
+    dataset_id : int
+        Dataset ID.
+    '''
+    try:
+        return _dataset_ids[dataset]
+    except KeyError:
+        raise ValueError('Invalid dataset, {}, entered'.format(dataset))
+
+
+def _check_range(values, num_bits, name):
+    if np.any(values < 0) or np.any(values >= 2**num_bits):
+        raise ValueError('{} values must be in the range [0, {})'.format(
+                         name, 2**num_bits))
+
+
+def encode_event_keys(dataset, runs, events, sub_events):
+    '''Packs run, event, and sub-event numbers into int64 event keys
+
+    Parameters
+    ----------
+    dataset : int or str
+        Simulation set number (e.g. 12360) or data detector configuration
+        (e.g. 'IC86.2012') the events belong to.
+    runs : array_like
+        Run numbers.
+    events : array_like
+        Event numbers.
+    sub_events : array_like
+        Sub-event numbers.
+
+    Returns
+    -------
+    keys : numpy.ndarray
+        Array of unique int64 event keys.
+
+    Examples
+    --------
+    >>> from comptools.event_keys import encode_event_keys, decode_event_keys
+    >>> keys = encode_event_keys(12360, [1, 1], [10, 11], [0, 0])
+    >>> decode_event_keys(keys)
+    (array([12360, 12360], dtype=object), array([1, 1]), array([10, 11]), array([0, 0]))
+
+    '''
+    dataset_id = get_dataset_id(dataset)
+    runs = np.asarray(runs, dtype=np.int64)
+    events = np.asarray(events, dtype=np.int64)
+    sub_events = np.asarray(sub_events, dtype=np.int64)
+    _check_range(runs, _RUN_BITS, 'Run')
+    _check_range(events, _EVENT_BITS, 'Event')
+    _check_range(sub_events, _SUB_EVENT_BITS, 'SubEvent')
+
+    keys = ((np.int64(dataset_id) << _DATASET_SHIFT) |
+            (runs << _RUN_SHIFT) |
+            (events << _EVENT_SHIFT) |
+            (sub_events << _SUB_EVENT_SHIFT))
+
+    return keys
+
+
+def decode_event_keys(keys):
+    '''Unpacks int64 event keys into dataset, run, event, and sub-event
+
+    Parameters
+    ----------
+    keys : array_like
+        Event keys (see ``encode_event_keys``).
+
+    Returns
+    -------
+    datasets : numpy.ndarray
+        Simulation set number or data detector configuration of each event.
+    runs : numpy.ndarray
+        Run numbers.
+    events : numpy.ndarray
+        Event numbers.
+    sub_events : numpy.ndarray
+        Sub-event numbers.
+    '''
+    keys = np.asarray(keys, dtype=np.int64)
+
+    def _unpack(shift, num_bits):
+        return (keys >> shift) & ((1 << num_bits) - 1)
+
+    dataset_ids = _unpack(_DATASET_SHIFT, _DATASET_BITS)
+    if not np.all(np.isin(dataset_ids, list(_dataset_ids.values()))):
+        raise ValueError('Event keys contain unknown dataset IDs')
+    id_to_dataset = np.empty(2**_DATASET_BITS, dtype=object)
+    for dataset, dataset_id in _dataset_ids.items():
+        id_to_dataset[dataset_id] = dataset
+    datasets = id_to_dataset[dataset_ids]
+
+    runs = _unpack(_RUN_SHIFT, _RUN_BITS)
+    events = _unpack(_EVENT_SHIFT, _EVENT_BITS)
+    sub_events = _unpack(_SUB_EVENT_SHIFT, _SUB_EVENT_BITS)
+
+    return datasets, runs, events, sub_events
@@ -1,18 +1,27 @@
 
 from __future__ import print_function, division
 import os
+import shutil
+import threading
+from collections import OrderedDict
+import hashlib
 import numpy as np
 import pandas as pd
 import dask
-from dask import multiprocessing
+from dask import delayed, multiprocessing, threaded
 from dask.diagnostics import ProgressBar
 import dask.dataframe as dd
 from sklearn.model_selection import ShuffleSplit
 from sklearn.externals import joblib
 
-from .base import get_paths
+from .base import get_paths, get_energybins
 from .simfunctions import get_sim_configs
 from .datafunctions import get_data_configs
+from .dataframe_schema import read_schema, expand_dataframe, get_stored_columns
+from .cuts import evaluate_cuts, get_cut_columns
+from .bitmap_index import read_bitmap_index, select_rows
+from .derived_columns import (get_derived_columns, resolve_columns,
+                              add_derived_columns)
 
 
 def validate_dataframe(df):
@@ -24,157 +33,171 @@ def validate_datatype(datatype):
     assert datatype in ['sim', 'data'], 'datatype must be either \'sim\' or \'data\''
 
 
+def get_quality_cuts(log_energy_min=None, log_energy_max=None):
+    """Returns the quality cut specification
+
+    Adapted from PHYSICAL REVIEW D 88, 042004 (2013).
+
+    Parameters
+    ----------
+    log_energy_min : int, float, optional
+        Lower limit on the Laputop log energy in GeV (default is None).
+    log_energy_max : int, float, optional
+        Upper limit on the Laputop log energy in GeV (default is None).
+
+    Returns
+    -------
+    cuts : list
+        List of ``(name, expression)`` cuts (see ``comptools.cuts``).
+    """
+    min_energy = ''
+    if log_energy_min is not None:
+        min_energy = 'lap_energy > {!r}'.format(10**log_energy_min)
+    max_energy = ''
+    if log_energy_max is not None:
+        max_energy = 'lap_energy < {!r}'.format(10**log_energy_max)
+
+    cuts = [
+        # IT specific cuts
+        ('passed_IceTopQualityCuts', 'passed_IceTopQualityCuts'),
+        # ('lap_fitstatus_ok', 'lap_fitstatus_ok'),
+        # ('FractionContainment_Laputop_IceTop',
+        #  'FractionContainment_Laputop_IceTop < 0.96'),
+        # ('lap_beta', 'lap_beta < 9.5 & lap_beta > 1.4'),
+        # ('lap_rlogl', 'lap_rlogl < 2'),
+        # ('IceTopMaxSignalInEdge', '~IceTopMaxSignalInEdge'),
+        # ('IceTopMaxSignal', 'IceTopMaxSignal >= 6'),
+        # ('IceTopNeighbourMaxSignal', 'IceTopNeighbourMaxSignal >= 4'),
+        ('NStations', 'NStations >= 5'),
+        # ('StationDensity', 'StationDensity >= 0.2'),
+        # Min/max energy cuts
+        ('min_energy_lap', min_energy),
+        ('max_energy_lap', max_energy),
+        ('reco_energy_range', ' & '.join(c for c in [min_energy, max_energy]
+                                         if c)),
+        # InIce specific cuts
+        ('eloss_positive', 'eloss_1500_standard > 0'),
+        ('passed_InIceQualityCuts',
+         'passed_InIceQualityCuts & eloss_1500_standard > 0'),
+        ('NChannels_1_60', 'NChannels_1_60 >= 8'),
+        ('max_qfrac_1_60', 'max_qfrac_1_60 < 0.3'),
+        ('FractionContainment_Laputop_InIce',
+         'FractionContainment_Laputop_InIce < 1.0'),
+        # Millipede specific cuts
+        # ('mil_rlogl', 'mil_rlogl < 2.0'),
+        # ('num_millipede_cascades', 'num_millipede_cascades >= 3'),
+        # Some combined cuts
+        ('num_hits_1_60', 'NChannels_1_60 >= 8 & NStations >= 5'),
+    ]
+
+    return cuts
+
+
+def get_quality_cut_flow(dataprocessing=False):
+    """Returns the names of the standard quality cuts, in applied order
+    """
+    if dataprocessing:
+        cut_flow = ['passed_IceTopQualityCuts',
+                    'FractionContainment_Laputop_InIce',
+                    'reco_energy_range',
+                    'num_hits_1_60',
+                    'max_qfrac_1_60',
+                    ]
+    else:
+        cut_flow = ['passed_IceTopQualityCuts',
+                    'FractionContainment_Laputop_InIce',
+                    'passed_InIceQualityCuts',
+                    'num_hits_1_60',
+                    'reco_energy_range',
+                    ]
+
+    return cut_flow
+
+
 def apply_quality_cuts(df, datatype='sim', return_cut_dict=False,
                        dataprocessing=False, verbose=True, log_energy_min=None,
-                       log_energy_max=None):
+                       log_energy_max=None, cuts=None, term_cache=None):
 
     validate_dataframe(df)
     validate_datatype(datatype)
 
-    # Quality Cuts #
-    # Adapted from PHYSICAL REVIEW D 88, 042004 (2013)
-    cut_dict = {}
-    # IT specific cuts
-    cut_dict['passed_IceTopQualityCuts'] = df['passed_IceTopQualityCuts'].astype(bool)
-    # cut_dict['lap_fitstatus_ok'] = df['lap_fitstatus_ok']
-    # cut_dict['FractionContainment_Laputop_IceTop'] = df[
-    #     'FractionContainment_Laputop_IceTop'] < 0.96
-    # cut_dict['lap_beta'] = (df['lap_beta'] < 9.5) & (df['lap_beta'] > 1.4)
-    # cut_dict['lap_rlogl'] = df['lap_rlogl'] < 2
-    # cut_dict['IceTopMaxSignalInEdge'] = ~df['IceTopMaxSignalInEdge'].astype(bool)
-    # cut_dict['IceTopMaxSignal'] = (df['IceTopMaxSignal'] >= 6)
-    # cut_dict['IceTopNeighbourMaxSignal'] = df['IceTopNeighbourMaxSignal'] >= 4
-    cut_dict['NStations'] = df['NStations'] >= 5
-    # cut_dict['StationDensity'] = df['StationDensity'] >= 0.2
-
-    # Set up min/max energy cuts
-    cut_dict['min_energy_lap'] = np.ones(len(df['lap_energy']), dtype=bool)
-    cut_dict['max_energy_lap'] = np.ones(len(df['lap_energy']), dtype=bool)
-    if log_energy_min is not None:
-        cut_dict['min_energy_lap'] = df['lap_energy'] > 10**log_energy_min
-    if log_energy_max is not None:
-        cut_dict['max_energy_lap'] = df['lap_energy'] < 10**log_energy_max
-
-    # cut_dict['min_energy_lap'] = df['lap_energy'] > 10**6.0
-    # cut_dict['max_energy_lap'] = df['lap_energy'] < 10**8.0
-
-    # cut_dict['IceTop_charge_175m'] = np.logical_not(df['IceTop_charge_175m'].isnull())
-    # cut_dict['IceTop_charge'] = np.logical_not(df['IceTop_charge'].isnull()) & cut_dict['IceTop_charge_175m']
-
-    # InIce specific cuts
-    cut_dict['eloss_positive'] = df['eloss_1500_standard'] > 0
-    cut_dict['passed_InIceQualityCuts'] = df['passed_InIceQualityCuts'].astype(bool) & cut_dict['eloss_positive']
-    # for cut in ['MilliNCascAbove2', 'MilliQtotRatio', 'MilliRloglBelow2',
-    #             'NCh_CoincLaputopCleanedPulsesAbove7', 'StochRecoSucceeded']:
-    #     cut_dict['passed_{}'.format(cut)] = df['passed_{}'.format(cut)].astype(bool)
-    for i in ['1_60']:
-        cut_dict['NChannels_' + i] = df['NChannels_' + i] >= 8
-        cut_dict['max_qfrac_' + i] = df['max_qfrac_' + i] < 0.3
-    cut_dict['FractionContainment_Laputop_InIce'] = df['FractionContainment_Laputop_InIce'] < 1.0
-
-    # # Millipede specific cuts
-    # cut_dict['mil_rlogl'] = df['mil_rlogl'] < 2.0
-    # cut_dict['mil_qtot_ratio'] = df['mil_qtot_predicted']/df['mil_qtot_measured'] > -0.03
-    # cut_dict['num_millipede_cascades'] = df['num_millipede_cascades'] >= 3
-
-    # Some conbined cuts
-    # cut_dict['lap_reco_success'] = cut_dict['lap_fitstatus_ok'] & cut_dict['lap_beta'] & cut_dict['lap_rlogl']
-    # cut_dict['num_hits_1_60'] = cut_dict['NChannels_1_60'] & cut_dict['NStations']
-    for i in ['1_60']:
-        cut_dict['num_hits_'+i] = cut_dict['NChannels_'+i] & cut_dict['NStations']
-    # cut_dict['lap_containment'] = cut_dict[
-    #     'FractionContainment_Laputop_IceTop'] & cut_dict['FractionContainment_Laputop_InIce']
-    # cut_dict['IT_signal'] = cut_dict['IceTopMaxSignalInEdge'] & cut_dict[
-    #     'IceTopMaxSignal'] & cut_dict['IceTopNeighbourMaxSignal']
-
-    cut_dict['reco_energy_range'] = cut_dict['min_energy_lap'] & cut_dict['max_energy_lap']
-    # cut_dict['lap_IT_containment'] = cut_dict['FractionContainment_Laputop_IceTop'] & cut_dict['IT_signal']
-    # cut_dict['mil_reco_success'] = cut_dict['mil_rlogl'] & cut_dict[
-    #     'mil_qtot_ratio'] & cut_dict['num_millipede_cascades']
+    if cuts is None:
+        cuts = get_quality_cuts(log_energy_min=log_energy_min,
+                                log_energy_max=log_energy_max)
+    cut_flow = None if return_cut_dict else get_quality_cut_flow(dataprocessing)
+    selection_mask, cut_dict, cut_flow_table = evaluate_cuts(
+        df, cuts, cut_flow=cut_flow, term_cache=term_cache)
 
     if return_cut_dict:
         print('Returning without applying quality cuts')
         return df, cut_dict
     else:
-        selection_mask = np.array([True] * len(df))
-        if dataprocessing:
-            standard_cut_keys = ['passed_IceTopQualityCuts',
-                                 'FractionContainment_Laputop_InIce',
-                                 'reco_energy_range',
-                                 'num_hits_1_60',
-                                 'max_qfrac_1_60',
-                                 ]
-        else:
-            standard_cut_keys = ['passed_IceTopQualityCuts',
-                                 'FractionContainment_Laputop_InIce',
-                                 'passed_InIceQualityCuts',
-                                 'num_hits_1_60',
-                                 'reco_energy_range',
-                                 ]
-        for key in standard_cut_keys:
-            selection_mask *= cut_dict[key]
         # Print cut event flow
         if verbose:
-            n_total = len(df)
-            print('Starting out with {} {} events'.format(n_total, datatype))
-            cumulative_cut_mask = np.array([True] * n_total)
+            print('Starting out with {} {} events'.format(len(df), datatype))
             print('{} quality cut event flow:'.format(datatype))
-            for key in standard_cut_keys:
-                cumulative_cut_mask *= cut_dict[key]
-                print('{:>30}:  {:>5.3}  {:>5.3}'.format(key, np.sum(
-                    cut_dict[key]) / n_total, np.sum(cumulative_cut_mask) / n_total))
+            for key, row in cut_flow_table.iterrows():
+                print('{:>30}:  {:>5.3}  {:>5.3}'.format(
+                    key, row['pass_fraction'], row['cumulative_fraction']))
             print('\n')
 
         df_cut = df[selection_mask]
-        # df_cut = df[selection_mask].reset_index(drop=True)
 
         return df_cut
 
 
 def add_convenience_variables(df, datatype='sim'):
+    """Adds every registered derived column that can be computed from df
+
+    See ``comptools.derived_columns`` for the available columns. To only
+    compute the columns that are needed, request them directly from
+    ``load_sim`` or ``load_data`` instead.
+    """
     validate_dataframe(df)
 
-    if datatype == 'sim':
-        df['MC_log_energy'] = np.nan_to_num(np.log10(df['MC_energy']))
-    # Add log-scale columns to df
-    df['lap_log_energy'] = np.nan_to_num(np.log10(df['lap_energy']))
-    # df['InIce_log_charge_1_60'] = np.nan_to_num(np.log10(df['InIce_charge_1_60']))
-    for i in ['1_60']:
-        # df['InIce_log_charge_'+i] = np.nan_to_num(np.log10(df['InIce_charge_'+i]))
-        df['InIce_log_charge_'+i] = np.log10(df['InIce_charge_'+i])
-        df['log_NChannels_'+i] = np.log10(df['NChannels_'+i])
-        df['log_NHits_'+i] = np.log10(df['NHits_'+i])
-    df['lap_cos_zenith'] = np.cos(df['lap_zenith'])
-    for dist in ['50', '80', '125', '180', '250', '500']:
-        df['log_s'+dist] = np.log10(df['lap_s'+dist])
-    df['log_dEdX'] = np.log10(df['eloss_1500_standard'])
-    df['log_d4r_peak_energy'] = np.log10(df['d4r_peak_energy'])
-    df['log_d4r_peak_sigma'] = np.log10(df['d4r_peak_sigma'])
-
-    # df['log_IceTop_charge'] = np.log10(df['IceTop_charge'])
-    # df['log_IceTop_charge_175m'] = np.log10(df['IceTop_charge_175m'])
-    # df['IT_charge_ratio'] = df['IceTop_charge_175m']/df['IceTop_charge']
-    # df['charge_ratio'] = df['InIce_charge_1_60']/df['IceTop_charge']
-
-    # Add ratio of features (could help improve RF classification)
-    # df['charge_nchannels_ratio'] = df['InIce_charge_1_30'] / df['NChannels_1_30']
-    # df['charge_nhits_ratio'] = df['InIce_charge_1_30'] / df['NHits_1_30']
-    # df['nhits_nchannels_ratio'] =  df['NHits_1_30'] / df['NChannels_1_30']
-    # df['stationdensity_charge_ratio'] = df[
-    #     'StationDensity'] / df['InIce_charge_1_30']
-    # df['stationdensity_nchannels_ratio'] = df[
-    #     'StationDensity'] / df['NChannels_1_30']
-    # df['stationdensity_nhits_ratio'] = df['StationDensity'] / df['NHits_1_30']
+    columns = []
+    for column in get_derived_columns():
+        if column == 'MC_log_energy' and datatype != 'sim':
+            continue
+        read_columns, _ = resolve_columns([column], df.columns)
+        if all(c in df.columns for c in read_columns):
+            columns.append(column)
 
-    return df
+    return add_derived_columns(df, columns)
 
 
-def _load_basic_dataframe(df_file=None, datatype='sim', config='IC86.2012',
-                          energy_reco=True, energy_cut_key='reco_log_energy',
-                          log_energy_min=None, log_energy_max=None,
-                          columns=None, n_jobs=1, verbose=False):
+def _get_file_columns(df_file):
+    """Returns the (expanded) columns of a processed DataFrame file
+    """
+    schema = read_schema(df_file)
+    if schema is not None:
+        return list(schema['columns'])
+    with pd.HDFStore(df_file, mode='r') as store:
+        columns = list(store.select('dataframe', start=0, stop=0).columns)
 
-    validate_datatype(datatype)
+    return columns
+
+
+def _resolve_load_columns(df_file, columns, energy_cut_key=None,
+                          extra_columns=None):
+    """Returns the stored columns to read and the derived columns to
+    compute for the requested columns (and the energy cut key and any
+    extra columns, e.g. energy model features or quality cut columns)
+    """
+    if columns is None:
+        return None, []
+    columns = list(columns)
+    extra_columns = list(extra_columns or [])
+    if energy_cut_key not in ['reco_log_energy', 'reco_energy']:
+        extra_columns.append(energy_cut_key)
+    for column in extra_columns:
+        if column is not None and column not in columns:
+            columns.append(column)
+
+    return resolve_columns(columns, _get_file_columns(df_file))
+
+
+def _get_dataframe_file(df_file=None, datatype='sim', config='IC86.2012'):
     # If df_file is not specified, use default path
     if df_file is None:
         paths = get_paths()
@@ -183,36 +206,983 @@ def _load_basic_dataframe(df_file=None, datatype='sim', config='IC86.2012',
     if not os.path.exists(df_file):
         raise IOError('The DataFrame file {} doesn\'t exist'.format(df_file))
 
+    return df_file
+
+
+def _get_energy_mask(df, energy_cut_key='reco_log_energy',
+                     log_energy_min=None, log_energy_max=None):
+    energy_mask = np.ones(df.shape[0], dtype=bool)
+    if log_energy_min is not None:
+        energy_mask = energy_mask & (df[energy_cut_key] > log_energy_min)
+    if log_energy_max is not None:
+        energy_mask = energy_mask & (df[energy_cut_key] < log_energy_max)
+
+    return energy_mask
+
+
+def get_dataframe_cache_dir(df_file):
+    """Returns the path to the Parquet cache of a processed DataFrame file
+
+    Parameters
+    ----------
+    df_file : path
+        Path to processed DataFrame HDF5 file (e.g. sim_dataframe.hdf5).
+
+    Returns
+    -------
+    cache_dir : path
+        Path to the Parquet dataset directory (e.g. sim_dataframe.parquet).
+    """
+    return os.path.splitext(df_file)[0] + '.parquet'
+
+
+def _dataframe_cache_is_valid(df_file, cache_dir):
+    """Checks that a Parquet cache exists and is newer than its HDF5 source
+    """
+    if not os.path.isdir(cache_dir):
+        return False
+    return os.path.getmtime(cache_dir) >= os.path.getmtime(df_file)
+
+
+# Column holding each event's row number in the HDF5 file, so that loading
+# from an energy-sorted cache can restore the original event order
+_ROW_COLUMN = 'hdf5_row'
+_ENERGY_INDEX_FILE = '_energy_index.npz'
+
+
+def save_dataframe_cache(df_file, cache_dir=None, chunksize=1000000,
+                         row_group_size=100000, sort_key=None,
+                         index_step=0.01, overwrite=False):
+    """Builds a columnar Parquet cache from a processed DataFrame file
+
+    The HDF5 ``'dataframe'`` table is streamed in chunks of ``chunksize``
+    rows and each chunk is written as a separate Parquet file in
+    ``cache_dir``. Row order and the event index are preserved, so
+    loading from the cache gives the same DataFrame as loading from the
+    HDF5 file. Once built, the cache is used by ``load_sim`` and
+    ``load_data`` to read only the requested columns and to push energy
+    range cuts down to Parquet row-group statistics.
+
+    If ``sort_key`` is given, events are instead stored sorted by that
+    energy column, together with a small index of the row offsets of a
+    fine log-energy grid. Loading an energy range of ``sort_key`` then
+    only reads the contiguous rows found with ``numpy.searchsorted``.
+    Events are returned in their original order either way.
+
+    Parameters
+    ----------
+    df_file : path
+        Path to processed DataFrame HDF5 file.
+    cache_dir : path, optional
+        Output Parquet dataset directory (default is
+        ``get_dataframe_cache_dir(df_file)``).
+    chunksize : int, optional
+        Number of rows to read from ``df_file`` at a time, and number of
+        rows in each Parquet file (default is 1000000).
+    row_group_size : int, optional
+        Number of rows in each Parquet row group (default is 100000).
+    sort_key : str, optional
+        Stored log energy column to sort events by (e.g.
+        'lap_log_energy'). Note that sorting requires loading the whole
+        DataFrame into memory (default is None, events aren't sorted).
+    index_step : float, optional
+        Log energy spacing of the sorted energy index (default is 0.01).
+    overwrite : bool, optional
+        Option to overwrite an existing cache (default is False).
+
+    Returns
+    -------
+    cache_dir : path
+        Path to the Parquet dataset directory.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('pyarrow is required to build a Parquet '
+                          'DataFrame cache')
+
+    if not os.path.exists(df_file):
+        raise IOError('The DataFrame file {} doesn\'t exist'.format(df_file))
+    if cache_dir is None:
+        cache_dir = get_dataframe_cache_dir(df_file)
+    if os.path.exists(cache_dir):
+        if overwrite:
+            shutil.rmtree(cache_dir)
+        else:
+            raise IOError('The DataFrame cache {} already exists. Set '
+                          'overwrite=True to rebuild it.'.format(cache_dir))
+
+    # Write to a temporary directory first so that an interrupted build
+    # never leaves behind a partial cache that looks valid
+    tmp_dir = cache_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    if sort_key is None:
+        chunks = _iter_hdf_chunks(df_file, chunksize=chunksize)
+    else:
+        df_sorted = pd.concat(list(_iter_hdf_chunks(df_file,
+                                                    chunksize=chunksize)))
+        df_sorted[_ROW_COLUMN] = np.arange(len(df_sorted))
+        df_sorted = df_sorted.sort_values(sort_key, kind='mergesort')
+        _save_energy_index(os.path.join(tmp_dir, _ENERGY_INDEX_FILE),
+                           df_sorted[sort_key].values, sort_key=sort_key,
+                           chunksize=chunksize, step=index_step)
+        chunks = (df_sorted.iloc[start:start + chunksize]
+                  for start in range(0, len(df_sorted), chunksize))
+
+    for idx, df in enumerate(chunks):
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        part_file = os.path.join(tmp_dir, 'part.{:05d}.parquet'.format(idx))
+        pq.write_table(table, part_file, row_group_size=row_group_size)
+    os.rename(tmp_dir, cache_dir)
+
+    return cache_dir
+
+
+def _save_energy_index(index_file, sorted_energies, sort_key, chunksize,
+                       step=0.01):
+    finite = sorted_energies[np.isfinite(sorted_energies)]
+    if len(finite):
+        grid_min = np.floor(finite[0] / step) * step
+        grid_max = np.ceil(finite[-1] / step) * step
+        grid = np.arange(grid_min, grid_max + step / 2, step)
+    else:
+        grid = np.empty(0)
+    # offsets[i] is the first row with an energy >= grid[i]
+    offsets = np.searchsorted(sorted_energies, grid, side='left')
+    np.savez(index_file, sort_key=sort_key, grid=grid, offsets=offsets,
+             n_rows=len(sorted_energies), chunksize=chunksize)
+
+
+def _read_energy_index(cache_dir):
+    index_file = os.path.join(cache_dir, _ENERGY_INDEX_FILE)
+    if not os.path.exists(index_file):
+        return None
+    with np.load(index_file) as index:
+        energy_index = {key: index[key] for key in index.files}
+    energy_index['sort_key'] = str(energy_index['sort_key'])
+
+    return energy_index
+
+
+def _get_row_range(energy_index, log_energy_min=None, log_energy_max=None):
+    """Returns the smallest row range of an energy-sorted cache that
+    contains all events in (log_energy_min, log_energy_max)
+    """
+    grid, offsets = energy_index['grid'], energy_index['offsets']
+    start, stop = 0, int(energy_index['n_rows'])
+    if log_energy_min is not None:
+        idx = np.searchsorted(grid, log_energy_min, side='right') - 1
+        if idx >= 0:
+            start = int(offsets[idx])
+    if log_energy_max is not None:
+        idx = np.searchsorted(grid, log_energy_max, side='left')
+        if idx < len(grid):
+            stop = int(offsets[idx])
+
+    return start, stop
+
+
+def _load_sorted_cache_rows(cache_dir, energy_index, start, stop,
+                            columns=None):
+    """Reads rows [start, stop) of an energy-sorted Parquet cache
+    """
+    import pyarrow.parquet as pq
+
+    chunksize = int(energy_index['chunksize'])
+    if stop <= start:
+        return None
+    dataframes = []
+    for part in range(start // chunksize, (stop - 1) // chunksize + 1):
+        part_file = os.path.join(cache_dir, 'part.{:05d}.parquet'.format(part))
+        parquet_file = pq.ParquetFile(part_file)
+        part_start = max(start - part * chunksize, 0)
+        part_stop = min(stop - part * chunksize, parquet_file.metadata.num_rows)
+        # Only read the row groups that overlap with [part_start, part_stop)
+        row_groups, group_start, first_group_start = [], 0, None
+        for group in range(parquet_file.metadata.num_row_groups):
+            group_stop = group_start + parquet_file.metadata.row_group(group).num_rows
+            if group_start < part_stop and group_stop > part_start:
+                row_groups.append(group)
+                if first_group_start is None:
+                    first_group_start = group_start
+            group_start = group_stop
+        table = parquet_file.read_row_groups(row_groups, columns=columns,
+                                             use_pandas_metadata=True)
+        df = table.to_pandas()
+        dataframes.append(df.iloc[part_start - first_group_start:
+                                  part_stop - first_group_start])
+
+    return pd.concat(dataframes) if dataframes else None
+
+
+def _load_dataframe_cache(cache_dir, columns=None, energy_cut_key=None,
+                          log_energy_min=None, log_energy_max=None):
+    """Reads a Parquet DataFrame cache, pushing energy cuts down to pyarrow
+    """
+    if columns is not None:
+        columns = list(columns)
+    energy_index = _read_energy_index(cache_dir)
+    read_columns = columns
+    if energy_index is not None and columns is not None:
+        read_columns = columns + [_ROW_COLUMN]
+
+    if energy_index is not None and energy_cut_key == energy_index['sort_key']:
+        # Energy-sorted cache: read the contiguous rows in the energy range
+        start, stop = _get_row_range(energy_index,
+                                     log_energy_min=log_energy_min,
+                                     log_energy_max=log_energy_max)
+        if read_columns is not None and energy_cut_key not in read_columns:
+            read_columns = read_columns + [energy_cut_key]
+        df = _load_sorted_cache_rows(cache_dir, energy_index, start, stop,
+                                     columns=read_columns)
+        if df is None:
+            df = pd.read_parquet(cache_dir, engine='pyarrow',
+                                 columns=read_columns).iloc[:0]
+        energy_mask = _get_energy_mask(df, energy_cut_key=energy_cut_key,
+                                       log_energy_min=log_energy_min,
+                                       log_energy_max=log_energy_max)
+        df = df.loc[energy_mask, :]
+    else:
+        filters = []
+        if energy_cut_key is not None:
+            if log_energy_min is not None:
+                filters.append((energy_cut_key, '>', log_energy_min))
+            if log_energy_max is not None:
+                filters.append((energy_cut_key, '<', log_energy_max))
+        df = pd.read_parquet(cache_dir, engine='pyarrow',
+                             columns=read_columns,
+                             filters=filters if filters else None)
+
+    if energy_index is not None:
+        df = df.sort_values(_ROW_COLUMN).drop(_ROW_COLUMN, axis=1)
+    if columns is not None:
+        df = df.loc[:, columns]
+
+    return df
+
+
+def get_reco_energy_file(df_file):
+    """Returns the path to the reconstructed energy sidecar of a DataFrame file
+
+    Parameters
+    ----------
+    df_file : path
+        Path to processed DataFrame HDF5 file (e.g. sim_dataframe.hdf5).
+
+    Returns
+    -------
+    reco_energy_file : path
+        Path to the HDF5 file storing reconstructed energies for each event
+        in ``df_file`` (e.g. sim_dataframe_reco_energy.hdf5).
+    """
+    return os.path.splitext(df_file)[0] + '_reco_energy.hdf5'
+
+
+def get_model_fingerprint(pipeline_str):
+    """Returns a hash that identifies a saved model
+
+    The hash is computed from the contents of the saved model file, which
+    includes both the trained pipeline and its training features. Any
+    retraining of the model therefore results in a new fingerprint.
+
+    Parameters
+    ----------
+    pipeline_str : str
+        Name of saved model (e.g. 'RF_energy_IC86.2012').
+
+    Returns
+    -------
+    fingerprint : str
+        Hexadecimal SHA-1 digest of the saved model file.
+    """
+    model_file = _get_model_file(pipeline_str)
+    sha1 = hashlib.sha1()
+    with open(model_file, 'rb') as f_obj:
+        for block in iter(lambda: f_obj.read(2**20), b''):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+
+def _predict_in_chunks(pipeline, X, chunksize=100000, n_jobs=1):
+    """Runs pipeline.predict on chunks of X, optionally in parallel threads
+    """
+    if len(X) == 0:
+        return np.empty(0)
+    starts = range(0, len(X), chunksize)
+    if n_jobs > 1:
+        chunks = [delayed(pipeline.predict)(X[start:start + chunksize])
+                  for start in starts]
+        predictions = dask.compute(*chunks, get=threaded.get,
+                                   num_workers=n_jobs)
+    else:
+        predictions = [pipeline.predict(X[start:start + chunksize])
+                       for start in starts]
+
+    return np.concatenate(predictions)
+
+
+def get_reco_log_energy(df, df_file=None, config='IC86.2012', use_cache=True,
+                        n_jobs=1):
+    """Returns reconstructed log energies for each event in a DataFrame
+
+    Reconstructed energies are stored in a sidecar HDF5 file next to
+    ``df_file`` (see ``get_reco_energy_file``) under a key derived from the
+    fingerprint of the energy reconstruction model. Events that already
+    have a stored energy for the current model are not re-predicted.
+    Stored energies are ignored (and replaced the next time energies are
+    stored) when the model is retrained or when ``df_file`` is newer than
+    the sidecar file.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Processed DataFrame (see ``load_sim`` or ``load_data``).
+    df_file : path, optional
+        Path to the DataFrame file ``df`` was loaded from. If None, no
+        sidecar file is used and every event is predicted (default is None).
+    config : str, optional
+        Detector configuration of the energy model (default is 'IC86.2012').
+    use_cache : bool, optional
+        Option to read and update the sidecar file (default is True).
+    n_jobs : int, optional
+        Number of threads to predict energies with (default is 1).
+
+    Returns
+    -------
+    reco_log_energy : numpy.ndarray
+        Reconstructed log10 energies in GeV, aligned with ``df``.
+    """
+    validate_dataframe(df)
+    pipeline_str = 'RF_energy_{}'.format(config)
+    use_cache = use_cache and df_file is not None
+    key = _get_reco_energy_key(pipeline_str)
+
+    reco_log_energy, predicted = _get_reco_log_energy_chunk(
+        df, df_file=df_file, pipeline_str=pipeline_str, key=key,
+        use_cache=use_cache, n_jobs=n_jobs)
+    if use_cache and len(predicted):
+        _store_reco_log_energy(df_file, key, predicted)
+
+    return reco_log_energy.values
+
+
+def _get_reco_energy_key(pipeline_str):
+    """Returns the sidecar file key of the energies predicted by a model
+    """
+    return 'reco_log_energy_{}'.format(get_model_fingerprint(pipeline_str))
+
+
+_reco_energy_models = {}
+_reco_energy_models_lock = threading.Lock()
+
+
+def _load_reco_energy_model(pipeline_str, key):
+    """Loads an energy model, at most once per process and model version
+
+    Models are cached by their sidecar key (see ``_get_reco_energy_key``),
+    so several configs can be loaded concurrently in threads (see
+    ``load_data``) without evicting each other's models.
+    """
+    with _reco_energy_models_lock:
+        if key not in _reco_energy_models:
+            _reco_energy_models[key] = load_trained_model(
+                pipeline_str, return_metadata=True)
+        model_dict = _reco_energy_models[key]
+
+    return model_dict
+
+
+def _get_reco_log_energy_chunk(df, df_file=None, pipeline_str=None, key=None,
+                               use_cache=True, n_jobs=1):
+    """Returns reconstructed energies for a chunk of events
+
+    Stored energies are only read for the events in ``df``, and the model
+    is only loaded if some events don't have a stored energy. Returns the
+    reconstructed energies, aligned with ``df``, and the newly predicted
+    energies that still need to be stored.
+    """
+    stored = None
+    if use_cache:
+        stored = _read_stored_reco_log_energy(df_file, key, index=df.index)
+    model_dict = None
+    if stored is None or len(stored) < len(df):
+        model_dict = _load_reco_energy_model(pipeline_str, key)
+    reco_log_energy, missing_mask = _predict_reco_log_energy(
+        df, model_dict=model_dict, stored=stored, n_jobs=n_jobs)
+
+    return reco_log_energy, reco_log_energy.loc[missing_mask]
+
+
+def _reco_energy_file_is_valid(df_file):
+    """Checks that the sidecar file of df_file exists and isn't older than it
+    """
+    reco_energy_file = get_reco_energy_file(df_file)
+    return (os.path.exists(reco_energy_file) and
+            os.path.getmtime(reco_energy_file) >= os.path.getmtime(df_file))
+
+
+def _read_stored_reco_log_energy(df_file, key, index=None):
+    """Reads the stored reconstructed energies of a DataFrame file
+
+    Returns the energies stored under ``key`` (restricted to ``index``, if
+    given), or None if there are no stored energies for the current model.
+    Sidecar files older than ``df_file`` are ignored, they're replaced the
+    next time energies are stored (see ``_store_reco_log_energy``).
+    """
+    if not _reco_energy_file_is_valid(df_file):
+        return None
+
+    with pd.HDFStore(get_reco_energy_file(df_file), mode='r') as store:
+        if '/' + key not in store.keys():
+            return None
+        if index is None:
+            return store[key]
+        if len(index) == 0:
+            return store.select(key, start=0, stop=0)
+        # Energies are appended in prediction order, not event key order,
+        # so the key range spanned by index is only a read filter. The
+        # rows of index are selected from what's read.
+        bounds = [np.asarray(bound).item()
+                  for bound in [index.min(), index.max()]]
+        stored = store.select(key, where=['index >= {!r}'.format(bounds[0]),
+                                          'index <= {!r}'.format(bounds[1])])
+
+    return stored[stored.index.isin(index)]
+
+
+def _store_reco_log_energy(df_file, key, reco_log_energy):
+    """Stores reconstructed energies in the sidecar file of df_file
+
+    Energies are appended if the sidecar file is valid and only holds
+    energies from the current model. Otherwise a new sidecar file is
+    written and renamed over the old one, so concurrent readers never see
+    a partially written or removed file.
+    """
+    reco_energy_file = get_reco_energy_file(df_file)
+    if _reco_energy_file_is_valid(df_file):
+        with pd.HDFStore(reco_energy_file, mode='r') as store:
+            keys = store.keys()
+        if keys == ['/' + key]:
+            with pd.HDFStore(reco_energy_file, mode='a') as store:
+                store.append(key, reco_log_energy, format='table',
+                             min_itemsize={'index': 30})
+            return
+
+    # Energies predicted with any previous models (or for an older
+    # df_file) are dropped by replacing the whole file
+    tmp_file = '{}.tmp{}'.format(reco_energy_file, os.getpid())
+    with pd.HDFStore(tmp_file, mode='w') as store:
+        store.append(key, reco_log_energy, format='table',
+                     min_itemsize={'index': 30})
+    os.rename(tmp_file, reco_energy_file)
+
+
+def _predict_reco_log_energy(df, model_dict=None, stored=None, n_jobs=1):
+    """Fills in reconstructed energies not already in ``stored``
+
+    Returns the reconstructed energies, aligned with ``df``, and a mask of
+    the events that had to be predicted with the model in ``model_dict``.
+    """
+    reco_log_energy = pd.Series(np.nan, index=df.index)
+    if stored is not None:
+        stored = stored[stored.index.isin(df.index)]
+        reco_log_energy.loc[stored.index] = stored.values
+
+    missing_mask = reco_log_energy.isnull().values
+    if missing_mask.any():
+        feature_list = list(model_dict['training_features'])
+        X = df.loc[missing_mask, feature_list].values
+        predictions = _predict_in_chunks(model_dict['pipeline'], X,
+                                         n_jobs=n_jobs)
+        reco_log_energy.loc[missing_mask] = predictions
+
+    return reco_log_energy, missing_mask
+
+
+def _filter_partition(df, schema=None, columns=None, derived_columns=None,
+                      energy_cut_key=None, log_energy_min=None,
+                      log_energy_max=None, df_file=None, pipeline_str=None,
+                      key=None, use_cache=True):
+    """Expands, reconstructs energies for, and energy cuts one partition
+
+    Energies are only reconstructed (with the model ``pipeline_str``) if
+    ``pipeline_str`` is given. Returns the partition and the newly
+    predicted energies that still need to be stored (or None).
+    """
+    df = expand_dataframe(df, schema)
+    if derived_columns:
+        df = add_derived_columns(df, derived_columns)
+    reco_cut = energy_cut_key in ['reco_log_energy', 'reco_energy']
+    # Cuts on stored columns are applied before reconstructing energies,
+    # so only the events passing them are predicted
+    if energy_cut_key is not None and not reco_cut:
+        energy_mask = _get_energy_mask(df, energy_cut_key=energy_cut_key,
+                                       log_energy_min=log_energy_min,
+                                       log_energy_max=log_energy_max)
+        df = df.loc[energy_mask, :].copy()
+    predicted = None
+    if pipeline_str is not None:
+        reco_log_energy, predicted = _get_reco_log_energy_chunk(
+            df, df_file=df_file, pipeline_str=pipeline_str, key=key,
+            use_cache=use_cache)
+        df['reco_log_energy'] = reco_log_energy.values
+        df['reco_energy'] = 10**df['reco_log_energy']
+    if energy_cut_key is not None and reco_cut:
+        energy_mask = _get_energy_mask(df, energy_cut_key=energy_cut_key,
+                                       log_energy_min=log_energy_min,
+                                       log_energy_max=log_energy_max)
+        df = df.loc[energy_mask, :]
+    if columns is not None:
+        output_columns = list(columns)
+        if pipeline_str is not None:
+            output_columns += ['reco_log_energy', 'reco_energy']
+        df = df.loc[:, output_columns]
+
+    return df, predicted
+
+
+def _load_basic_dataframe(df_file=None, datatype='sim', config='IC86.2012',
+                          energy_reco=True, energy_cut_key='reco_log_energy',
+                          log_energy_min=None, log_energy_max=None,
+                          columns=None, use_cache=True, n_jobs=1,
+                          verbose=False):
+
+    validate_datatype(datatype)
+    df_file = _get_dataframe_file(df_file=df_file, datatype=datatype,
+                                  config=config)
+
+    cache_dir = get_dataframe_cache_dir(df_file)
+    if not (use_cache and _dataframe_cache_is_valid(df_file, cache_dir)):
+        return _load_hdf_dataframe(df_file, config=config,
+                                   energy_reco=energy_reco,
+                                   energy_cut_key=energy_cut_key,
+                                   log_energy_min=log_energy_min,
+                                   log_energy_max=log_energy_max,
+                                   columns=columns, use_cache=use_cache,
+                                   n_jobs=n_jobs, verbose=verbose)
+
+    pipeline_str = 'RF_energy_{}'.format(config)
+    extra_columns = []
+    if energy_reco:
+        key = _get_reco_energy_key(pipeline_str)
+        extra_columns = _load_reco_energy_model(pipeline_str,
+                                                key)['training_features']
+    read_columns, derived_columns = _resolve_load_columns(
+        df_file, columns, energy_cut_key=energy_cut_key,
+        extra_columns=extra_columns)
+    # Energy cuts on stored columns can be applied while reading.
+    # Reconstructed energies don't exist until after loading.
+    stored_cut_key = energy_cut_key
+    if read_columns is not None and energy_cut_key not in read_columns:
+        stored_cut_key = None
+    elif energy_cut_key in ['reco_log_energy', 'reco_energy']:
+        stored_cut_key = None
+    df = _load_dataframe_cache(cache_dir, columns=read_columns,
+                               energy_cut_key=stored_cut_key,
+                               log_energy_min=log_energy_min,
+                               log_energy_max=log_energy_max)
+    df = add_derived_columns(df, derived_columns)
+
+    if energy_reco:
+        df['reco_log_energy'] = get_reco_log_energy(df, df_file=df_file,
+                                                    config=config,
+                                                    use_cache=use_cache,
+                                                    n_jobs=n_jobs)
+        df['reco_energy'] = 10**df['reco_log_energy']
+
+    energy_mask = _get_energy_mask(df, energy_cut_key=energy_cut_key,
+                                   log_energy_min=log_energy_min,
+                                   log_energy_max=log_energy_max)
+    df = df.loc[energy_mask, :]
+    if columns is not None:
+        output_columns = list(columns)
+        if energy_reco:
+            output_columns += ['reco_log_energy', 'reco_energy']
+        df = df.loc[:, output_columns]
+
+    return df
+
+
+def _load_hdf_dataframe(df_file, config='IC86.2012', energy_reco=True,
+                        energy_cut_key='reco_log_energy', log_energy_min=None,
+                        log_energy_max=None, columns=None, use_cache=True,
+                        n_jobs=1, verbose=False):
+    """Loads a DataFrame HDF5 file, applying energy cuts to each partition
+
+    Energy cuts (and, if needed for the cut, energy reconstruction) are
+    applied inside the dask graph, so only events passing the cuts are
+    ever gathered into the returned DataFrame.
+    """
+    schema = read_schema(df_file)
+    pipeline_str = 'RF_energy_{}'.format(config)
+
+    # Only the model name and fingerprint are passed to each partition,
+    # the model itself is loaded once per worker process
+    key, extra_columns = None, []
+    if energy_reco:
+        key = _get_reco_energy_key(pipeline_str)
+        model_dict = _load_reco_energy_model(pipeline_str, key)
+        extra_columns = model_dict['training_features']
+
+    # Read any extra columns needed for energy reconstruction and cuts
+    stored_columns, derived_columns = _resolve_load_columns(
+        df_file, columns, energy_cut_key=energy_cut_key,
+        extra_columns=extra_columns)
+    read_columns = None
+    if stored_columns is not None:
+        read_columns = stored_columns + derived_columns
+
     chunksize = 1000000
-    df = dd.read_hdf(df_file, 'dataframe', mode='r', columns=columns,
-                     chunksize=chunksize)
+    ddf = dd.read_hdf(df_file, 'dataframe', mode='r',
+                      columns=get_stored_columns(stored_columns, schema),
+                      chunksize=chunksize)
+    if log_energy_min is None and log_energy_max is None:
+        energy_cut_key = None
+    partitions = [delayed(_filter_partition)(
+                      partition, schema=schema, columns=read_columns,
+                      derived_columns=derived_columns,
+                      energy_cut_key=energy_cut_key,
+                      log_energy_min=log_energy_min,
+                      log_energy_max=log_energy_max, df_file=df_file,
+                      pipeline_str=pipeline_str if energy_reco else None,
+                      key=key, use_cache=use_cache)
+                  for partition in ddf.to_delayed()]
     get = multiprocessing.get if n_jobs > 1 else dask.get
     if verbose:
         with ProgressBar():
-            df = df.compute(get=get, num_workers=n_jobs)
+            results = dask.compute(*partitions, get=get, num_workers=n_jobs)
     else:
-        df = df.compute(get=get, num_workers=n_jobs)
+        results = dask.compute(*partitions, get=get, num_workers=n_jobs)
+    df = pd.concat([df_partition for df_partition, _ in results])
+
+    if energy_reco and use_cache:
+        # Every newly predicted energy is stored, including those of
+        # events that didn't pass a reconstructed energy cut
+        predicted = [p for _, p in results if len(p)]
+        if predicted:
+            _store_reco_log_energy(df_file, key, pd.concat(predicted))
+    if columns is not None:
+        output_columns = list(columns)
+        if energy_reco:
+            output_columns += ['reco_log_energy', 'reco_energy']
+        df = df.loc[:, output_columns]
+
+    return df
+
+
+def _iter_basic_dataframe(df_file=None, datatype='sim', config='IC86.2012',
+                          columns=None, chunksize=100000, energy_reco=True,
+                          energy_cut_key='reco_log_energy',
+                          log_energy_min=None, log_energy_max=None,
+                          quality_cuts=False, convenience_variables=False,
+                          use_cache=True, n_jobs=1):
+
+    validate_datatype(datatype)
+    df_file = _get_dataframe_file(df_file=df_file, datatype=datatype,
+                                  config=config)
 
+    # The energy model and its sidecar key are only looked up once
+    pipeline_str = 'RF_energy_{}'.format(config)
+    extra_columns = []
     if energy_reco:
-        model_dict = load_trained_model('RF_energy_{}'.format(config),
-                                        return_metadata=True)
-        pipeline = model_dict['pipeline']
-        feature_list = list(model_dict['training_features'])
-        df['reco_log_energy'] = pipeline.predict(df[feature_list].values)
-        df['reco_energy'] = 10**df['reco_log_energy']
+        key = _get_reco_energy_key(pipeline_str)
+        model_dict = _load_reco_energy_model(pipeline_str, key)
+        extra_columns += list(model_dict['training_features'])
+    if quality_cuts:
+        extra_columns += get_cut_columns(get_quality_cuts())
+    read_columns, derived_columns = _resolve_load_columns(
+        df_file, columns, energy_cut_key=energy_cut_key,
+        extra_columns=extra_columns)
+    # Columns only needed to compute derived columns, energies, or cuts
+    extra_columns = []
+    if columns is not None:
+        extra_columns = [c for c in read_columns + derived_columns
+                         if c not in columns]
+
+    stored_cut_key = energy_cut_key
+    if read_columns is not None and energy_cut_key not in read_columns:
+        stored_cut_key = None
+    elif energy_cut_key in ['reco_log_energy', 'reco_energy']:
+        stored_cut_key = None
+    cache_dir = get_dataframe_cache_dir(df_file)
+    if use_cache and _dataframe_cache_is_valid(df_file, cache_dir):
+        part_files = sorted(os.path.join(cache_dir, f)
+                            for f in os.listdir(cache_dir)
+                            if f.endswith('.parquet'))
+        parts = (_load_dataframe_cache(part_file, columns=read_columns,
+                                       energy_cut_key=stored_cut_key,
+                                       log_energy_min=log_energy_min,
+                                       log_energy_max=log_energy_max)
+                 for part_file in part_files)
+        # Events in energy-sorted caches are yielded in energy order
+        parts = (df.drop(_ROW_COLUMN, axis=1) if _ROW_COLUMN in df else df
+                 for df in parts)
+        chunks = (df.iloc[start:start + chunksize].copy()
+                  for df in parts for start in range(0, len(df), chunksize))
+    else:
+        chunks = _iter_hdf_chunks(df_file, columns=read_columns,
+                                  chunksize=chunksize)
+
+    for df in chunks:
+        df = add_derived_columns(df, derived_columns)
+        if energy_reco:
+            reco_log_energy, predicted = _get_reco_log_energy_chunk(
+                df, df_file=df_file, pipeline_str=pipeline_str, key=key,
+                use_cache=use_cache, n_jobs=n_jobs)
+            df['reco_log_energy'] = reco_log_energy.values
+            df['reco_energy'] = 10**df['reco_log_energy']
+            if use_cache and len(predicted):
+                _store_reco_log_energy(df_file, key, predicted)
+        if quality_cuts:
+            df = apply_quality_cuts(df, datatype=datatype, verbose=False)
+        if convenience_variables:
+            df = add_convenience_variables(df, datatype=datatype)
+        energy_mask = _get_energy_mask(df, energy_cut_key=energy_cut_key,
+                                       log_energy_min=log_energy_min,
+                                       log_energy_max=log_energy_max)
+        df = df.loc[energy_mask, :]
+        if columns is not None:
+            output_columns = list(columns) + [c for c in df.columns
+                                              if c not in columns and
+                                              c not in extra_columns]
+            df = df.loc[:, output_columns]
+        if len(df):
+            yield df
+
+
+def _iter_hdf_chunks(df_file, columns=None, chunksize=100000):
+    # Compact DataFrames (see comptools.dataframe_schema) are expanded
+    # back to their original dtypes chunk by chunk
+    schema = read_schema(df_file)
+    with pd.HDFStore(df_file, mode='r') as store:
+        for df in store.select('dataframe',
+                               columns=get_stored_columns(columns, schema),
+                               chunksize=chunksize):
+            yield expand_dataframe(df, schema, columns=columns)
+
+
+def iter_sim(config='IC86.2012', columns=None, chunksize=100000,
+             df_file=None, energy_reco=True, energy_cut_key='reco_log_energy',
+             log_energy_min=6.0, log_energy_max=8.0, quality_cuts=False,
+             convenience_variables=False, use_cache=True, n_jobs=1):
+    '''Generates chunks of the processed simulation DataFrame
+
+    Unlike ``load_sim``, only ``chunksize`` rows are held in memory at a
+    time and no training/testing split is made.
 
-    energy_mask = np.ones(df.shape[0], dtype=bool)
-    if log_energy_min is not None:
-        energy_mask = energy_mask & (df[energy_cut_key] > log_energy_min)
-    if log_energy_max is not None:
-        energy_mask = energy_mask & (df[energy_cut_key] < log_energy_max)
+    Parameters
+    ----------
+    config : str, optional
+        Detector configuration (default is 'IC86.2012').
+    columns : array_like, optional
+        Option to specify the columns that should be in the yielded
+        DataFrames (default is None, all columns are returned).
+    chunksize : int, optional
+        Maximum number of rows to read at a time (default is 100000).
+    df_file : path, optional
+        If specified, the given path to a pandas.DataFrame will be loaded
+        (default is None, so the file path will be determined from the
+        datatype and config).
+    energy_reco : bool, optional
+        Option to perform energy reconstruction for each event
+        (default is True).
+    energy_cut_key : str, optional
+        Energy key to apply energy range cuts to (default is 'reco_log_energy').
+    log_energy_min : int, float, optional
+        Option to set a lower limit on the reconstructed log energy in GeV
+        (default is 6.0).
+    log_energy_max : int, float, optional
+        Option to set a upper limit on the reconstructed log energy in GeV
+        (default is 8.0).
+    quality_cuts : bool, optional
+        Option to apply ``apply_quality_cuts`` to each chunk
+        (default is False).
+    convenience_variables : bool, optional
+        Option to apply ``add_convenience_variables`` to each chunk
+        (default is False).
+    use_cache : bool, optional
+        Option to read from the Parquet cache and reconstructed energy
+        sidecar files, if available (default is True).
+    n_jobs : int, optional
+        Number of threads to reconstruct energies with (default is 1).
+
+    Yields
+    ------
+    df : pandas.DataFrame
+        Non-empty chunk of processed simulation events passing all cuts.
+
+    '''
+    if config not in get_sim_configs():
+        raise ValueError('config must be in {}'.format(get_sim_configs()))
 
-    return df.loc[energy_mask, :]
+    return _iter_basic_dataframe(df_file=df_file, datatype='sim',
+                                 config=config, columns=columns,
+                                 chunksize=chunksize, energy_reco=energy_reco,
+                                 energy_cut_key=energy_cut_key,
+                                 log_energy_min=log_energy_min,
+                                 log_energy_max=log_energy_max,
+                                 quality_cuts=quality_cuts,
+                                 convenience_variables=convenience_variables,
+                                 use_cache=use_cache, n_jobs=n_jobs)
+
+
+def iter_data(config='IC86.2012', columns=None, chunksize=100000,
+              df_file=None, energy_reco=True, energy_cut_key='reco_log_energy',
+              log_energy_min=6.0, log_energy_max=8.0, quality_cuts=False,
+              convenience_variables=False, use_cache=True, n_jobs=1):
+    '''Generates chunks of the processed data DataFrame
+
+    Unlike ``load_data``, only ``chunksize`` rows are held in memory at a
+    time. This is useful for histogramming large data samples.
+
+    Parameters
+    ----------
+    config : str, optional
+        Detector configuration (default is 'IC86.2012').
+    columns : array_like, optional
+        Option to specify the columns that should be in the yielded
+        DataFrames (default is None, all columns are returned).
+    chunksize : int, optional
+        Maximum number of rows to read at a time (default is 100000).
+    df_file : path, optional
+        If specified, the given path to a pandas.DataFrame will be loaded
+        (default is None, so the file path will be determined from the
+        datatype and config).
+    energy_reco : bool, optional
+        Option to perform energy reconstruction for each event
+        (default is True).
+    energy_cut_key : str, optional
+        Energy key to apply energy range cuts to (default is 'reco_log_energy').
+    log_energy_min : int, float, optional
+        Option to set a lower limit on the reconstructed log energy in GeV
+        (default is 6.0).
+    log_energy_max : int, float, optional
+        Option to set a upper limit on the reconstructed log energy in GeV
+        (default is 8.0).
+    quality_cuts : bool, optional
+        Option to apply ``apply_quality_cuts`` to each chunk
+        (default is False).
+    convenience_variables : bool, optional
+        Option to apply ``add_convenience_variables`` to each chunk
+        (default is False).
+    use_cache : bool, optional
+        Option to read from the Parquet cache and reconstructed energy
+        sidecar files, if available (default is True).
+    n_jobs : int, optional
+        Number of threads to reconstruct energies with (default is 1).
+
+    Yields
+    ------
+    df : pandas.DataFrame
+        Non-empty chunk of processed data events passing all cuts.
+
+    Examples
+    --------
+    Histogram reconstructed energies with bounded memory:
+
+    >>> import numpy as np
+    >>> import comptools as comp
+    >>> bins = comp.get_energybins().log_energy_bins
+    >>> counts = np.zeros(len(bins) - 1)
+    >>> for df in comp.io.iter_data(config='IC86.2013',
+    ...                             columns=['log_s125', 'log_dEdX',
+    ...                                      'lap_cos_zenith']):
+    ...     counts += np.histogram(df['reco_log_energy'], bins=bins)[0]
+
+    '''
+    if config not in get_data_configs():
+        raise ValueError('config must be in {}'.format(get_data_configs()))
+
+    return _iter_basic_dataframe(df_file=df_file, datatype='data',
+                                 config=config, columns=columns,
+                                 chunksize=chunksize, energy_reco=energy_reco,
+                                 energy_cut_key=energy_cut_key,
+                                 log_energy_min=log_energy_min,
+                                 log_energy_max=log_energy_max,
+                                 quality_cuts=quality_cuts,
+                                 convenience_variables=convenience_variables,
+                                 use_cache=use_cache, n_jobs=n_jobs)
+
+
+def iter_energy_bins(log_energy_bins, config='IC86.2012', datatype='sim',
+                     energy_key='lap_log_energy', columns=None, df_file=None):
+    """Generates the events in each bin of a stored log energy column
+
+    If the DataFrame has a Parquet cache sorted by ``energy_key`` (see
+    ``save_dataframe_cache``), each bin is read as a contiguous slice of
+    rows. Otherwise the DataFrame is loaded once and masked for each bin.
+
+    Parameters
+    ----------
+    log_energy_bins : array_like
+        Log energy bin edges.
+    config : str, optional
+        Detector configuration (default is 'IC86.2012').
+    datatype : {'sim', 'data'}
+        Whether to load simulation or data events (default is 'sim').
+    energy_key : str, optional
+        Stored log energy column to bin events in (default is
+        'lap_log_energy').
+    columns : array_like, optional
+        Option to specify the columns that should be in the yielded
+        DataFrames (default is None, all columns are returned).
+    df_file : path, optional
+        If specified, the given path to a pandas.DataFrame will be loaded
+        (default is None, so the file path will be determined from the
+        datatype and config).
+
+    Yields
+    ------
+    bin_idx : int
+        Energy bin index.
+    df : pandas.DataFrame
+        Events with ``energy_key`` strictly inside the energy bin.
+
+    """
+    validate_datatype(datatype)
+    df_file = _get_dataframe_file(df_file=df_file, datatype=datatype,
+                                  config=config)
+    log_energy_bins = np.asarray(log_energy_bins)
+    cache_dir = get_dataframe_cache_dir(df_file)
+    energy_index = None
+    if _dataframe_cache_is_valid(df_file, cache_dir):
+        energy_index = _read_energy_index(cache_dir)
+
+    if energy_index is not None and energy_index['sort_key'] == energy_key:
+        for bin_idx, (low, high) in enumerate(zip(log_energy_bins[:-1],
+                                                  log_energy_bins[1:])):
+            df = _load_dataframe_cache(cache_dir, columns=columns,
+                                       energy_cut_key=energy_key,
+                                       log_energy_min=low,
+                                       log_energy_max=high)
+            yield bin_idx, df
+    else:
+        load_columns = columns
+        if columns is not None and energy_key not in columns:
+            load_columns = list(columns) + [energy_key]
+        df = _load_basic_dataframe(df_file=df_file, datatype=datatype,
+                                   config=config, energy_reco=False,
+                                   energy_cut_key=None, columns=load_columns)
+        for bin_idx, (low, high) in enumerate(zip(log_energy_bins[:-1],
+                                                  log_energy_bins[1:])):
+            energy_mask = _get_energy_mask(df, energy_cut_key=energy_key,
+                                           log_energy_min=low,
+                                           log_energy_max=high)
+            df_bin = df.loc[energy_mask, :]
+            if columns is not None:
+                df_bin = df_bin.loc[:, list(columns)]
+            yield bin_idx, df_bin
 
 
 def load_sim(df_file=None, config='IC86.2012', test_size=0.3,
              energy_reco=True, energy_cut_key='reco_log_energy',
-             log_energy_min=6.0, log_energy_max=8.0, columns=None, n_jobs=1,
+             log_energy_min=6.0, log_energy_max=8.0, columns=None,
+             use_cache=True, n_jobs=1, random_state=2, return_index=False,
              verbose=False):
     '''Function to load processed simulation DataFrame
 
@@ -226,8 +1196,8 @@ def load_sim(df_file=None, config='IC86.2012', test_size=0.3,
         Detector configuration (default is 'IC86.2012').
     test_size : int, float, optional
         Fraction or number of events to be split off into a seperate testing
-        set (default is 0.3). test_size will be passed to
-        sklearn.model_selection.ShuffleSplit.
+        set (default is 0.3). The split is persisted next to the DataFrame
+        file (see ``get_train_test_split``).
     energy_reco : bool, optional
         Option to perform energy reconstruction for each event
         (default is True).
@@ -241,17 +1211,33 @@ def load_sim(df_file=None, config='IC86.2012', test_size=0.3,
         (default is 8.0).
     columns : array_like, optional
         Option to specify the columns that should be in the returned
-        DataFrame(s) (default is None, all columns are returned).
+        DataFrame(s). Registered derived columns (see
+        ``comptools.derived_columns``) that aren't stored are computed
+        from their stored dependencies (default is None, all columns are
+        returned).
+    use_cache : bool, optional
+        Option to load from the Parquet cache of the DataFrame file, if one
+        has been built with ``save_dataframe_cache`` and is up to date, and
+        to reuse stored reconstructed energies (see ``get_reco_log_energy``)
+        (default is True).
     n_jobs : int, optional
         Number of chunks to load in parallel (default is 1).
+    random_state : int, optional
+        Random seed for the training/testing split (default is 2).
+    return_index : bool, optional
+        Option to return the full DataFrame along with the row positions of
+        the training and testing events, instead of copying them into
+        separate DataFrames (default is False).
     verbose : bool, optional
         Option for verbose progress bar output (default is True).
 
     Returns
     -------
-    pandas.DataFrame, tuple of pandas.DataFrame
-        Return a single DataFrame if test_size is 0, otherwise return
-        a 2-tuple of training and testing DataFrame.
+    pandas.DataFrame, tuple
+        Return a single DataFrame if test_size is 0. Otherwise return a
+        2-tuple of training and testing DataFrames, or if ``return_index``
+        is True, a 3-tuple of the DataFrame and the training and testing
+        row positions.
 
     '''
 
@@ -264,34 +1250,149 @@ def load_sim(df_file=None, config='IC86.2012', test_size=0.3,
                                energy_reco=energy_reco,
                                energy_cut_key=energy_cut_key, columns=columns,
                                log_energy_min=log_energy_min,
-                               log_energy_max=log_energy_max, n_jobs=n_jobs,
+                               log_energy_max=log_energy_max,
+                               use_cache=use_cache, n_jobs=n_jobs,
                                verbose=verbose)
 
     # If specified, split into training and testing DataFrames
     if test_size > 0:
-        splitter = ShuffleSplit(n_splits=1, test_size=test_size,
-                                random_state=2)
-        train_mask, test_mask = next(splitter.split(df.values))
-        output = df.iloc[train_mask], df.iloc[test_mask]
+        df_file = _get_dataframe_file(df_file=df_file, datatype='sim',
+                                      config=config)
+        train_index, test_index = get_train_test_split(
+            df.index, test_size=test_size, random_state=random_state,
+            df_file=df_file)
+        if return_index:
+            output = df, train_index, test_index
+        else:
+            output = df.iloc[train_index], df.iloc[test_index]
     else:
         output = df
 
     return output
 
 
+def _get_index_fingerprint(index):
+    """Returns a short hash of the events in a DataFrame index
+    """
+    hashes = pd.util.hash_pandas_object(pd.Index(index), index=False)
+    return hashlib.sha1(hashes.values.tobytes()).hexdigest()[:16]
+
+
+def get_train_test_split_file(df_file, index, test_size=0.3,
+                              random_state=2):
+    """Returns the path to the persisted train/test split of a set of events
+
+    Parameters
+    ----------
+    df_file : path
+        Path to processed DataFrame HDF5 file the events were loaded from.
+    index : pandas.Index
+        Index of the loaded events (i.e. after any energy cuts).
+    test_size : int, float, optional
+        Fraction or number of events in the testing set (default is 0.3).
+    random_state : int, optional
+        Random seed of the split (default is 2).
+
+    Returns
+    -------
+    split_file : path
+        Path to split mask file.
+    """
+    split_dir = os.path.splitext(df_file)[0] + '_splits'
+    basename = 'test_size-{}_seed-{}_{}.npz'.format(
+        test_size, random_state, _get_index_fingerprint(index))
+
+    return os.path.join(split_dir, basename)
+
+
+def get_train_test_split(index, test_size=0.3, random_state=2, df_file=None):
+    """Splits events into training and testing sets
+
+    The split is drawn from the number of events alone (i.e. no DataFrame
+    columns are copied) and is the same as the one made by
+    ``sklearn.model_selection.ShuffleSplit``. If ``df_file`` is given, the
+    testing set mask is saved to (or, if it already exists, read from) the
+    file given by ``get_train_test_split_file`` so that every analysis
+    script uses an identical split.
+
+    Parameters
+    ----------
+    index : pandas.Index
+        Index of the events to split.
+    test_size : int, float, optional
+        Fraction or number of events in the testing set (default is 0.3).
+    random_state : int, optional
+        Random seed of the split (default is 2).
+    df_file : path, optional
+        Processed DataFrame HDF5 file the events were loaded from
+        (default is None, the split isn't persisted).
+
+    Returns
+    -------
+    train_index : numpy.ndarray
+        Sorted row positions of the training events.
+    test_index : numpy.ndarray
+        Sorted row positions of the testing events.
+    """
+    n_rows = len(index)
+    split_file = None
+    if df_file is not None:
+        split_file = get_train_test_split_file(df_file, index,
+                                               test_size=test_size,
+                                               random_state=random_state)
+
+    test_mask = None
+    if split_file is not None and os.path.exists(split_file):
+        with np.load(split_file) as split:
+            if int(split['n_rows']) == n_rows:
+                test_mask = np.unpackbits(split['test_mask'])[:n_rows]
+                test_mask = test_mask.astype(bool)
+
+    if test_mask is None:
+        splitter = ShuffleSplit(n_splits=1, test_size=test_size,
+                                random_state=random_state)
+        _, test_index = next(splitter.split(np.empty((n_rows, 0))))
+        test_mask = np.zeros(n_rows, dtype=bool)
+        test_mask[test_index] = True
+        if split_file is not None:
+            _save_split_mask(split_file, test_mask)
+
+    return np.flatnonzero(~test_mask), np.flatnonzero(test_mask)
+
+
+def _save_split_mask(split_file, test_mask):
+    # The data directory may be read-only for some users, in which case
+    # the split is regenerated on every load
+    try:
+        split_dir = os.path.dirname(split_file)
+        if not os.path.isdir(split_dir):
+            os.makedirs(split_dir)
+        tmp_file = split_file + '.tmp.npz'
+        np.savez(tmp_file, test_mask=np.packbits(test_mask),
+                 n_rows=len(test_mask))
+        os.rename(tmp_file, split_file)
+    except (IOError, OSError):
+        pass
+
+
 def load_data(df_file=None, config='IC86.2012', energy_reco=True,
               energy_cut_key='reco_log_energy', log_energy_min=6.0,
-              log_energy_max=8.0, columns=None, n_jobs=1, verbose=False):
+              log_energy_max=8.0, columns=None, use_cache=True, n_jobs=1,
+              return_dict=False, verbose=False):
     '''Function to load processed data DataFrame
 
     Parameters
     ----------
-    df_file : path, optional
+    df_file : path or list of paths, optional
         If specified, the given path to a pandas.DataFrame will be loaded
         (default is None, so the file path will be determined from the
-        datatype and config).
-    config : str, optional
-        Detector configuration (default is 'IC86.2012').
+        datatype and config). If ``config`` is a list, ``df_file`` must be
+        None or a list with one path per config.
+    config : str or list of str, optional
+        Detector configuration (default is 'IC86.2012'). If a list of
+        configurations is given, they are loaded concurrently in threads
+        of the current process and a ``'config'`` categorical column is
+        added to each DataFrame.
     energy_reco : bool, optional
         Option to perform energy reconstruction for each event
         (default is True).
@@ -305,18 +1406,49 @@ def load_data(df_file=None, config='IC86.2012', energy_reco=True,
         (default is 8.0).
     columns : array_like, optional
         Option to specify the columns that should be in the returned
-        DataFrame(s) (default is None, all columns are returned).
+        DataFrame(s). Registered derived columns (see
+        ``comptools.derived_columns``) that aren't stored are computed
+        from their stored dependencies (default is None, all columns are
+        returned).
+    use_cache : bool, optional
+        Option to load from the Parquet cache of the DataFrame file, if one
+        has been built with ``save_dataframe_cache`` and is up to date, and
+        to reuse stored reconstructed energies (see ``get_reco_log_energy``)
+        (default is True).
     n_jobs : int, optional
         Number of chunks to load in parallel (default is 1).
+    return_dict : bool, optional
+        If ``config`` is a list, option to return a dictionary of
+        per-config DataFrames instead of a single concatenated DataFrame
+        (default is False).
     verbose : bool, optional
         Option for verbose progress bar output (default is True).
 
     Returns
     -------
-    pandas.DataFrame
-        Return a DataFrame with processed data
+    pandas.DataFrame or collections.OrderedDict
+        Return a DataFrame with processed data. If ``config`` is a list
+        and ``return_dict`` is True, an OrderedDict with a DataFrame for
+        each config is returned instead.
+
+    Examples
+    --------
+    Load several years of data at once:
+
+    >>> import comptools as comp
+    >>> df_data = comp.load_data(config=['IC86.2012', 'IC86.2013'],
+    ...                          columns=['log_s125', 'log_dEdX'])
+    >>> df_data['config'].value_counts()  # doctest: +SKIP
 
     '''
+    if isinstance(config, (list, tuple)):
+        return _load_data_configs(df_files=df_file, configs=config,
+                                  energy_reco=energy_reco,
+                                  energy_cut_key=energy_cut_key,
+                                  log_energy_min=log_energy_min,
+                                  log_energy_max=log_energy_max,
+                                  columns=columns, use_cache=use_cache,
+                                  n_jobs=n_jobs, return_dict=return_dict)
 
     if config not in get_data_configs():
         raise ValueError('config must be in {}'.format(get_data_configs()))
@@ -325,12 +1457,117 @@ def load_data(df_file=None, config='IC86.2012', energy_reco=True,
                                energy_reco=energy_reco,
                                energy_cut_key=energy_cut_key, columns=columns,
                                log_energy_min=log_energy_min,
-                               log_energy_max=log_energy_max, n_jobs=n_jobs,
+                               log_energy_max=log_energy_max,
+                               use_cache=use_cache, n_jobs=n_jobs,
                                verbose=verbose)
 
     return df
 
 
+def _load_data_configs(df_files=None, configs=None, return_dict=False,
+                       **load_kwargs):
+    """Loads several data configs concurrently in threads
+
+    Threads share memory with the calling process, so the loaded
+    DataFrames don't have to be pickled back from worker processes.
+    """
+    configs = list(configs)
+    if len(configs) == 0:
+        raise ValueError('At least one config must be given')
+    if len(set(configs)) != len(configs):
+        raise ValueError('Duplicate configs given: {}'.format(configs))
+    for config in configs:
+        if config not in get_data_configs():
+            raise ValueError('config must be in {}'.format(get_data_configs()))
+    if df_files is None:
+        df_files = [None] * len(configs)
+    elif len(df_files) != len(configs):
+        raise ValueError('df_file must be a list with one file per config')
+
+    loads = [delayed(_load_basic_dataframe)(df_file=df_file, datatype='data',
+                                            config=config, **load_kwargs)
+             for df_file, config in zip(df_files, configs)]
+    dataframes = dask.compute(*loads, get=threaded.get,
+                              num_workers=len(configs))
+
+    for code, df in enumerate(dataframes):
+        codes = np.full(len(df), code, dtype=np.int8)
+        df['config'] = pd.Categorical.from_codes(codes, categories=configs)
+
+    if return_dict:
+        return OrderedDict(zip(configs, dataframes))
+    else:
+        return pd.concat(dataframes)
+
+
+def load_selected_events(config='IC86.2012', datatype='sim', cuts=None,
+                         columns=None, df_file=None, **selection):
+    """Loads only the events passing cuts and categorical selections
+
+    Events are selected with the packed cut bitmaps and categorical
+    bitmap indexes stored by processing/save_dataframe.py (see
+    ``comptools.bitmap_index``), so only the matching rows are read.
+
+    Parameters
+    ----------
+    config : str, optional
+        Detector configuration (default is 'IC86.2012').
+    datatype : {'sim', 'data'}
+        Whether to load simulation or data events (default is 'sim').
+    cuts : list, optional
+        Names of the quality cuts (see ``get_quality_cuts``) events must
+        pass (default is None).
+    columns : array_like, optional
+        Option to specify the columns that should be in the returned
+        DataFrame (default is None, all columns are returned).
+    df_file : path, optional
+        If specified, the given path to a pandas.DataFrame will be loaded
+        (default is None, so the file path will be determined from the
+        datatype and config).
+    **selection
+        Categorical column values to select, e.g.
+        ``MC_comp='Fe56Nucleus'`` or ``comp_group_2=['light']``.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Selected events.
+
+    Examples
+    --------
+    Load iron events passing the standard cuts except ``max_qfrac_1_60``:
+
+    >>> import comptools as comp
+    >>> cuts = [cut for cut in comp.io.get_quality_cut_flow(dataprocessing=True)
+    ...         if cut != 'max_qfrac_1_60']
+    >>> df = comp.io.load_selected_events(cuts=cuts, MC_comp='Fe56Nucleus')
+
+    """
+    validate_datatype(datatype)
+    df_file = _get_dataframe_file(df_file=df_file, datatype=datatype,
+                                  config=config)
+    bitmap_index, n_rows = read_bitmap_index(df_file)
+    if bitmap_index is None:
+        raise IOError('The DataFrame file {} has no bitmap index. Rerun '
+                      'processing/save_dataframe.py to build one.'.format(
+                          df_file))
+    rows = select_rows(bitmap_index, n_rows, cuts=cuts, **selection)
+
+    schema = read_schema(df_file)
+    with pd.HDFStore(df_file, mode='r') as store:
+        if store.get_storer('dataframe').nrows != n_rows:
+            raise IOError('The bitmap index of {} is out of date'.format(
+                          df_file))
+        stored_columns = get_stored_columns(columns, schema)
+        if len(rows):
+            df = store.select('dataframe', where=rows, columns=stored_columns)
+        else:
+            df = store.select('dataframe', start=0, stop=0,
+                              columns=stored_columns)
+
+    return expand_dataframe(df, schema, columns=columns)
+
+
 def load_tank_charges(config='IC79.2010', datatype='sim', return_dask=False):
     paths = get_paths()
     file_pattern = os.path.join(paths.comp_data_dir,
@@ -345,6 +1582,86 @@ def load_tank_charges(config='IC79.2010', datatype='sim', return_dask=False):
         return tank_charges.compute()
 
 
+def get_stratified_sample(df, max_per_stratum=1000, energy_bins=None,
+                          energy_key='MC_log_energy', comp_key='comp_group_2',
+                          random_state=2):
+    """Draws a stratified subsample of events
+
+    Events are grouped into strata by energy bin and composition, and at
+    most ``max_per_stratum`` events are drawn from each stratum without
+    replacement. Sparsely populated strata are kept in full, so the
+    subsample is much more balanced than the input events, while the
+    returned sample weights reweight it back to the input population.
+    The subsample only depends on ``random_state`` and the input events.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Input DataFrame.
+    max_per_stratum : int, optional
+        Maximum number of events drawn from each stratum (default is 1000).
+    energy_bins : array_like, optional
+        Log energy bin edges (default is None, the analysis energy bins
+        from ``comptools.get_energybins`` are used). Events outside the
+        bins aren't sampled.
+    energy_key : str, optional
+        Log energy column to bin events in (default is 'MC_log_energy').
+    comp_key : str, optional
+        Composition column, e.g. 'comp_group_3' (default is 'comp_group_2').
+    random_state : int, optional
+        Random seed (default is 2).
+
+    Returns
+    -------
+    sample_index : numpy.ndarray
+        Sorted row positions of the sampled events.
+    sample_weight : numpy.ndarray
+        Weight of each sampled event, i.e. the number of events in its
+        stratum divided by the number sampled from it.
+
+    Examples
+    --------
+    Tune hyperparameters on a subsample of the training events:
+
+    >>> import comptools as comp
+    >>> df_train, df_test = comp.load_sim(config='IC86.2012')  # doctest: +SKIP
+    >>> sample_index, sample_weight = comp.io.get_stratified_sample(
+    ...     df_train, max_per_stratum=500)  # doctest: +SKIP
+    >>> df_sample = df_train.iloc[sample_index]  # doctest: +SKIP
+
+    """
+    validate_dataframe(df)
+    if max_per_stratum < 1:
+        raise ValueError('max_per_stratum must be at least 1, '
+                         'got {}'.format(max_per_stratum))
+    if energy_bins is None:
+        energy_bins = get_energybins().log_energy_bins
+    energy_bins = np.asarray(energy_bins)
+
+    energy_bin_idx = np.digitize(df[energy_key].values, energy_bins) - 1
+    comp_codes, comp_values = pd.factorize(df[comp_key])
+    in_strata = ((energy_bin_idx >= 0) &
+                 (energy_bin_idx < len(energy_bins) - 1) & (comp_codes >= 0))
+    stratum = energy_bin_idx * len(comp_values) + comp_codes
+    stratum[~in_strata] = -1
+
+    # Shuffle events within each stratum and keep the first max_per_stratum
+    random_keys = np.random.RandomState(random_state).random_sample(len(df))
+    order = np.lexsort((random_keys, stratum))
+    sorted_stratum = stratum[order]
+    stratum_start = np.searchsorted(sorted_stratum, sorted_stratum)
+    rank = np.arange(len(df)) - stratum_start
+    keep = (rank < max_per_stratum) & (sorted_stratum >= 0)
+
+    sample_index = np.sort(order[keep])
+    counts = np.bincount(stratum[in_strata])
+    sample_stratum = stratum[sample_index]
+    n_sampled = np.minimum(counts, max_per_stratum)[sample_stratum]
+    sample_weight = counts[sample_stratum] / n_sampled
+
+    return sample_index, sample_weight
+
+
 def dataframe_to_array(df, columns, drop_null=True):
 
     validate_dataframe(df)
@@ -361,14 +1678,78 @@ def dataframe_to_array(df, columns, drop_null=True):
     return array
 
 
-def dataframe_to_X_y(df, feature_list, target='comp_target_2', drop_null=True):
+def _finite_mask(array):
+    if np.issubdtype(array.dtype, np.number):
+        mask = np.isfinite(array)
+    else:
+        mask = pd.notnull(array)
+    if mask.ndim > 1:
+        mask = mask.all(axis=1)
+    return mask
+
+
+def dataframe_to_X_y(df, feature_list, target='comp_target_2', drop_null=True,
+                     dtype=None, return_index=False):
+    '''Extracts aligned feature and target arrays from a DataFrame
 
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Input DataFrame.
+    feature_list : list
+        Feature columns.
+    target : str, optional
+        Target column (default is 'comp_target_2').
+    drop_null : bool, optional
+        Option to drop events that have a NaN or infinite value in any of
+        the feature or target columns (default is True). Features and
+        target are filtered with the same mask, so X and y stay aligned.
+    dtype : numpy.dtype, optional
+        Data type of the returned feature array (e.g. numpy.float32). By
+        default the feature columns' common dtype is used (default is None).
+    return_index : bool, optional
+        Option to also return the index of the events in X and y
+        (default is False).
+
+    Returns
+    -------
+    X : numpy.ndarray
+        Feature array with shape (n_events, n_features).
+    y : numpy.ndarray
+        Target array with shape (n_events,).
+    index : pandas.Index
+        Index of the events in X and y. Only returned if return_index is
+        True.
+    '''
     validate_dataframe(df)
 
-    X = dataframe_to_array(df, feature_list, drop_null=drop_null)
-    y = dataframe_to_array(df, target, drop_null=drop_null)
+    # Avoid copies where possible (e.g. when the feature columns already
+    # share a dtype and no events need to be dropped)
+    X = df[feature_list].values
+    if dtype is not None:
+        X = X.astype(dtype, copy=False)
+    y = df[target].values
+    index = df.index
 
-    return X, y
+    if drop_null:
+        mask = _finite_mask(X) & _finite_mask(y)
+        if not mask.all():
+            X, y, index = X[mask], y[mask], index[mask]
+
+    if return_index:
+        return X, y, index
+    else:
+        return X, y
+
+
+def _get_model_file(pipeline_str):
+    paths = get_paths()
+    model_file = os.path.join(paths.project_root, 'models',
+                              '{}.pkl'.format(pipeline_str))
+    if not os.path.exists(model_file):
+        raise IOError('There is no saved model file {}'.format(model_file))
+
+    return model_file
 
 
 def load_trained_model(pipeline_str='BDT', return_metadata=False):
@@ -390,12 +1771,7 @@ def load_trained_model(pipeline_str='BDT', return_metadata=False):
         Dictionary containing trained model as well as relevant metadata.
 
     """
-    paths = get_paths()
-    model_file = os.path.join(paths.project_root, 'models',
-                              '{}.pkl'.format(pipeline_str))
-    if not os.path.exists(model_file):
-        raise IOError('There is no saved model file {}'.format(model_file))
-
+    model_file = _get_model_file(pipeline_str)
     model_dict = joblib.load(model_file)
 
     if return_metadata:
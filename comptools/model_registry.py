@@ -0,0 +1,279 @@
+from __future__ import print_function, division
+import os
+import glob
+import time
+import json
+import hashlib
+import numpy as np
+import sklearn
+from sklearn.externals import joblib
+
+from .base import get_paths
+from .pipelines import get_pipeline
+
+
+def get_registry_dir():
+    '''Returns the default directory of the trained-model registry
+    '''
+    return os.path.join(get_paths().project_root, 'models', 'registry')
+
+
+def _update_array_hash(sha1, array):
+    array = np.ascontiguousarray(array)
+    if array.dtype == object:
+        sha1.update(repr(array.tolist()).encode('utf-8'))
+    else:
+        sha1.update('{}{}'.format(array.dtype.str, array.shape).encode('utf-8'))
+        sha1.update(array.tobytes())
+
+
+def _canonical_param(name, value):
+    '''Converts a hyperparameter value to a JSON-serializable primitive
+
+    Estimators (whose own parameters are part of ``get_params(deep=True)``)
+    and classes are replaced by their import path. Values without a stable
+    primitive representation, e.g. a ``numpy.random.RandomState``, raise a
+    TypeError.
+    '''
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_canonical_param(name, item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _canonical_param(name, item)
+                for key, item in value.items()}
+    if hasattr(value, 'get_params') or isinstance(value, type):
+        cls = value if isinstance(value, type) else type(value)
+        return '{}.{}'.format(cls.__module__, cls.__name__)
+    raise TypeError('Hyperparameter {} has a value of type {}, which can\'t '
+                    'be hashed reproducibly'.format(name, type(value)))
+
+
+def get_model_key(pipeline, X_train, y_train, feature_list=None,
+                  fit_params=None, split_seed=None):
+    '''Returns a hash that identifies a trained model
+
+    The hash combines the pipeline steps and all hyperparameter values
+    (serialized as canonical JSON, see ``_canonical_param``), the
+    training features, the contents of the training arrays (and any
+    fit parameters such as sample weights), the seed of the split the
+    training events came from, and the scikit-learn version.
+
+    Parameters
+    ----------
+    pipeline : sklearn.pipeline.Pipeline
+        Unfitted pipeline.
+    X_train : array_like
+        Training features.
+    y_train : array_like
+        Training targets.
+    feature_list : list, optional
+        Names of the training feature columns (default is None).
+    fit_params : dict, optional
+        Additional parameters passed to ``pipeline.fit`` (default is None).
+    split_seed : int, optional
+        Random seed of the training/testing split (default is None).
+
+    Returns
+    -------
+    key : str
+        Hexadecimal SHA-1 digest.
+
+    Raises
+    ------
+    TypeError
+        If a hyperparameter value can't be serialized reproducibly.
+    '''
+    sha1 = hashlib.sha1()
+    params = {name: _canonical_param(name, value)
+              for name, value in pipeline.get_params(deep=True).items()}
+    hyperparams = json.dumps(params, sort_keys=True, allow_nan=True)
+    for item in ([sklearn.__version__, repr(split_seed), hyperparams] +
+                 list(feature_list or [])):
+        sha1.update(item.encode('utf-8'))
+        sha1.update(b'\0')
+    _update_array_hash(sha1, X_train)
+    _update_array_hash(sha1, y_train)
+    for name, value in sorted((fit_params or {}).items()):
+        sha1.update(name.encode('utf-8'))
+        _update_array_hash(sha1, value)
+
+    return sha1.hexdigest()
+
+
+def _get_registry_file(registry_dir, pipeline_str, key):
+    basename = '{}_sklearn-{}_{}.pkl'.format(pipeline_str, sklearn.__version__,
+                                             key[:16])
+    return os.path.join(registry_dir, basename)
+
+
+def evict_models(registry_dir=None, max_entries=None, max_age=None,
+                 pipeline_str=None):
+    '''Removes stale entries from the trained-model registry
+
+    Only entries saved with the current scikit-learn version (and, if
+    given, of the ``pipeline_str`` pipeline) are considered, so a registry
+    can be shared by environments with different versions (entries are
+    keyed on the version) and by several pipelines. Entries are touched
+    whenever they are loaded, so the least recently used entries are
+    removed first.
+
+    Parameters
+    ----------
+    registry_dir : path, optional
+        Registry directory (default is None, see ``get_registry_dir``).
+    max_entries : int, optional
+        Maximum number of entries of the current scikit-learn version to
+        keep (default is None, no limit).
+    max_age : float, optional
+        Remove entries not used in the last ``max_age`` days (default is
+        None, no limit).
+    pipeline_str : str, optional
+        Only consider entries of this pipeline (default is None, entries
+        of all pipelines are considered).
+
+    Returns
+    -------
+    removed : list
+        Paths of the removed entries.
+    '''
+    if registry_dir is None:
+        registry_dir = get_registry_dir()
+    removed = []
+    pattern = '{}_sklearn-{}_*.pkl'.format(pipeline_str or '*',
+                                           sklearn.__version__)
+    entries = [(os.path.getmtime(model_file), model_file)
+               for model_file in glob.glob(os.path.join(registry_dir, pattern))]
+
+    # Most recently used first
+    entries = sorted(entries, reverse=True)
+    if max_age is not None:
+        min_time = time.time() - max_age * 24 * 3600
+        removed += [f for mtime, f in entries if mtime < min_time]
+        entries = [(mtime, f) for mtime, f in entries if mtime >= min_time]
+    if max_entries is not None:
+        removed += [f for _, f in entries[max_entries:]]
+
+    for model_file in removed:
+        try:
+            os.remove(model_file)
+        except OSError:
+            pass
+
+    return removed
+
+
+def fit_or_load(pipeline_str, X_train, y_train, feature_list=None,
+                params=None, fit_params=None, split_seed=None,
+                registry_dir=None, max_entries=20, return_metadata=False,
+                verbose=False):
+    '''Returns a trained pipeline, only training it if it isn't cached
+
+    Trained pipelines are stored in a registry keyed by the pipeline,
+    hyperparameters, training features, training data, and split seed
+    (see ``get_model_key``). If a pipeline with the same key has already
+    been trained it's loaded, otherwise it's trained and added to the
+    registry.
+
+    Parameters
+    ----------
+    pipeline_str : str
+        Name of pipeline (see ``comptools.get_pipeline``).
+    X_train : array_like
+        Training features.
+    y_train : array_like
+        Training targets.
+    feature_list : list, optional
+        Names of the training feature columns. Stored with the model
+        (default is None).
+    params : dict, optional
+        Hyperparameters to set on the pipeline, e.g.
+        ``{'classifier__max_depth': 3}`` (default is None).
+    fit_params : dict, optional
+        Additional parameters passed to ``pipeline.fit``, e.g.
+        ``{'classifier__sample_weight': sample_weight}`` (default is None).
+    split_seed : int, optional
+        Random seed of the training/testing split, e.g. the
+        ``random_state`` passed to ``comptools.load_sim`` (default is None).
+    registry_dir : path, optional
+        Registry directory (default is None, see ``get_registry_dir``).
+    max_entries : int, optional
+        Maximum number of entries of ``pipeline_str`` kept in the registry
+        after a new model is added. Entries of other pipelines aren't
+        removed (default is 20).
+    return_metadata : bool, optional
+        Option to return the model dictionary, with the fitted pipeline
+        and its metadata, instead of the pipeline (default is False).
+    verbose : bool, optional
+        Option to print whether the model was loaded or trained
+        (default is False).
+
+    Returns
+    -------
+    pipeline : sklearn.pipeline.Pipeline
+        Trained pipeline.
+    model_dict : dict
+        Dictionary containing the trained pipeline as well as relevant
+        metadata. Only returned if return_metadata is True.
+
+    Examples
+    --------
+    >>> import comptools as comp
+    >>> df_train, df_test = comp.load_sim(config='IC86.2012')  # doctest: +SKIP
+    >>> feature_list, _ = comp.get_training_features()
+    >>> X_train, y_train = comp.dataframe_to_X_y(df_train, feature_list,
+    ...                                          target='comp_target_4')  # doctest: +SKIP
+    >>> pipeline = comp.fit_or_load('BDT_comp_IC86.2012_4-groups',
+    ...                             X_train, y_train,
+    ...                             feature_list=feature_list,
+    ...                             split_seed=2)  # doctest: +SKIP
+
+    '''
+    if registry_dir is None:
+        registry_dir = get_registry_dir()
+    pipeline = get_pipeline(pipeline_str)
+    if params:
+        pipeline.set_params(**params)
+    key = get_model_key(pipeline, X_train, y_train,
+                        feature_list=feature_list, fit_params=fit_params,
+                        split_seed=split_seed)
+    model_file = _get_registry_file(registry_dir, pipeline_str, key)
+
+    model_dict = None
+    if os.path.exists(model_file):
+        try:
+            model_dict = joblib.load(model_file)
+        except Exception:
+            # Unreadable (e.g. partially written) entries are retrained
+            model_dict = None
+    if model_dict is not None and model_dict.get('key') == key:
+        # Mark entry as recently used
+        os.utime(model_file, None)
+        if verbose:
+            print('Loaded {} from {}'.format(pipeline_str, model_file))
+    else:
+        if verbose:
+            print('Training {}...'.format(pipeline_str))
+        pipeline.fit(X_train, y_train, **(fit_params or {}))
+        model_dict = {'pipeline': pipeline,
+                      # Using tuple because items must be pickle-able
+                      'training_features': tuple(feature_list or []),
+                      'sklearn_version': sklearn.__version__,
+                      'pipeline_str': pipeline_str,
+                      'params': dict(params or {}),
+                      'split_seed': split_seed,
+                      'key': key}
+        if not os.path.isdir(registry_dir):
+            os.makedirs(registry_dir)
+        tmp_file = '{}.tmp{}'.format(model_file, os.getpid())
+        joblib.dump(model_dict, tmp_file)
+        os.rename(tmp_file, model_file)
+        evict_models(registry_dir=registry_dir, max_entries=max_entries,
+                     pipeline_str=pipeline_str)
+
+    if return_metadata:
+        return model_dict
+    else:
+        return model_dict['pipeline']
@@ -1,49 +1,105 @@
 
-from __future__ import division
-from collections import defaultdict
+from __future__ import division, print_function
+import os
+import shutil
+import tempfile
 import dask
 from dask import delayed, multiprocessing, threaded
 from dask.diagnostics import ProgressBar
 import numpy as np
 import pandas as pd
-from sklearn.model_selection import StratifiedKFold, KFold, GridSearchCV
+from sklearn.base import BaseEstimator, clone
+from sklearn.model_selection import (StratifiedKFold, KFold, GridSearchCV,
+                                     ParameterGrid, StratifiedShuffleSplit)
 from sklearn.metrics import get_scorer
+from sklearn.externals import joblib
 
 from .base import get_training_features
-from .io import dataframe_to_X_y
+from .io import dataframe_to_X_y, _finite_mask
 from .composition_encoding import get_comp_list
 from .data_functions import ratio_error
 from .pipelines import get_pipeline
 
 
-def _get_frac_correct(df_train, df_test, feature_columns, num_groups,
-                      pipeline_str, comp_list, log_energy_bins):
+# Fold data loaded by workers, keyed by data file (see _load_fold_data)
+_fold_data_cache = {}
+
+
+def _dump_fold_data(data, processes=True):
+    '''Shares CV arrays with the tasks that evaluate each fold
+
+    For process-based schedulers the arrays are written to a file that
+    workers can memory-map. The file is put in shared memory (/dev/shm)
+    when available, so only the file name and fold index arrays have to
+    be sent to each worker rather than a copy of the training DataFrame
+    for every task. Threads share memory already, so for threaded and
+    synchronous schedulers the arrays are only registered in memory under
+    a key that is passed to each task instead.
+    '''
+    if not processes:
+        data_file = 'memory:{}'.format(id(data))
+        _fold_data_cache[data_file] = data
+        return data_file
+
+    temp_folder = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    data_dir = tempfile.mkdtemp(prefix='comptools_cv_', dir=temp_folder)
+    data_file = os.path.join(data_dir, 'fold_data.pkl')
+    joblib.dump(data, data_file)
+
+    return data_file
+
+
+def _load_fold_data(data_file):
+    '''Returns the (memory-mapped) CV arrays in data_file
+    '''
+    if data_file not in _fold_data_cache:
+        _fold_data_cache[data_file] = joblib.load(data_file, mmap_mode='r')
+    return _fold_data_cache[data_file]
+
+
+def _remove_fold_data(data_file):
+    _fold_data_cache.pop(data_file, None)
+    if not data_file.startswith('memory:'):
+        shutil.rmtree(os.path.dirname(data_file), ignore_errors=True)
+
+
+def _get_comp_codes(df, num_groups):
+    comp_list = get_comp_list(num_groups=num_groups)
+    comp_key = 'comp_group_{}'.format(num_groups)
+    return pd.Categorical(df[comp_key], categories=comp_list).codes
+
+
+def _get_frac_correct(data_file, train_index, test_index, pipeline_str,
+                      comp_list, log_energy_bins):
     '''Calculates the fraction of correctly identified samples in each energy bin
     for each composition in comp_list. In addition, the statisitcal error for the
     fraction correctly identified is calculated.'''
 
     # Fit pipeline and get mask for correctly identified events
-    target = 'comp_target_{}'.format(num_groups)
+    data = _load_fold_data(data_file)
+    X, y = data['X'], data['y']
     pipeline = get_pipeline(pipeline_str)
-    pipeline.fit(df_train[feature_columns], df_train[target])
-    test_predictions = pipeline.predict(df_test[feature_columns])
-    correctly_identified_mask = (test_predictions == df_test[target])
+    pipeline.fit(X[train_index], y[train_index])
+    test_predictions = pipeline.predict(X[test_index])
+    correctly_identified_mask = (test_predictions == y[test_index])
+    test_comp_codes = data['comp_codes'][test_index]
+    test_log_energy = data['MC_log_energy'][test_index]
 
     # Construct MC composition masks
     MC_comp_mask = {}
-    for composition in comp_list:
-        MC_comp_mask[composition] = df_test['comp_group_{}'.format(num_groups)] == composition
-    MC_comp_mask['total'] = np.ones(len(df_test), dtype=bool)
+    for comp_code, composition in enumerate(comp_list):
+        MC_comp_mask[composition] = test_comp_codes == comp_code
+    MC_comp_mask['total'] = np.ones(len(test_index), dtype=bool)
 
     data = {}
     for composition in comp_list + ['total']:
         comp_mask = MC_comp_mask[composition]
         # Get number of MC comp in each reco energy bin
-        num_MC_energy = np.histogram(df_test.loc[comp_mask, 'MC_log_energy'], bins=log_energy_bins)[0]
+        num_MC_energy = np.histogram(test_log_energy[comp_mask], bins=log_energy_bins)[0]
         num_MC_energy_err = np.sqrt(num_MC_energy)
 
         # Get number of correctly identified comp in each reco energy bin
-        num_reco_energy = np.histogram(df_test.loc[comp_mask & correctly_identified_mask, 'MC_log_energy'],
+        num_reco_energy = np.histogram(test_log_energy[comp_mask & correctly_identified_mask],
                                        bins=log_energy_bins)[0]
         num_reco_energy_err = np.sqrt(num_reco_energy)
 
@@ -65,58 +121,100 @@ def get_CV_frac_correct(df_train, feature_list, target, pipeline_str, num_groups
     comp_list = get_comp_list(num_groups=num_groups)
     comp_target = target
 
+    # Publish the arrays needed by every fold once, so that each task only
+    # receives its fold indices. Folds are stratified by target, but the
+    # pipeline is always trained on the num_groups composition target.
+    data_file = _dump_fold_data(
+        {'X': df_train[feature_list].values,
+         'y': df_train['comp_target_{}'.format(num_groups)].values,
+         'MC_log_energy': df_train['MC_log_energy'].values,
+         'comp_codes': _get_comp_codes(df_train, num_groups)},
+        processes=n_jobs > 1)
+
     # Set up get_frac_correct to run on each CV fold
     folds = []
-    for train_index, test_index in skf.split(df_train, df_train[comp_target]):
-        df_train_fold = df_train.iloc[train_index]
-        df_test_fold = df_train.iloc[test_index]
+    for train_index, test_index in skf.split(np.empty((len(df_train), 0)),
+                                             df_train[comp_target]):
         frac_correct = delayed(_get_frac_correct)(
-                    df_train_fold, df_test_fold, feature_list, num_groups,
-                    pipeline_str, comp_list, log_energy_bins)
+                    data_file, train_index, test_index, pipeline_str,
+                    comp_list, log_energy_bins)
         folds.append(frac_correct)
 
     df_cv = delayed(pd.DataFrame.from_records)(folds)
 
     # Run get_frac_correct on each fold in parallel
     print('Running {}-fold CV model evaluation...'.format(n_splits))
-    with ProgressBar():
-        get = multiprocessing.get if n_jobs > 1 else dask.get
-        df_cv = df_cv.compute(get=get, num_works=n_jobs)
+    try:
+        with ProgressBar():
+            get = multiprocessing.get if n_jobs > 1 else dask.get
+            df_cv = df_cv.compute(get=get, num_works=n_jobs)
+    finally:
+        _remove_fold_data(data_file)
 
     return df_cv
 
 
+def _get_pipeline_single_core(pipeline_str, **params):
+    pipeline = get_pipeline(pipeline_str)
+    pipeline.named_steps['classifier'].set_params(**params)
+    # Only run on a single core
+    try:
+        pipeline.named_steps['classifier'].set_params(**{'n_jobs': 1})
+    except ValueError:
+        pass
+    return pipeline
+
+
+def _get_comp_scores(scorer, y, pred, comp_codes, comp_list):
+    '''Returns the score for all events and each composition group
+    '''
+    scores = {'total': scorer(y, pred)}
+    for comp_code, composition in enumerate(comp_list):
+        comp_mask = comp_codes == comp_code
+        scores[composition] = scorer(y[comp_mask], pred[comp_mask])
+    return scores
+
+
+def _get_cv_dict(pipeline_str, param_name, param_value, fold_scores,
+                 comp_list):
+    '''Summarizes the training and testing scores of each CV fold
+
+    fold_scores is a list with a (train_scores, test_scores) pair of
+    dictionaries (see _get_comp_scores) for each fold.
+    '''
+    data_dict = {'classifier': pipeline_str, 'param_name': param_name,
+                 'param_value': param_value, 'n_splits': len(fold_scores)}
+    for label in comp_list + ['total']:
+        for idx, name in enumerate(['train', 'test']):
+            scores = [fold[idx][label] for fold in fold_scores]
+            data_dict['{}_mean_{}'.format(name, label)] = np.mean(scores)
+            data_dict['{}_std_{}'.format(name, label)] = np.std(scores)
+
+    return data_dict
+
+
 @delayed
-def _cross_validate_comp(df_train, df_test, pipeline_str, param_name,
-                         param_value, feature_list=None,
-                         target='comp_target_2', scoring='r2', num_groups=2,
-                         n_splits=10):
-    '''Calculates stratified k-fold CV scores for a given hyperparameter value
+def _cross_validate_comp(data_file, folds, pipeline_str, param_name,
+                         param_value, scoring='r2', num_groups=2):
+    '''Calculates k-fold CV scores for a given hyperparameter value
 
     Parameters
     ----------
-    df_train : pandas.DataFrame
-        Training DataFrame (see comptools.load_sim()).
-    df_test : pandas.DataFrame
-        Testing DataFrame (see comptools.load_sim()).
+    data_file : path
+        File with the feature array, targets, and composition codes of the
+        training events (see _dump_fold_data).
+    folds : list
+        Training and testing row positions for each CV fold.
     pipeline_str : str
         Name of pipeline to use (e.g. 'BDT', 'RF_energy', etc.).
     param_name : str
         Name of hyperparameter (e.g. 'max_depth', 'learning_rate', etc.).
     param_value : int, float, str
         Value to set hyperparameter to.
-    feature_list : list, optional
-        List of training feature columns to use (default is to use
-        comptools.get_training_features()).
-    target : str, optional
-        Training target to use (default is 'comp_target_2').
     scoring : {'r2', 'mse', 'accuracy'}
         Scoring metric to calculate for each CV fold (default is 'r2').
     num_groups : int, optional
         Number of composition class groups to use (default is 2).
-    n_splits : int, optional
-        Number of folds to use in (KFold) cross-validation
-        (default is 10).
 
     Returns
     -------
@@ -126,76 +224,166 @@ def _cross_validate_comp(df_train, df_test, pipeline_str, param_name,
     '''
     # assert scoring in ['accuracy', 'mse', 'r2'], 'Invalid scoring parameter'
     comp_list = get_comp_list(num_groups=num_groups)
-    if feature_list is None:
-        feature_list, _ = get_training_features()
-
-    pipeline = get_pipeline(pipeline_str)
-    pipeline.named_steps['classifier'].set_params(**{param_name: param_value})
-    # Only run on a single core
-    try:
-        pipeline.named_steps['classifier'].set_params(**{'n_jobs': 1})
-    except ValueError:
-        pass
+    data = _load_fold_data(data_file)
+    X, y, comp_codes = data['X'], data['y'], data['comp_codes']
 
-    data_dict = {'classifier': pipeline_str, 'param_name': param_name,
-                 'param_value': param_value, 'n_splits': n_splits}
-
-    train_scores = defaultdict(list)
-    test_scores = defaultdict(list)
-
-    kf = KFold(n_splits=n_splits, shuffle=True, random_state=2)
+    pipeline = _get_pipeline_single_core(pipeline_str,
+                                         **{param_name: param_value})
     scorer = get_scorer(scoring)
 
-    for train_index, test_index in kf.split(df_train.values):
+    fold_scores = []
+    for train_index, test_index in folds:
 
-        df_train_fold = df_train.iloc[train_index]
-        df_test_fold = df_train.iloc[test_index]
-        X_train, y_train = dataframe_to_X_y(df_train_fold, feature_list,
-                                            target=target)
-        X_test, y_test = dataframe_to_X_y(df_test_fold, feature_list,
-                                          target=target)
+        X_train, y_train = X[train_index], y[train_index]
+        X_test, y_test = X[test_index], y[test_index]
 
         pipeline = pipeline.fit(X_train, y_train)
 
         train_pred = pipeline.predict(X_train)
-        train_score = scorer(y_train, train_pred)
-        train_scores['total'].append(train_score)
-
         test_pred = pipeline.predict(X_test)
-        test_score = scorer(y_test, test_pred)
-        test_scores['total'].append(test_score)
 
         # Get testing/training scores for each composition group
-        for composition in comp_list:
-            comp_key = 'comp_group_{}'.format(num_groups)
+        fold_scores.append(
+            (_get_comp_scores(scorer, y_train, train_pred,
+                              comp_codes[train_index], comp_list),
+             _get_comp_scores(scorer, y_test, test_pred,
+                              comp_codes[test_index], comp_list)))
 
-            comp_mask_train = df_train_fold[comp_key] == composition
-            comp_score_train = scorer(y_train[comp_mask_train],
-                                      train_pred[comp_mask_train])
-            train_scores[composition].append(comp_score_train)
+    data_dict = _get_cv_dict(pipeline_str, param_name, param_value,
+                             fold_scores, comp_list)
 
-            comp_mask_test = df_test_fold[comp_key] == composition
-            comp_score_test = scorer(y_test[comp_mask_test],
-                                     test_pred[comp_mask_test])
-            test_scores[composition].append(comp_score_test)
+    return data_dict
 
-    for label in comp_list + ['total']:
-        data_dict['train_mean_{}'.format(label)] = np.mean(train_scores[label])
-        data_dict['train_std_{}'.format(label)] = np.std(train_scores[label])
-        data_dict['test_mean_{}'.format(label)] = np.mean(test_scores[label])
-        data_dict['test_std_{}'.format(label)] = np.std(test_scores[label])
 
-    return data_dict
+def _is_xgboost(classifier):
+    # Duck-typed, so xgboost is only needed if an xgboost model is used
+    return hasattr(classifier, 'get_booster')
+
+
+def supports_staged_predict(classifier):
+    '''Checks whether a classifier can predict with a subset of its stages
+
+    Boosting classifiers (scikit-learn models with ``staged_predict`` and
+    xgboost models) can score a range of ``n_estimators`` values from a
+    single fit (see ``cross_validate_comp``).
+
+    Parameters
+    ----------
+    classifier : estimator
+        Classifier (e.g. the ``'classifier'`` step of a pipeline).
+
+    Returns
+    -------
+    bool
+        Whether staged predictions are supported.
+    '''
+    return hasattr(classifier, 'staged_predict') or _is_xgboost(classifier)
+
+
+def _staged_predict(pipeline, X, n_estimators):
+    '''Predicts with a fitted boosting pipeline truncated to fewer stages
+
+    Parameters
+    ----------
+    pipeline : sklearn.pipeline.Pipeline
+        Fitted pipeline with a boosting classifier as its final step.
+    X : array_like
+        Feature array.
+    n_estimators : array_like
+        Numbers of boosting stages to predict with.
+
+    Returns
+    -------
+    predictions : dict
+        Mapping from each value in ``n_estimators`` to the predictions of
+        the first that many stages.
+    '''
+    X_transformed = X
+    for _, step in pipeline.steps[:-1]:
+        X_transformed = step.transform(X_transformed)
+    classifier = pipeline.steps[-1][1]
+
+    predictions = {}
+    if _is_xgboost(classifier):
+        for n in n_estimators:
+            try:
+                predictions[n] = classifier.predict(X_transformed,
+                                                    iteration_range=(0, n))
+            except TypeError:
+                # Older versions of xgboost
+                predictions[n] = classifier.predict(X_transformed,
+                                                    ntree_limit=n)
+    else:
+        n_estimators = set(n_estimators)
+        for stage, pred in enumerate(classifier.staged_predict(X_transformed),
+                                     start=1):
+            if stage in n_estimators:
+                predictions[stage] = pred
+        # Boosting can terminate early (e.g. AdaBoost with a perfect fit),
+        # in which case the remaining stages are the same as the last one
+        for n in n_estimators - set(predictions):
+            predictions[n] = pred
+
+    return predictions
+
+
+@delayed
+def _staged_cross_validate_fold(data_file, train_index, test_index,
+                                pipeline_str, param_values, scoring='r2',
+                                num_groups=2):
+    '''Scores a boosting pipeline for several n_estimators with one fit
+
+    The pipeline is fit once with the largest number of estimators and the
+    smaller values are scored from its staged predictions.
+
+    Returns
+    -------
+    fold_scores : list
+        Pair of training and testing score dictionaries (see
+        _get_comp_scores) for each value in param_values.
+    '''
+    comp_list = get_comp_list(num_groups=num_groups)
+    data = _load_fold_data(data_file)
+    X, y, comp_codes = data['X'], data['y'], data['comp_codes']
+    X_train, y_train = X[train_index], y[train_index]
+    X_test, y_test = X[test_index], y[test_index]
+
+    pipeline = _get_pipeline_single_core(pipeline_str,
+                                         n_estimators=max(param_values))
+    pipeline = pipeline.fit(X_train, y_train)
+    train_preds = _staged_predict(pipeline, X_train, param_values)
+    test_preds = _staged_predict(pipeline, X_test, param_values)
+
+    scorer = get_scorer(scoring)
+    fold_scores = []
+    for param_value in param_values:
+        fold_scores.append(
+            (_get_comp_scores(scorer, y_train, train_preds[param_value],
+                              comp_codes[train_index], comp_list),
+             _get_comp_scores(scorer, y_test, test_preds[param_value],
+                              comp_codes[test_index], comp_list)))
+
+    return fold_scores
+
+
+def _staged_cv_dicts(folds_scores, pipeline_str, param_values, comp_list):
+    return [_get_cv_dict(pipeline_str, 'n_estimators', param_value,
+                         [fold_scores[idx] for fold_scores in folds_scores],
+                         comp_list)
+            for idx, param_value in enumerate(param_values)]
 
 
 def cross_validate_comp(df_train, df_test, pipeline_str, param_name,
                         param_values, feature_list=None,
                         target='comp_target_2', scoring='accuracy',
-                        num_groups=2, n_splits=10, n_jobs=1, verbose=False):
+                        num_groups=2, n_splits=10, n_jobs=1, staged=False,
+                        verbose=False):
     '''Calculates stratified k-fold CV scores for a given hyperparameter value
 
     Similar to sklearn.model_selection.cross_validate, but returns results
     for individual composition groups as well as the combined CV result.
+    The training arrays are extracted once and each hyperparameter value
+    only receives the CV fold indices.
 
     Parameters
     ----------
@@ -223,6 +411,12 @@ def cross_validate_comp(df_train, df_test, pipeline_str, param_name,
         (default is 10).
     n_jobs : int, optional
         Number of jobs to run in parallel (default is 1).
+    staged : bool, optional
+        Option to evaluate an ``n_estimators`` sweep of a boosting pipeline
+        (e.g. 'BDT_comp_*' or 'xgboost_comp_*') with a single fit per fold
+        at the largest value. Smaller values are scored from the staged
+        predictions of that fit, which are the same as refitting with
+        fewer estimators (default is False).
     verbose : bool, optional
         Option to print a progress bar (default is False).
 
@@ -233,26 +427,69 @@ def cross_validate_comp(df_train, df_test, pipeline_str, param_name,
             on those scores for each composition.
 
     '''
-    cv_dicts = []
-    for param_value in param_values:
-        cv_dict = _cross_validate_comp(
-                    df_train, df_test, pipeline_str,
-                    param_name, param_value,
-                    feature_list=feature_list, target=target,
-                    scoring=scoring, num_groups=num_groups, n_splits=n_splits)
-        cv_dicts.append(cv_dict)
+    if staged:
+        if param_name != 'n_estimators':
+            raise ValueError('Staged evaluation is only supported for '
+                             'n_estimators, got {}'.format(param_name))
+        classifier = get_pipeline(pipeline_str).named_steps['classifier']
+        if not supports_staged_predict(classifier):
+            raise ValueError('Staged evaluation isn\'t supported for the '
+                             '{} pipeline'.format(pipeline_str))
+    if feature_list is None:
+        feature_list, _ = get_training_features()
+
+    # Events with null features or target are dropped from each fold
+    X, y = dataframe_to_X_y(df_train, feature_list, target=target,
+                            drop_null=False)
+    positions = np.flatnonzero(_finite_mask(X) & _finite_mask(y))
+    X, y = X[positions], y[positions]
+    comp_codes = _get_comp_codes(df_train, num_groups)[positions]
+    # Folds are evaluated in threads, so the arrays don't need to be
+    # written to a file
+    data_file = _dump_fold_data({'X': X, 'y': y, 'comp_codes': comp_codes},
+                                processes=False)
+
+    # Map the folds of all training events to rows of X
+    row = np.full(len(df_train), -1, dtype=int)
+    row[positions] = np.arange(len(positions))
+    kf = KFold(n_splits=n_splits, shuffle=True, random_state=2)
+    folds = []
+    for train_index, test_index in kf.split(np.empty((len(df_train), 0))):
+        train_rows, test_rows = row[train_index], row[test_index]
+        folds.append((train_rows[train_rows >= 0], test_rows[test_rows >= 0]))
+
+    if staged:
+        folds_scores = [_staged_cross_validate_fold(
+                            data_file, train_index, test_index, pipeline_str,
+                            list(param_values), scoring=scoring,
+                            num_groups=num_groups)
+                        for train_index, test_index in folds]
+        cv_dicts = delayed(_staged_cv_dicts)(
+            folds_scores, pipeline_str, list(param_values),
+            get_comp_list(num_groups=num_groups))
+    else:
+        cv_dicts = []
+        for param_value in param_values:
+            cv_dict = _cross_validate_comp(
+                        data_file, folds, pipeline_str,
+                        param_name, param_value,
+                        scoring=scoring, num_groups=num_groups)
+            cv_dicts.append(cv_dict)
 
     df_cv = delayed(pd.DataFrame.from_records)(cv_dicts, index='param_value')
 
     get = dask.get if n_jobs == 1 else threaded.get
     # get = dask.get if n_jobs == 1 else multiprocessing.get
-    if verbose:
-        with ProgressBar():
-            print('Performing {}-fold CV on {} hyperparameter values ({} fits):'.format(
-                n_splits, len(param_values),  n_splits*len(param_values)))
+    try:
+        if verbose:
+            with ProgressBar():
+                print('Performing {}-fold CV on {} hyperparameter values ({} fits):'.format(
+                    n_splits, len(param_values),  n_splits*len(param_values)))
+                df_cv = df_cv.compute(get=get, num_works=n_jobs)
+        else:
             df_cv = df_cv.compute(get=get, num_works=n_jobs)
-    else:
-        df_cv = df_cv.compute(get=get, num_works=n_jobs)
+    finally:
+        _remove_fold_data(data_file)
 
     return df_cv
 
@@ -294,8 +531,272 @@ def get_param_grid(pipeline_name=None):
     return param_grid
 
 
+def _fit_early_stopping(estimator, X, y, early_stopping_rounds,
+                        validation_fraction=0.1, random_state=2):
+    '''Fits an xgboost pipeline, stopping when a held-out fold stops improving
+
+    A stratified ``validation_fraction`` of the events is held out and
+    passed (transformed by the preceding pipeline steps) as the xgboost
+    ``eval_set``.
+    '''
+    splitter = StratifiedShuffleSplit(n_splits=1, test_size=validation_fraction,
+                                      random_state=random_state)
+    train_index, val_index = next(splitter.split(X, y))
+    X_train, X_val = X[train_index], X[val_index]
+    steps = getattr(estimator, 'steps', [('classifier', estimator)])
+    for _, step in steps[:-1]:
+        X_train = step.fit_transform(X_train, y[train_index])
+        X_val = step.transform(X_val)
+    classifier = steps[-1][1]
+
+    fit_params = {'eval_set': [(X_val, y[val_index])], 'verbose': False}
+    if 'early_stopping_rounds' in classifier.get_params():
+        classifier.set_params(early_stopping_rounds=early_stopping_rounds)
+    else:
+        # Older versions of xgboost take it as a fit parameter
+        fit_params['early_stopping_rounds'] = early_stopping_rounds
+    classifier.fit(X_train, y[train_index], **fit_params)
+
+    return estimator
+
+
+def _fit_and_score(estimator, X, y, train_index, test_index, scorer,
+                   early_stopping_rounds=None, random_state=2):
+    if early_stopping_rounds is None:
+        estimator.fit(X[train_index], y[train_index])
+    else:
+        _fit_early_stopping(estimator, X[train_index], y[train_index],
+                            early_stopping_rounds, random_state=random_state)
+    return scorer(estimator, X[test_index], y[test_index])
+
+
+def _stratified_subsample(y, n_samples, permutation, min_per_class=1):
+    '''Returns the indices of a class-stratified subsample
+
+    Events are taken in the order of ``permutation``, so larger subsamples
+    contain the smaller ones. Each class keeps its share of the events,
+    but at least ``min_per_class`` of them (or all of them, if fewer).
+    '''
+    if n_samples >= len(permutation):
+        return permutation
+    _, y_codes = np.unique(y[permutation], return_inverse=True)
+    counts = np.bincount(y_codes)
+    n_per_class = (n_samples * counts) // len(permutation)
+    n_per_class = np.minimum(np.maximum(n_per_class, min_per_class), counts)
+    keep = np.zeros(len(permutation), dtype=bool)
+    for code, n in enumerate(n_per_class):
+        keep[np.flatnonzero(y_codes == code)[:n]] = True
+
+    return permutation[keep]
+
+
+class SuccessiveHalvingSearchCV(BaseEstimator):
+    """Hyperparameter search by successive halving
+
+    Every parameter combination in ``param_grid`` is first cross-validated
+    with a small amount of a resource (training events or boosting
+    stages). Only the best ``1 / factor`` of the candidates are kept for
+    the next iteration, which uses ``factor`` times more of the resource,
+    until the remaining candidates are evaluated with the full resource.
+    Poor candidates are therefore stopped early, after only a few cheap
+    fits.
+
+    The fitted search has the same ``best_estimator_``, ``best_params_``,
+    ``best_score_``, and ``cv_results_`` attributes as
+    ``sklearn.model_selection.GridSearchCV``.
+
+    Parameters
+    ----------
+    estimator : estimator object
+        Estimator (e.g. a pipeline from ``comptools.get_pipeline``) to tune.
+    param_grid : dict
+        Dictionary with hyperparameter names / values, in the same format
+        as for GridSearchCV (see ``get_param_grid``).
+    resource : str, optional
+        Resource to increase in each iteration. Either 'n_samples', the
+        number of training events, or the name of an integer
+        hyperparameter in ``param_grid`` (e.g.
+        'classifier__n_estimators'). A hyperparameter resource is removed
+        from the candidates and ranges from its smallest to its largest
+        grid value (default is 'n_samples').
+    factor : int, optional
+        Fraction of candidates kept in each iteration, as well as the
+        growth of the resource (default is 3).
+    min_resources : int, optional
+        Amount of resource used in the first iteration (default is None,
+        chosen so that the last iteration uses the full resource).
+    cv : int, optional
+        Number of stratified folds (default is 10).
+    scoring : str, callable, optional
+        Scoring metric (default is 'accuracy').
+    n_jobs : int, optional
+        Number of fits to run in parallel (default is 1).
+    early_stopping_rounds : int, optional
+        For xgboost pipelines only. If given, 10% of the training events
+        of each fold are held out as an xgboost ``eval_set``, and boosting
+        stops once the held-out score hasn't improved for this many
+        rounds (default is None, no early stopping).
+    random_state : int, optional
+        Random seed for the training event subsamples and folds
+        (default is 2).
+    verbose : int, optional
+        Option to print the progress of each iteration (default is 0).
+    """
+
+    def __init__(self, estimator, param_grid, resource='n_samples', factor=3,
+                 min_resources=None, cv=10, scoring='accuracy', n_jobs=1,
+                 early_stopping_rounds=None, random_state=2, verbose=0):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.resource = resource
+        self.factor = factor
+        self.min_resources = min_resources
+        self.cv = cv
+        self.scoring = scoring
+        self.n_jobs = n_jobs
+        self.early_stopping_rounds = early_stopping_rounds
+        self.random_state = random_state
+        self.verbose = verbose
+
+    def _get_resource_range(self, n_samples, n_candidates, n_classes):
+        if self.resource == 'n_samples':
+            max_resources = n_samples
+            grid_min_resources = None
+        else:
+            if self.resource not in self.param_grid:
+                raise ValueError('Resource {} must be in param_grid or be '
+                                 'n_samples'.format(self.resource))
+            max_resources = max(self.param_grid[self.resource])
+            grid_min_resources = min(self.param_grid[self.resource])
+
+        # Number of iterations needed to get down to a single candidate
+        n_iterations = 1
+        while self.factor ** n_iterations <= n_candidates:
+            n_iterations += 1
+        min_resources = self.min_resources
+        if min_resources is None:
+            min_resources = max_resources // self.factor ** (n_iterations - 1)
+            if self.resource == 'n_samples':
+                # Every fold needs training events from each class
+                min_resources = max(min_resources, 2 * self.cv * n_classes)
+            else:
+                min_resources = max(min_resources, grid_min_resources, 1)
+
+        return min(min_resources, max_resources), max_resources, n_iterations
+
+    def fit(self, X, y):
+        """Runs the successive halving search
+
+        Parameters
+        ----------
+        X : array_like
+            Training features.
+        y : array_like
+            Training labels.
+
+        Returns
+        -------
+        self : SuccessiveHalvingSearchCV
+            Fitted search.
+        """
+        X, y = np.asarray(X), np.asarray(y)
+        scorer = get_scorer(self.scoring)
+        if (self.early_stopping_rounds is not None and
+                not _is_xgboost(getattr(self.estimator, 'steps',
+                                        [(None, self.estimator)])[-1][1])):
+            raise ValueError('early_stopping_rounds is only supported for '
+                             'xgboost estimators')
+        param_grid = dict(self.param_grid)
+        if self.resource != 'n_samples':
+            param_grid.pop(self.resource, None)
+        candidates = list(ParameterGrid(param_grid))
+        min_resources, max_resources, n_iterations = self._get_resource_range(
+            len(X), len(candidates), len(np.unique(y)))
+
+        random_state = np.random.RandomState(self.random_state)
+        permutation = random_state.permutation(len(X))
+        cv_results = {'params': [], 'iter': [], 'n_resources': [],
+                      'mean_test_score': [], 'std_test_score': []}
+        iteration = 0
+        while True:
+            # Grow the resource by factor, making sure the last iteration
+            # uses all of it
+            n_resources = min(max_resources, max(
+                min_resources * self.factor ** iteration,
+                max_resources // self.factor ** max(n_iterations - 1 - iteration, 0)))
+            resource_params = {}
+            if self.resource == 'n_samples':
+                # Every class needs enough events to be in each fold
+                sample_index = _stratified_subsample(y, n_resources,
+                                                     permutation,
+                                                     min_per_class=self.cv)
+            else:
+                sample_index = permutation
+                resource_params[self.resource] = n_resources
+            X_iter, y_iter = X[sample_index], y[sample_index]
+            if self.verbose:
+                print('Iteration {}: {} candidates with {} = {}'.format(
+                    iteration, len(candidates), self.resource, n_resources))
+
+            skf = StratifiedKFold(n_splits=self.cv, shuffle=True,
+                                  random_state=self.random_state)
+            folds = list(skf.split(X_iter, y_iter))
+            fold_scores = joblib.Parallel(n_jobs=self.n_jobs)(
+                joblib.delayed(_fit_and_score)(
+                    clone(self.estimator).set_params(**dict(params,
+                                                            **resource_params)),
+                    X_iter, y_iter, train_index, test_index, scorer,
+                    early_stopping_rounds=self.early_stopping_rounds,
+                    random_state=self.random_state)
+                for params in candidates
+                for train_index, test_index in folds)
+            fold_scores = np.reshape(fold_scores, (len(candidates), self.cv))
+            mean_scores = fold_scores.mean(axis=1)
+            for params, mean_score, scores in zip(candidates, mean_scores,
+                                                  fold_scores):
+                cv_results['params'].append(dict(params, **resource_params))
+                cv_results['iter'].append(iteration)
+                cv_results['n_resources'].append(n_resources)
+                cv_results['mean_test_score'].append(mean_score)
+                cv_results['std_test_score'].append(scores.std())
+
+            if len(candidates) == 1 or n_resources >= max_resources:
+                break
+            # Keep the best candidates (stable for ties) for the next iteration
+            n_keep = int(np.ceil(len(candidates) / self.factor))
+            keep = np.argsort(-mean_scores, kind='mergesort')[:n_keep]
+            candidates = [candidates[idx] for idx in sorted(keep)]
+            iteration += 1
+
+        best_idx = np.argmax(mean_scores)
+        self.best_params_ = dict(candidates[best_idx])
+        if self.resource != 'n_samples':
+            self.best_params_[self.resource] = max_resources
+        self.best_score_ = mean_scores[best_idx]
+        self.best_estimator_ = clone(self.estimator).set_params(
+            **self.best_params_)
+        if self.early_stopping_rounds is None:
+            self.best_estimator_.fit(X, y)
+        else:
+            _fit_early_stopping(self.best_estimator_, X, y,
+                                self.early_stopping_rounds,
+                                random_state=self.random_state)
+        self.cv_results_ = {key: np.asarray(value) if key != 'params' else value
+                            for key, value in cv_results.items()}
+        self.n_iterations_ = iteration + 1
+
+        return self
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+    def predict_proba(self, X):
+        return self.best_estimator_.predict_proba(X)
+
+
 def gridsearch_optimize(pipeline, param_grid, X_train, y_train, n_jobs=1,
-                        return_gridsearch=False):
+                        return_gridsearch=False, search='grid',
+                        resource='n_samples', factor=3):
     """Runs a grid search to optimize hyperparameters
 
     Parameters
@@ -315,31 +816,57 @@ def gridsearch_optimize(pipeline, param_grid, X_train, y_train, n_jobs=1,
         Whether to return the fitted GridSearchCV object, or the
         best_estimator_ object (default is False, so will return the
         best_estimator_).
+    search : {'grid', 'halving'}, optional
+        Search strategy. 'grid' cross-validates every combination in
+        param_grid, while 'halving' uses successive halving (see
+        SuccessiveHalvingSearchCV) to discard poor combinations after
+        cheap fits (default is 'grid').
+    resource : str, optional
+        Resource increased in each successive halving iteration, either
+        'n_samples' or a hyperparameter in param_grid such as
+        'classifier__n_estimators'. Ignored if search='grid'
+        (default is 'n_samples').
+    factor : int, optional
+        Successive halving reduction factor. Ignored if search='grid'
+        (default is 3).
 
     Returns
     -------
     best_pipeline : sklearn.model_selection.Pipeline
         Pipeline with optimal hyperparameter values that has been trained on
         the entire training dataset (X_train, y_train).
-    gridsearch : sklearn.model_selection.GridSearchCV
-        Fitted GridSearchCV object.
+    gridsearch : sklearn.model_selection.GridSearchCV, SuccessiveHalvingSearchCV
+        Fitted search object.
     """
     # Want to make sure pipeline isn't running in parallel
     # Will run GridSearchCV in parallel instead
     if hasattr(pipeline, 'classifier__n_jobs'):
         pipeline.set_params(classifier__n_jobs=1)
 
-    param_str = '\n\t'.join(['{}: {}'.format(key, value) for key, value in param_grid.iteritems()])
-    print('Running grid search over the following parameters:\n\t{}'.format(param_str))
-    gridsearch = GridSearchCV(pipeline,
-                              param_grid=param_grid,
-                              cv=10,
-                              scoring='accuracy',
-                              n_jobs=n_jobs,
-                              return_train_score=True,
-                              verbose=1)
+    if search not in ['grid', 'halving']:
+        raise ValueError('Invalid search entered: {}'.format(search))
+
+    param_str = '\n\t'.join(['{}: {}'.format(key, value) for key, value in param_grid.items()])
+    print('Running {} search over the following parameters:\n\t{}'.format(search, param_str))
+    if search == 'grid':
+        gridsearch = GridSearchCV(pipeline,
+                                  param_grid=param_grid,
+                                  cv=10,
+                                  scoring='accuracy',
+                                  n_jobs=n_jobs,
+                                  return_train_score=True,
+                                  verbose=1)
+    else:
+        gridsearch = SuccessiveHalvingSearchCV(pipeline,
+                                               param_grid=param_grid,
+                                               resource=resource,
+                                               factor=factor,
+                                               cv=10,
+                                               scoring='accuracy',
+                                               n_jobs=n_jobs,
+                                               verbose=1)
     gridsearch.fit(X_train, y_train)
-    print('best GridSearchCV params = {}'.format(gridsearch.best_params_))
+    print('best {} search params = {}'.format(search, gridsearch.best_params_))
 
     if return_gridsearch:
         return gridsearch
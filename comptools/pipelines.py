@@ -8,7 +8,8 @@ from sklearn.tree import DecisionTreeClassifier
 from sklearn.svm import SVC, LinearSVC, NuSVC
 from sklearn.preprocessing import StandardScaler
 from sklearn.externals import joblib
-from xgboost import XGBClassifier
+import xgboost
+from xgboost import XGBClassifier, XGBRegressor
 
 from sklearn.linear_model import LogisticRegression
 from mlxtend.classifier import StackingClassifier
@@ -25,10 +26,36 @@ from sklearn.metrics import euclidean_distances
 def line(x, x1, y1, x2, y2):
     return (x - x1) * ((y2-y1) / (x2-x1)) + y1
 
+# Boundary lines in the (log_s125, log_dEdX) plane, given as
+# (x1, y1, x2, y2) points for line(), between the proton, oxygen, and
+# iron classes
+_linecut_boundaries = [(0, 0.75, 2, 2.3),
+                       (0, 0.9, 2, 2.4),
+                       (0, 1.1, 2, 2.5)]
+
+
 class LineCutClassifier(BaseEstimator, ClassifierMixin):
+    """Classifies events with cuts on log_dEdX along lines in log_s125
 
-    def __init__(self, demo_param='demo'):
+    An event is assigned to the first class whose boundary line it's
+    below (or on), and to the last class if it's above every line.
+
+    Parameters
+    ----------
+    boundaries : list, optional
+        Boundary lines, as (x1, y1, x2, y2) points, between consecutive
+        classes. N boundaries give N + 1 classes (default is None, the
+        proton / oxygen / iron boundaries for 4 classes).
+    """
+
+    def __init__(self, demo_param='demo', boundaries=None):
         self.demo_param = demo_param
+        self.boundaries = boundaries
+
+    def _get_boundaries(self):
+        if self.boundaries is None:
+            return _linecut_boundaries
+        return self.boundaries
 
     def fit(self, X, y):
 
@@ -36,7 +63,8 @@ class LineCutClassifier(BaseEstimator, ClassifierMixin):
         X, y = check_X_y(X, y)
         # Store the classes seen during fit
         self.classes_ = unique_labels(y)
-        assert len(self.classes_) == 4, 'Must have 4 classes'
+        n_classes = len(self._get_boundaries()) + 1
+        assert len(self.classes_) == n_classes, 'Must have {} classes'.format(n_classes)
 
         self.X_ = X
         self.y_ = y
@@ -53,20 +81,16 @@ class LineCutClassifier(BaseEstimator, ClassifierMixin):
 
         assert X.shape[1] == 3, 'Must have only 3 training features'
 
-        y = np.empty(len(X), dtype=int)
-        for idx, (log_s125, log_dEdX) in enumerate(X[:, (1, 2)]):
-            log_dEdX_iron = line(log_s125, 0, 1.1, 2, 2.5)
-            log_dEdX_oxygen = line(log_s125, 0, 0.9, 2, 2.4)
-            log_dEdX_proton = line(log_s125, 0, 0.75, 2, 2.3)
-
-            if log_dEdX <= log_dEdX_proton:
-                y[idx] = 0
-            elif (log_dEdX <= log_dEdX_oxygen) and (log_dEdX > log_dEdX_proton):
-                y[idx] = 1
-            elif (log_dEdX <= log_dEdX_iron) and (log_dEdX > log_dEdX_oxygen):
-                y[idx] = 2
-            else:
-                y[idx] = 3
+        log_s125, log_dEdX = X[:, 1], X[:, 2]
+        boundaries = self._get_boundaries()
+        below_boundary = np.empty((len(X), len(boundaries)), dtype=bool)
+        for idx, (x1, y1, x2, y2) in enumerate(boundaries):
+            below_boundary[:, idx] = log_dEdX <= line(log_s125, x1, y1, x2, y2)
+
+        # Index of the first boundary each event is below, or the last
+        # class for events above all of them
+        y = np.where(below_boundary.any(axis=1),
+                     below_boundary.argmax(axis=1), len(boundaries))
 
         return y
 
@@ -233,6 +257,20 @@ def get_pipeline(classifier_name='BDT'):
                                    random_state=2)
         steps.append(('classifier', classifier))
 
+    elif classifier_name in ['HistBDT_comp_IC86.2012_2-groups',
+                             'HistBDT_comp_IC86.2012_3-groups',
+                             'HistBDT_comp_IC86.2012_4-groups']:
+        # Same tree depths as the corresponding BDT_comp pipelines
+        max_depth = {'2-groups': 4, '3-groups': 3, '4-groups': 2}
+        # xgboost bins each feature into at most max_bin quantile bins
+        classifier = XGBClassifier(tree_method='hist',
+                                   max_bin=255,
+                                   max_depth=max_depth[classifier_name[-8:]],
+                                   learning_rate=0.1,
+                                   n_estimators=100,
+                                   random_state=2)
+        steps.append(('classifier', classifier))
+
     elif classifier_name == 'LogisticRegression_comp_IC86.2012_4-groups':
         classifier = LogisticRegression(random_state=2)
         steps.append(('scaler', StandardScaler()))
@@ -293,6 +331,14 @@ def get_pipeline(classifier_name='BDT'):
                                            n_jobs=10,
                                            random_state=2)
         steps.append(('classifier', classifier))
+    elif classifier_name == 'HistBDT_energy_IC86.2012':
+        classifier = XGBRegressor(tree_method='hist',
+                                  max_bin=255,
+                                  max_depth=7,
+                                  learning_rate=0.1,
+                                  n_estimators=100,
+                                  random_state=2)
+        steps.append(('classifier', classifier))
     else:
         raise ValueError(
             '{} is not a valid classifier name'.format(classifier_name))
@@ -305,3 +351,83 @@ def get_pipeline(classifier_name='BDT'):
     pipeline = Pipeline(steps)
 
     return pipeline
+
+
+def get_hist_dmatrix(X, y=None, ref=None, max_bin=255):
+    '''Returns features binned once, for reuse across HistBDT fits
+
+    The returned matrix stores the binned features together with their
+    bin edges, so it can only be used with boosters trained with the same
+    binning (xgboost raises an error for a different ``max_bin``).
+
+    Parameters
+    ----------
+    X : array_like
+        Feature array.
+    y : array_like, optional
+        Targets (default is None).
+    ref : xgboost.QuantileDMatrix, optional
+        Training matrix whose bin edges are used to bin ``X``, e.g. for
+        testing events (default is None, bin edges are computed from
+        ``X``).
+    max_bin : int, optional
+        Maximum number of bins per feature. Must match the ``max_bin`` of
+        the HistBDT pipelines (default is 255).
+
+    Returns
+    -------
+    dmatrix : xgboost.QuantileDMatrix
+        Binned features (and targets).
+    '''
+    return xgboost.QuantileDMatrix(X, label=y, ref=ref, max_bin=max_bin)
+
+
+def fit_hist_bdt(pipeline_str, dtrain, **params):
+    '''Trains the booster of a HistBDT pipeline on pre-binned features
+
+    Unlike ``get_pipeline(pipeline_str).fit``, the features in ``dtrain``
+    aren't binned again, so the same binned features can be reused to
+    train several hyperparameter settings.
+
+    Parameters
+    ----------
+    pipeline_str : str
+        Name of a HistBDT pipeline (e.g. 'HistBDT_comp_IC86.2012_4-groups').
+    dtrain : xgboost.QuantileDMatrix
+        Binned training features and targets (see ``get_hist_dmatrix``).
+    params : dict
+        Hyperparameters of the pipeline classifier to change, e.g.
+        ``max_depth=3``.
+
+    Returns
+    -------
+    booster : xgboost.Booster
+        Trained booster. For composition pipelines, ``booster.predict``
+        returns the probability of each class (or of class 1, for two
+        classes).
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> import comptools as comp
+    >>> X = np.random.normal(size=(1000, 3))
+    >>> y = (X[:, 0] > 0).astype(int)
+    >>> dtrain = comp.get_hist_dmatrix(X, y)
+    >>> boosters = [comp.fit_hist_bdt('HistBDT_comp_IC86.2012_2-groups',
+    ...                               dtrain, max_depth=max_depth)
+    ...             for max_depth in [2, 3, 4]]
+    '''
+    if not pipeline_str.startswith('HistBDT'):
+        raise ValueError('{} is not a HistBDT pipeline'.format(pipeline_str))
+    classifier = get_pipeline(pipeline_str).named_steps['classifier']
+    classifier.set_params(**params)
+    xgb_params = classifier.get_xgb_params()
+    if isinstance(classifier, XGBClassifier):
+        n_classes = len(np.unique(dtrain.get_label()))
+        if n_classes > 2:
+            xgb_params['objective'] = 'multi:softprob'
+            xgb_params['num_class'] = n_classes
+    booster = xgboost.train(xgb_params, dtrain,
+                            num_boost_round=classifier.n_estimators)
+
+    return booster
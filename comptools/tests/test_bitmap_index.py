@@ -0,0 +1,89 @@
+import pytest
+import numpy as np
+import pandas as pd
+from comptools.cuts import evaluate_cuts
+from comptools.dataframe_schema import compact_dataframe, save_schema
+from comptools.bitmap_index import (QUALITY_CUTS_COLUMN, pack_cut_masks,
+                                    get_cut_mask, save_cut_names,
+                                    build_bitmap_index, save_bitmap_index,
+                                    read_bitmap_index, select_rows)
+
+
+@pytest.fixture
+def df():
+    np.random.seed(2)
+    n_events = 1003
+    df = pd.DataFrame({'NStations': np.random.randint(0, 10, n_events),
+                       'max_qfrac_1_60': np.random.uniform(0, 1, n_events),
+                       'sim': np.random.choice([12360, 12362], n_events),
+                       'MC_comp': np.random.choice(['PPlus', 'Fe56Nucleus'],
+                                                   n_events)})
+    return df
+
+
+cuts = [('NStations', 'NStations >= 5'),
+        ('max_qfrac_1_60', 'max_qfrac_1_60 < 0.3')]
+
+
+def test_pack_cut_masks(df):
+    _, cut_masks, _ = evaluate_cuts(df, cuts)
+    packed = pack_cut_masks(cut_masks)
+    cut_names = list(cut_masks)
+
+    assert packed.dtype == np.uint8
+    for name, mask in cut_masks.items():
+        np.testing.assert_array_equal(get_cut_mask(packed, cut_names, [name]),
+                                      mask)
+    np.testing.assert_array_equal(get_cut_mask(packed, cut_names, cut_names),
+                                  cut_masks['NStations'] &
+                                  cut_masks['max_qfrac_1_60'])
+    np.testing.assert_array_equal(get_cut_mask(packed, cut_names, []),
+                                  np.ones(len(df), dtype=bool))
+
+
+@pytest.mark.parametrize('compact', [True, False])
+def test_bitmap_index_select_rows(df, tmpdir, compact):
+    _, cut_masks, _ = evaluate_cuts(df, cuts)
+    df[QUALITY_CUTS_COLUMN] = pack_cut_masks(cut_masks)
+    cut_names = list(cut_masks)
+
+    df_file = str(tmpdir.join('sim_dataframe.hdf5'))
+    with pd.HDFStore(df_file, mode='w') as store:
+        schema = None
+        if compact:
+            df_stored, schema = compact_dataframe(df)
+        else:
+            df_stored = df
+        store.append('dataframe', df_stored, format='table')
+        if schema is not None:
+            save_schema(store, schema)
+        save_cut_names(store, cut_names)
+        bitmap_index, n_rows = build_bitmap_index(store, schema=schema,
+                                                  cut_names=cut_names,
+                                                  chunksize=100)
+        save_bitmap_index(store, bitmap_index, n_rows)
+
+    bitmap_index, n_rows = read_bitmap_index(df_file)
+    assert n_rows == len(df)
+    rows = select_rows(bitmap_index, n_rows, cuts=['max_qfrac_1_60'],
+                       MC_comp='Fe56Nucleus', sim=[12360, 12362])
+    expected_mask = (cut_masks['max_qfrac_1_60'] &
+                     (df['MC_comp'] == 'Fe56Nucleus').values)
+    np.testing.assert_array_equal(rows, np.flatnonzero(expected_mask))
+
+    rows = select_rows(bitmap_index, n_rows, sim=12362)
+    np.testing.assert_array_equal(rows, np.flatnonzero(df['sim'] == 12362))
+
+
+def test_select_rows_invalid_fail(df, tmpdir):
+    df_file = str(tmpdir.join('sim_dataframe.hdf5'))
+    with pd.HDFStore(df_file, mode='w') as store:
+        store.append('dataframe', df, format='table')
+        bitmap_index, n_rows = build_bitmap_index(store)
+
+    with pytest.raises(ValueError) as excinfo:
+        select_rows(bitmap_index, n_rows, cuts=['NStations'])
+    assert 'Invalid cut name' in str(excinfo.value)
+    with pytest.raises(ValueError) as excinfo:
+        select_rows(bitmap_index, n_rows, comp_group_2='light')
+    assert 'No bitmap index' in str(excinfo.value)
@@ -1,8 +1,54 @@
 
 import pytest
+import numpy as np
+import pandas as pd
 from comptools import get_comp_list
+from comptools.composition_encoding import (composition_group_labels,
+                                            encode_composition_groups,
+                                            decode_composition_groups)
 
 
 @pytest.mark.parametrize('num_groups', [2, 3, 4])
 def test_get_comp_list_length(num_groups):
     assert len(get_comp_list(num_groups)) == num_groups
+
+
+@pytest.mark.parametrize('num_groups', [2, 3, 4])
+def test_composition_encoding_round_trip(num_groups):
+    rng = np.random.RandomState(2)
+    compositions = rng.choice(get_comp_list(num_groups=4), 100)
+    comp_to_group = {'PPlus': 'light', 'He4Nucleus': 'light',
+                     'O16Nucleus': 'heavy', 'Fe56Nucleus': 'heavy'}
+    if num_groups == 3:
+        comp_to_group['O16Nucleus'] = 'intermediate'
+    expected_groups = [comp_to_group[c] if num_groups != 4 else c
+                       for c in compositions]
+
+    groups = composition_group_labels(compositions, num_groups=num_groups)
+    assert isinstance(groups, pd.Categorical)
+    assert list(groups) == expected_groups
+    labels = encode_composition_groups(groups, num_groups=num_groups)
+    np.testing.assert_array_equal(
+        labels, [get_comp_list(num_groups).index(g) for g in expected_groups])
+    decoded = decode_composition_groups(labels, num_groups=num_groups)
+    assert decoded.dtype == object
+    np.testing.assert_array_equal(decoded, expected_groups)
+
+
+def test_decode_composition_groups_2d():
+    labels = np.array([[0, 1], [1, 0]])
+    decoded = decode_composition_groups(labels, num_groups=2)
+    assert decoded.shape == labels.shape
+    np.testing.assert_array_equal(decoded, [['light', 'heavy'],
+                                            ['heavy', 'light']])
+
+
+def test_composition_encoding_invalid_fail():
+    with pytest.raises(KeyError):
+        composition_group_labels(['PPlus', 'Si28Nucleus'])
+    with pytest.raises(KeyError):
+        encode_composition_groups(['light', 'intermediate'], num_groups=2)
+    with pytest.raises(KeyError):
+        decode_composition_groups([0, 2], num_groups=2)
+    with pytest.raises(KeyError):
+        decode_composition_groups([0.5], num_groups=2)
@@ -0,0 +1,131 @@
+import pytest
+import numpy as np
+import pandas as pd
+from comptools.cuts import parse_cut, evaluate_cuts, get_cut_columns
+
+
+@pytest.fixture
+def df():
+    np.random.seed(2)
+    n_events = 1000
+    df = pd.DataFrame({'NStations': np.random.randint(0, 10, n_events),
+                       'max_qfrac_1_60': np.random.uniform(0, 1, n_events),
+                       'passed_IceTopQualityCuts': np.random.randint(0, 2, n_events)})
+    df.loc[::10, 'max_qfrac_1_60'] = np.nan
+
+    return df
+
+
+def test_parse_cut():
+    terms = parse_cut('NStations >= 5 & ~passed_IceTopQualityCuts')
+    assert terms == (('NStations', '>=', 5.0, False),
+                     ('passed_IceTopQualityCuts', None, None, True))
+    assert parse_cut('') == ()
+
+
+@pytest.mark.parametrize('expression', ['NStations >=', 'NStations > five',
+                                        '~NStations > 5', 'NStations &',
+                                        '5 < NStations'])
+def test_parse_cut_invalid_fail(expression):
+    with pytest.raises(ValueError):
+        parse_cut(expression)
+
+
+def test_evaluate_cuts(df):
+    cuts = [('NStations', 'NStations >= 5'),
+            ('max_qfrac', 'max_qfrac_1_60 < 0.3'),
+            ('passed_IceTop', 'passed_IceTopQualityCuts & NStations >= 5')]
+    selection_mask, cut_masks, cut_flow_table = evaluate_cuts(
+        df, cuts, cut_flow=['passed_IceTop', 'max_qfrac'])
+
+    expected_masks = {'NStations': (df['NStations'] >= 5).values,
+                      'max_qfrac': (df['max_qfrac_1_60'] < 0.3).values}
+    expected_masks['passed_IceTop'] = (
+        df['passed_IceTopQualityCuts'].astype(bool).values &
+        expected_masks['NStations'])
+    assert list(cut_masks) == ['NStations', 'max_qfrac', 'passed_IceTop']
+    for name, mask in expected_masks.items():
+        np.testing.assert_array_equal(cut_masks[name], mask)
+    expected_selection = (expected_masks['passed_IceTop'] &
+                          expected_masks['max_qfrac'])
+    np.testing.assert_array_equal(selection_mask, expected_selection)
+
+    assert list(cut_flow_table.index) == ['passed_IceTop', 'max_qfrac']
+    np.testing.assert_allclose(
+        cut_flow_table['pass_fraction'],
+        [expected_masks['passed_IceTop'].mean(),
+         expected_masks['max_qfrac'].mean()])
+    np.testing.assert_allclose(
+        cut_flow_table['cumulative_fraction'],
+        [expected_masks['passed_IceTop'].mean(), expected_selection.mean()])
+
+
+def test_evaluate_cuts_term_cache(df):
+    term_cache = {}
+    cuts = [('NStations', 'NStations >= 5'),
+            ('max_qfrac', 'max_qfrac_1_60 < 0.3')]
+    evaluate_cuts(df, cuts, term_cache=term_cache)
+    assert len(term_cache) == 2
+
+    # A cut variation only evaluates the changed term
+    cuts_varied = [('NStations', 'NStations >= 6'),
+                   ('max_qfrac', 'max_qfrac_1_60 < 0.3')]
+    df_max_qfrac = df.drop('max_qfrac_1_60', axis=1)
+    selection_mask, _, _ = evaluate_cuts(df_max_qfrac, cuts_varied,
+                                         term_cache=term_cache)
+    assert len(term_cache) == 3
+    np.testing.assert_array_equal(
+        selection_mask,
+        (df['NStations'] >= 6).values & (df['max_qfrac_1_60'] < 0.3).values)
+
+
+def test_evaluate_cuts_invalid_cut_flow_fail(df):
+    with pytest.raises(ValueError) as excinfo:
+        evaluate_cuts(df, [('NStations', 'NStations >= 5')],
+                      cut_flow=['NChannels'])
+    assert 'Invalid cut name' in str(excinfo.value)
+
+
+def test_get_cut_columns():
+    cuts = [('a', 'NStations >= 5 & max_qfrac_1_60 < 0.3'),
+            ('b', 'NStations < 9')]
+    assert get_cut_columns(cuts) == ['NStations', 'max_qfrac_1_60']
+
+
+@pytest.mark.parametrize('operators', [('>=', '<'), ('>', '<=')])
+def test_scan_cut_thresholds(df, operators):
+    from comptools.cuts import scan_cut_thresholds
+
+    df['comp_group_2'] = np.random.choice(['light', 'heavy'], len(df))
+    df['reco_log_energy'] = np.random.uniform(6, 8, len(df))
+    nstations_thresholds = [4, 5, 6]
+    qfrac_thresholds = [0.2, 0.3, 0.5]
+    cut_grid = [('NStations', operators[0], nstations_thresholds),
+                ('max_qfrac_1_60', operators[1], qfrac_thresholds)]
+    energy_bins = [6.0, 7.0, 7.5]
+    scan = scan_cut_thresholds(df, cut_grid, energy_key='reco_log_energy',
+                               energy_bins=energy_bins)
+
+    assert len(scan) == 2 * 3 * 3
+    for energy_bin in range(2):
+        energy_mask = ((df['reco_log_energy'] >= energy_bins[energy_bin]) &
+                       (df['reco_log_energy'] < energy_bins[energy_bin + 1]))
+        for nstations in nstations_thresholds:
+            for qfrac in qfrac_thresholds:
+                cuts = [('NStations', 'NStations {} {}'.format(operators[0],
+                                                               nstations)),
+                        ('max_qfrac', 'max_qfrac_1_60 {} {}'.format(
+                            operators[1], qfrac))]
+                selection_mask, _, _ = evaluate_cuts(df, cuts)
+                row = scan.loc[(energy_bin, nstations, qfrac)]
+                n_passed = {}
+                for composition in ['light', 'heavy']:
+                    comp_mask = energy_mask & (df['comp_group_2'] == composition)
+                    n_passed[composition] = np.sum(selection_mask & comp_mask)
+                    assert row['n_passed_{}'.format(composition)] == n_passed[composition]
+                    np.testing.assert_allclose(
+                        row['pass_fraction_{}'.format(composition)],
+                        n_passed[composition] / np.sum(comp_mask))
+                np.testing.assert_allclose(
+                    row['purity_light'],
+                    n_passed['light'] / (n_passed['light'] + n_passed['heavy']))
@@ -0,0 +1,68 @@
+import pytest
+import numpy as np
+import pandas as pd
+from comptools.dataframe_schema import (compact_dataframe, expand_dataframe,
+                                        get_stored_columns, save_schema,
+                                        read_schema)
+
+
+@pytest.fixture
+def df():
+    n_events = 100
+    np.random.seed(2)
+    comps = np.random.choice(['PPlus', 'He4Nucleus', 'O16Nucleus',
+                              'Fe56Nucleus'], size=n_events)
+    df = pd.DataFrame({'lap_log_energy': np.random.uniform(5, 9, n_events),
+                       'lap_beta': np.random.uniform(1, 10, n_events),
+                       'start_time_mjd': 56000 + np.random.random(n_events),
+                       'NStations': np.random.randint(3, 80, n_events),
+                       'passed_IceTopQualityCuts': np.random.random(n_events) > 0.5,
+                       'passed_InIceQualityCuts': np.random.randint(0, 2, n_events),
+                       'MC_comp': comps})
+    df.index = ['12360_1_{}_0'.format(i) for i in range(n_events)]
+
+    return df
+
+
+def test_compact_dataframe_dtypes(df):
+    df_compact, schema = compact_dataframe(df)
+
+    assert df_compact['lap_beta'].dtype == np.float32
+    assert df_compact['lap_log_energy'].dtype == np.float64
+    assert df_compact['start_time_mjd'].dtype == np.float64
+    assert df_compact['MC_comp'].dtype == np.int8
+    assert df_compact['packed_flags'].dtype == np.uint8
+    assert 'passed_IceTopQualityCuts' not in df_compact.columns
+
+
+def test_compact_dataframe_round_trip(df):
+    df_compact, schema = compact_dataframe(df)
+    df_expanded = expand_dataframe(df_compact, schema)
+
+    pd.testing.assert_frame_equal(df_expanded, df, check_exact=False,
+                                  rtol=1e-6)
+    # Energies are cut against bin edges, so they must round trip exactly
+    np.testing.assert_array_equal(df_expanded['lap_log_energy'],
+                                  df['lap_log_energy'])
+
+
+def test_compact_dataframe_invalid_label_fail(df):
+    df.loc[df.index[0], 'MC_comp'] = 'Unobtanium'
+    with pytest.raises(ValueError):
+        compact_dataframe(df)
+
+
+def test_compact_dataframe_hdf_columns(df, tmpdir):
+    df_file = str(tmpdir.join('sim_dataframe.hdf5'))
+    df_compact, schema = compact_dataframe(df)
+    with pd.HDFStore(df_file, mode='w') as store:
+        store.append('dataframe', df_compact, format='table')
+        save_schema(store, schema)
+
+    columns = ['passed_InIceQualityCuts', 'MC_comp']
+    schema = read_schema(df_file)
+    df_stored = pd.read_hdf(df_file, 'dataframe',
+                            columns=get_stored_columns(columns, schema))
+    df_expanded = expand_dataframe(df_stored, schema, columns=columns)
+
+    pd.testing.assert_frame_equal(df_expanded, df[columns])
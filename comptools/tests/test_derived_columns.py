@@ -0,0 +1,54 @@
+import pytest
+import numpy as np
+import pandas as pd
+from comptools import derived_columns
+from comptools.derived_columns import (register_derived_column,
+                                       resolve_columns, add_derived_columns)
+
+
+def test_resolve_columns():
+    stored_columns = ['lap_s125', 'eloss_1500_standard', 'log_dEdX']
+    read_columns, derived_columns = resolve_columns(
+        ['log_s125', 'log_dEdX', 'lap_beta'], stored_columns)
+
+    assert read_columns == ['lap_s125', 'log_dEdX', 'lap_beta']
+    assert derived_columns == ['log_s125']
+
+
+def test_add_derived_columns_nested(monkeypatch):
+    monkeypatch.setitem(derived_columns._derived_columns,
+                        'test_log_s125_dEdX_ratio',
+                        (['log_s125', 'log_dEdX'], np.divide))
+    df = pd.DataFrame({'lap_s125': [1.0, 10.0, 100.0],
+                       'eloss_1500_standard': [10.0, 100.0, 100.0]})
+    df = add_derived_columns(df, ['test_log_s125_dEdX_ratio'])
+
+    np.testing.assert_allclose(df['log_s125'], [0, 1, 2])
+    np.testing.assert_allclose(df['log_dEdX'], [1, 2, 2])
+    np.testing.assert_allclose(df['test_log_s125_dEdX_ratio'], [0, 0.5, 1])
+
+
+def test_add_derived_columns_missing_dependency_fail():
+    df = pd.DataFrame({'lap_s125': [1.0, 10.0]})
+    with pytest.raises(ValueError) as excinfo:
+        add_derived_columns(df, ['log_dEdX'])
+    assert 'eloss_1500_standard' in str(excinfo.value)
+
+
+def test_register_derived_column_self_dependency_fail():
+    with pytest.raises(ValueError) as excinfo:
+        register_derived_column('test_log_s125', ['test_log_s125'], np.log10)
+    assert 'itself' in str(excinfo.value)
+
+
+def test_register_derived_column_overwrite(monkeypatch):
+    monkeypatch.setitem(derived_columns._derived_columns, 'log_s125',
+                        derived_columns._derived_columns['log_s125'])
+    with pytest.raises(ValueError) as excinfo:
+        register_derived_column('log_s125', ['lap_s125'], np.log)
+    assert 'already registered' in str(excinfo.value)
+
+    register_derived_column('log_s125', ['lap_s125'], np.log, overwrite=True)
+    df = add_derived_columns(pd.DataFrame({'lap_s125': [1.0, np.e]}),
+                             ['log_s125'])
+    np.testing.assert_allclose(df['log_s125'], [0, 1])
@@ -0,0 +1,40 @@
+import pytest
+import numpy as np
+from comptools.event_keys import (encode_event_keys, decode_event_keys,
+                                  get_dataset_id)
+
+
+@pytest.mark.parametrize('dataset', [12360, 7006, 'IC86.2012', 'IC79.2010'])
+def test_event_keys_round_trip(dataset):
+    np.random.seed(2)
+    runs = np.random.randint(0, 2**20, size=100)
+    events = np.random.randint(0, 2**31, size=100)
+    sub_events = np.random.randint(0, 2**5, size=100)
+    keys = encode_event_keys(dataset, runs, events, sub_events)
+
+    assert keys.dtype == np.int64
+    assert np.all(keys >= 0)
+    datasets, runs_, events_, sub_events_ = decode_event_keys(keys)
+    assert np.all(datasets == dataset)
+    np.testing.assert_array_equal(runs, runs_)
+    np.testing.assert_array_equal(events, events_)
+    np.testing.assert_array_equal(sub_events, sub_events_)
+
+
+def test_event_keys_unique_across_datasets():
+    keys = [encode_event_keys(dataset, [1], [1], [0])[0]
+            for dataset in [12360, 12362, 'IC86.2012']]
+    assert len(set(keys)) == len(keys)
+
+
+def test_encode_event_keys_out_of_range_fail():
+    with pytest.raises(ValueError) as excinfo:
+        encode_event_keys(12360, [2**20], [0], [0])
+    error_message = 'Run values must be in the range [0, {})'.format(2**20)
+    assert str(excinfo.value) == error_message
+
+
+def test_get_dataset_id_invalid_fail():
+    with pytest.raises(ValueError) as excinfo:
+        get_dataset_id(12345)
+    assert str(excinfo.value) == 'Invalid dataset, 12345, entered'
@@ -1,5 +1,6 @@
 
 from __future__ import division
+import os
 import sys
 import pytest
 import numpy as np
@@ -65,3 +66,423 @@ def test_load_sim_split():
                                      test_size=0.5)
     pd.testing.assert_frame_equal(df_train_0, df_train_1)
     pd.testing.assert_frame_equal(df_test_0, df_test_1)
+
+
+@pytest.mark.needs_data
+def test_load_data_multiple_configs():
+    configs = ['IC86.2012', 'IC86.2013']
+    columns = ['lap_log_energy']
+    df = load_data(config=configs, energy_reco=False,
+                   energy_cut_key='lap_log_energy', columns=columns)
+    df_dict = load_data(config=configs, energy_reco=False,
+                        energy_cut_key='lap_log_energy', columns=columns,
+                        return_dict=True)
+
+    assert list(df_dict) == configs
+    assert list(df['config'].cat.categories) == configs
+    for config in configs:
+        pd.testing.assert_frame_equal(df.loc[df['config'] == config, :],
+                                      df_dict[config])
+
+
+def test_load_data_multiple_configs_invalid_config():
+    with pytest.raises(ValueError) as excinfo:
+        load_data(config=['IC86.2012', 'IC86.2099'])
+    assert 'config must be in' in str(excinfo.value)
+
+
+@pytest.fixture
+def df_file(tmpdir):
+    n_events = 1000
+    np.random.seed(2)
+    df = pd.DataFrame({'lap_log_energy': np.random.uniform(5, 9, n_events),
+                       'log_s125': np.random.normal(size=n_events),
+                       'log_dEdX': np.random.normal(size=n_events)})
+    df.index = ['12360_{}_{}_0'.format(i // 10, i) for i in range(n_events)]
+    df_file = str(tmpdir.join('sim_dataframe.hdf5'))
+    df.to_hdf(df_file, key='dataframe', format='table', data_columns=True)
+
+    return df_file
+
+
+def test_dataframe_cache_energy_cuts(df_file):
+    pytest.importorskip('pyarrow')
+    from comptools.io import save_dataframe_cache, _load_basic_dataframe
+
+    columns = ['lap_log_energy', 'log_s125']
+    kwargs = dict(df_file=df_file, energy_reco=False,
+                  energy_cut_key='lap_log_energy', log_energy_min=6.0,
+                  log_energy_max=8.0, columns=columns)
+    save_dataframe_cache(df_file, chunksize=300, row_group_size=100)
+    df_cache = _load_basic_dataframe(use_cache=True, **kwargs)
+
+    df = pd.read_hdf(df_file, 'dataframe', columns=columns)
+    energy_mask = (df['lap_log_energy'] > 6.0) & (df['lap_log_energy'] < 8.0)
+    assert list(df_cache.columns) == columns
+    pd.testing.assert_frame_equal(df.loc[energy_mask, :], df_cache)
+
+
+def test_sorted_dataframe_cache(df_file):
+    pytest.importorskip('pyarrow')
+    from comptools.io import (save_dataframe_cache, _load_basic_dataframe,
+                              iter_energy_bins)
+
+    save_dataframe_cache(df_file, chunksize=300, row_group_size=100,
+                         sort_key='lap_log_energy')
+    df = pd.read_hdf(df_file, 'dataframe')
+
+    columns = ['log_s125', 'lap_log_energy']
+    df_cache = _load_basic_dataframe(df_file=df_file, energy_reco=False,
+                                     energy_cut_key='lap_log_energy',
+                                     log_energy_min=6.123,
+                                     log_energy_max=7.5, columns=columns)
+    energy_mask = (df['lap_log_energy'] > 6.123) & (df['lap_log_energy'] < 7.5)
+    pd.testing.assert_frame_equal(df.loc[energy_mask, columns], df_cache)
+
+    bins = np.arange(5, 9.1, 0.5)
+    df_bins = dict(iter_energy_bins(bins, df_file=df_file))
+    assert sorted(df_bins) == list(range(len(bins) - 1))
+    for bin_idx, df_bin in df_bins.items():
+        energy_mask = ((df['lap_log_energy'] > bins[bin_idx]) &
+                       (df['lap_log_energy'] < bins[bin_idx + 1]))
+        pd.testing.assert_frame_equal(df.loc[energy_mask, :], df_bin)
+
+
+def test_get_train_test_split_persisted(tmpdir):
+    from sklearn.model_selection import ShuffleSplit
+    from comptools.io import get_train_test_split, get_train_test_split_file
+
+    index = pd.Index(np.arange(1000) * 7)
+    df_file = str(tmpdir.join('sim_dataframe.hdf5'))
+    train_index, test_index = get_train_test_split(index, test_size=0.3,
+                                                   random_state=2,
+                                                   df_file=df_file)
+    split_file = get_train_test_split_file(df_file, index, test_size=0.3,
+                                           random_state=2)
+    assert os.path.exists(split_file)
+
+    splitter = ShuffleSplit(n_splits=1, test_size=0.3, random_state=2)
+    expected_train, expected_test = next(splitter.split(np.empty(len(index))))
+    np.testing.assert_array_equal(train_index, np.sort(expected_train))
+    np.testing.assert_array_equal(test_index, np.sort(expected_test))
+
+    # Existing split files are read back rather than regenerated
+    with np.load(split_file) as split:
+        test_mask = np.unpackbits(split['test_mask'])[:len(index)]
+    np.savez(split_file, test_mask=np.packbits(~test_mask.astype(bool)),
+             n_rows=len(index))
+    train_index_file, test_index_file = get_train_test_split(
+        index, test_size=0.3, random_state=2, df_file=df_file)
+    np.testing.assert_array_equal(train_index_file, test_index)
+    np.testing.assert_array_equal(test_index_file, train_index)
+
+
+def test_get_stratified_sample():
+    from comptools.io import get_stratified_sample
+
+    np.random.seed(2)
+    n_events = 5000
+    df = pd.DataFrame({'MC_log_energy': np.random.exponential(0.5, n_events) + 6,
+                       'comp_group_2': np.random.choice(['light', 'heavy'],
+                                                        n_events, p=[0.8, 0.2])})
+    energy_bins = np.arange(6.0, 8.1, 0.5)
+    sample_index, sample_weight = get_stratified_sample(
+        df, max_per_stratum=200, energy_bins=energy_bins)
+
+    assert np.all(np.diff(sample_index) > 0)
+    df_sample = df.iloc[sample_index]
+    energy_bin = pd.cut(df['MC_log_energy'], energy_bins, right=False)
+    sample_energy_bin = energy_bin.iloc[sample_index]
+    counts = df.groupby([energy_bin, 'comp_group_2'], observed=True).size()
+    sample_counts = df_sample.groupby([sample_energy_bin, 'comp_group_2'],
+                                      observed=True).size()
+    pd.testing.assert_series_equal(sample_counts, np.minimum(counts, 200))
+    # Weighted sample reproduces the population of each stratum
+    weights = pd.Series(sample_weight, index=df_sample.index)
+    weighted_counts = weights.groupby([sample_energy_bin,
+                                       df_sample['comp_group_2']],
+                                      observed=True).sum()
+    np.testing.assert_allclose(weighted_counts, counts)
+
+    # Same events are drawn for the same random_state
+    sample_index_2, _ = get_stratified_sample(df, max_per_stratum=200,
+                                              energy_bins=energy_bins)
+    np.testing.assert_array_equal(sample_index, sample_index_2)
+
+
+def test_load_derived_columns(df_file):
+    pytest.importorskip('pyarrow')
+    from comptools.io import (save_dataframe_cache, _load_basic_dataframe,
+                              iter_sim)
+
+    df = pd.read_hdf(df_file, 'dataframe')
+    df['lap_zenith'] = np.random.uniform(0, 1, len(df))
+    df.to_hdf(df_file, key='dataframe', format='table', data_columns=True)
+    columns = ['lap_cos_zenith', 'log_s125']
+    expected = pd.DataFrame({'lap_cos_zenith': np.cos(df['lap_zenith']),
+                             'log_s125': df['log_s125']}, columns=columns)
+    energy_mask = (df['lap_log_energy'] > 6.0) & (df['lap_log_energy'] < 8.0)
+
+    df_iter = pd.concat(iter_sim(df_file=df_file, columns=columns,
+                                 energy_reco=False,
+                                 energy_cut_key='lap_log_energy'))
+    pd.testing.assert_frame_equal(df_iter, expected.loc[energy_mask, :])
+
+    save_dataframe_cache(df_file)
+    df_cache = _load_basic_dataframe(df_file=df_file, energy_reco=False,
+                                     energy_cut_key='lap_log_energy',
+                                     log_energy_min=6.0, log_energy_max=8.0,
+                                     columns=columns)
+    pd.testing.assert_frame_equal(df_cache, expected.loc[energy_mask, :])
+
+
+@pytest.fixture
+def energy_model_file(tmpdir):
+    from sklearn.externals import joblib
+    from sklearn.linear_model import LinearRegression
+    from sklearn.pipeline import Pipeline
+
+    np.random.seed(2)
+    X = np.random.normal(size=(100, 2))
+    y = X.sum(axis=1)
+    pipeline = Pipeline([('classifier', LinearRegression())]).fit(X, y)
+    model_dict = {'pipeline': pipeline,
+                  'training_features': ['log_s125', 'log_dEdX']}
+    model_file = str(tmpdir.join('RF_energy_IC86.2012.pkl'))
+    joblib.dump(model_dict, model_file)
+
+    return model_file
+
+
+def test_get_reco_log_energy_sidecar(df_file, energy_model_file, monkeypatch):
+    from comptools import io
+
+    monkeypatch.setattr(io, '_get_model_file', lambda name: energy_model_file)
+    df = pd.read_hdf(df_file, 'dataframe')
+    reco_log_energy = io.get_reco_log_energy(df, df_file=df_file)
+    np.testing.assert_allclose(reco_log_energy,
+                               df['log_s125'] + df['log_dEdX'])
+    assert os.path.exists(io.get_reco_energy_file(df_file))
+
+    # Stored energies should be used instead of re-predicting
+    def no_model(*args, **kwargs):
+        raise AssertionError('Model should not be loaded')
+    monkeypatch.setattr(io, 'load_trained_model', no_model)
+    monkeypatch.setattr(io, '_reco_energy_models', {})
+    df_subset = df.iloc[::-3]
+    np.testing.assert_array_equal(
+        io.get_reco_log_energy(df_subset, df_file=df_file),
+        reco_log_energy[::-3])
+
+
+def test_reco_energy_models_concurrent_configs(df_file, energy_model_file,
+                                               tmpdir, monkeypatch):
+    import time
+    from multiprocessing.pool import ThreadPool
+    from sklearn.externals import joblib
+    from comptools import io
+
+    # Second config with a different energy model
+    model_dict = joblib.load(energy_model_file)
+    model_dict['pipeline'].named_steps['classifier'].intercept_ += 1
+    other_model_file = str(tmpdir.join('RF_energy_IC86.2013.pkl'))
+    joblib.dump(model_dict, other_model_file)
+    model_files = {'RF_energy_IC86.2012': energy_model_file,
+                   'RF_energy_IC86.2013': other_model_file}
+    monkeypatch.setattr(io, '_get_model_file', lambda name: model_files[name])
+
+    n_loads = {}
+    load_trained_model = io.load_trained_model
+
+    def slow_load_trained_model(pipeline_str, return_metadata=False):
+        n_loads[pipeline_str] = n_loads.get(pipeline_str, 0) + 1
+        time.sleep(0.05)
+        return load_trained_model(pipeline_str,
+                                  return_metadata=return_metadata)
+    monkeypatch.setattr(io, 'load_trained_model', slow_load_trained_model)
+    monkeypatch.setattr(io, '_reco_energy_models', {})
+
+    df = pd.read_hdf(df_file, 'dataframe')
+    configs = ['IC86.2012', 'IC86.2013'] * 4
+    pool = ThreadPool(len(configs))
+    try:
+        results = pool.map(lambda config: io.get_reco_log_energy(
+            df, config=config, use_cache=False), configs)
+    finally:
+        pool.close()
+        pool.join()
+
+    expected = df['log_s125'] + df['log_dEdX']
+    for config, reco_log_energy in zip(configs, results):
+        offset = 1 if config == 'IC86.2013' else 0
+        np.testing.assert_allclose(reco_log_energy, expected + offset)
+    assert n_loads == {'RF_energy_IC86.2012': 1, 'RF_energy_IC86.2013': 1}
+
+
+def test_stale_reco_energy_sidecar(df_file, energy_model_file, monkeypatch):
+    from comptools import io
+
+    monkeypatch.setattr(io, '_get_model_file', lambda name: energy_model_file)
+    df = pd.read_hdf(df_file, 'dataframe')
+    reco_energy_file = io.get_reco_energy_file(df_file)
+    key = io._get_reco_energy_key('RF_energy')
+    io._store_reco_log_energy(df_file, key, pd.Series(0.5, index=df.index))
+    # Make the sidecar older than df_file
+    mtime = os.path.getmtime(df_file) - 10
+    os.utime(reco_energy_file, (mtime, mtime))
+
+    # Readers ignore, but don't remove, stale sidecar files
+    stored = io._read_stored_reco_log_energy(df_file, key)
+    assert stored is None
+    assert os.path.exists(reco_energy_file)
+
+    # Writers replace them
+    io._store_reco_log_energy(df_file, key, pd.Series(1.5, index=df.index[:5]))
+    stored = io._read_stored_reco_log_energy(df_file, key)
+    pd.testing.assert_series_equal(stored, pd.Series(1.5, index=df.index[:5]))
+
+
+def test_dataframe_cache_reco_energy_cut(df_file, energy_model_file,
+                                         monkeypatch):
+    pytest.importorskip('pyarrow')
+    from comptools import io
+
+    monkeypatch.setattr(io, '_get_model_file', lambda name: energy_model_file)
+    monkeypatch.setattr(io, '_reco_energy_models', {})
+    io.save_dataframe_cache(df_file)
+    df_cache = io._load_basic_dataframe(df_file=df_file, energy_reco=True,
+                                        energy_cut_key='reco_energy',
+                                        log_energy_min=0.5, log_energy_max=2.0)
+
+    # The cut is applied after reconstruction, not while reading the cache
+    df = pd.read_hdf(df_file, 'dataframe')
+    reco_energy = 10**(df['log_s125'] + df['log_dEdX'])
+    energy_mask = (reco_energy > 0.5) & (reco_energy < 2.0)
+    assert 0 < energy_mask.sum() < len(df)
+    pd.testing.assert_index_equal(df_cache.index, df.index[energy_mask])
+    np.testing.assert_allclose(df_cache['reco_energy'],
+                               reco_energy[energy_mask])
+
+
+def test_iter_sim_energy_reco_columns(df_file, energy_model_file, monkeypatch):
+    pytest.importorskip('pyarrow')
+    from comptools import io
+
+    monkeypatch.setattr(io, '_get_model_file', lambda name: energy_model_file)
+    df = pd.read_hdf(df_file, 'dataframe')
+    quality_columns = ['passed_IceTopQualityCuts', 'passed_InIceQualityCuts',
+                       'FractionContainment_Laputop_InIce']
+    for column in quality_columns:
+        df[column] = True
+    df['FractionContainment_Laputop_InIce'] = 0.5
+    df['NStations'] = 10
+    df['NChannels_1_60'] = 10
+    df['max_qfrac_1_60'] = 0.1
+    df['eloss_1500_standard'] = 1.0
+    df.to_hdf(df_file, key='dataframe', format='table', data_columns=True)
+    reco_log_energy = df['log_s125'] + df['log_dEdX']
+
+    # Energy model features and quality cut columns are read, but not
+    # returned, when only a few columns are requested
+    df_iter = pd.concat(io.iter_sim(df_file=df_file, columns=['lap_log_energy'],
+                                    chunksize=100, quality_cuts=True,
+                                    energy_cut_key='lap_log_energy'))
+    energy_mask = (df['lap_log_energy'] > 6.0) & (df['lap_log_energy'] < 8.0)
+    assert list(df_iter.columns) == ['lap_log_energy', 'reco_log_energy',
+                                     'reco_energy']
+    np.testing.assert_allclose(df_iter['reco_log_energy'],
+                               reco_log_energy[energy_mask])
+
+    # Energies predicted for each chunk are stored
+    stored = io._read_stored_reco_log_energy(
+        df_file, io._get_reco_energy_key('RF_energy'))
+    np.testing.assert_allclose(stored.loc[df.index], reco_log_energy)
+
+    io.save_dataframe_cache(df_file)
+    df_cache = io._load_basic_dataframe(df_file=df_file,
+                                        columns=['lap_log_energy'],
+                                        energy_cut_key='lap_log_energy',
+                                        log_energy_min=6.0,
+                                        log_energy_max=8.0)
+    pd.testing.assert_frame_equal(df_cache, df_iter)
+
+
+def test_filter_partition_reco_energy_cut(df_file, energy_model_file,
+                                          monkeypatch):
+    from comptools import io
+
+    monkeypatch.setattr(io, '_get_model_file', lambda name: energy_model_file)
+    df = pd.read_hdf(df_file, 'dataframe')
+    key = io._get_reco_energy_key('RF_energy')
+    io._store_reco_log_energy(df_file, key, pd.Series(0.5, index=df.index[:10]))
+    df_filtered, predicted = io._filter_partition(
+        df, columns=['lap_log_energy'], energy_cut_key='reco_log_energy',
+        log_energy_min=0.0, log_energy_max=1.0, df_file=df_file,
+        pipeline_str='RF_energy', key=key)
+
+    reco_log_energy = np.array(df['log_s125'] + df['log_dEdX'])
+    reco_log_energy[:10] = 0.5
+    energy_mask = (reco_log_energy > 0.0) & (reco_log_energy < 1.0)
+    assert list(df_filtered.columns) == ['lap_log_energy', 'reco_log_energy',
+                                         'reco_energy']
+    np.testing.assert_array_equal(df_filtered.index, df.index[energy_mask])
+    np.testing.assert_allclose(df_filtered['reco_log_energy'],
+                               reco_log_energy[energy_mask])
+    # All predicted energies are returned, even for events that are cut
+    np.testing.assert_array_equal(predicted.index, df.index[10:])
+    np.testing.assert_allclose(predicted, reco_log_energy[10:])
+
+
+def test_filter_partition_stored_energy_cut(df_file, energy_model_file,
+                                            monkeypatch):
+    from comptools import io
+
+    monkeypatch.setattr(io, '_get_model_file', lambda name: energy_model_file)
+    df = pd.read_hdf(df_file, 'dataframe')
+    df_filtered, predicted = io._filter_partition(
+        df, columns=['lap_log_energy'], energy_cut_key='lap_log_energy',
+        log_energy_min=6.0, log_energy_max=8.0, df_file=df_file,
+        pipeline_str='RF_energy', key=io._get_reco_energy_key('RF_energy'))
+
+    # Only events passing cuts on stored columns are predicted
+    energy_mask = (df['lap_log_energy'] > 6.0) & (df['lap_log_energy'] < 8.0)
+    np.testing.assert_array_equal(df_filtered.index, df.index[energy_mask])
+    np.testing.assert_array_equal(predicted.index, df.index[energy_mask])
+
+
+@pytest.mark.parametrize('use_cache', [True, False])
+def test_iter_sim_chunks(df_file, use_cache):
+    if use_cache:
+        pytest.importorskip('pyarrow')
+        from comptools.io import save_dataframe_cache
+        save_dataframe_cache(df_file, chunksize=300)
+    from comptools.io import iter_sim
+
+    chunksize = 100
+    chunks = list(iter_sim(df_file=df_file, columns=['lap_log_energy'],
+                           chunksize=chunksize, energy_reco=False,
+                           energy_cut_key='lap_log_energy',
+                           log_energy_min=6.0, log_energy_max=8.0,
+                           use_cache=use_cache))
+
+    df = pd.read_hdf(df_file, 'dataframe', columns=['lap_log_energy'])
+    energy_mask = (df['lap_log_energy'] > 6.0) & (df['lap_log_energy'] < 8.0)
+    assert all(0 < len(chunk) <= chunksize for chunk in chunks)
+    pd.testing.assert_frame_equal(pd.concat(chunks), df.loc[energy_mask, :])
+
+
+def test_dataframe_to_X_y_aligned():
+    from comptools.io import dataframe_to_X_y
+
+    df = pd.DataFrame({'feature_1': [1.0, np.nan, 3.0, 4.0, 5.0],
+                       'feature_2': [1.0, 2.0, np.inf, 4.0, 5.0],
+                       'target': [0, 1, 0, 1, np.nan]},
+                      index=['a', 'b', 'c', 'd', 'e'])
+    X, y, index = dataframe_to_X_y(df, ['feature_1', 'feature_2'],
+                                   target='target', dtype=np.float32,
+                                   return_index=True)
+
+    assert X.dtype == np.float32
+    np.testing.assert_array_equal(X, [[1, 1], [4, 4]])
+    np.testing.assert_array_equal(y, [0, 1])
+    assert list(index) == ['a', 'd']
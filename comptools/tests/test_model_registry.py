@@ -0,0 +1,104 @@
+import os
+import pytest
+import numpy as np
+from sklearn.pipeline import Pipeline
+from sklearn.tree import DecisionTreeClassifier
+from comptools.model_registry import fit_or_load, evict_models, get_model_key
+from comptools.pipelines import get_pipeline
+
+
+pipeline_str = 'HistBDT_comp_IC86.2012_2-groups'
+
+
+def get_X_y(seed=2):
+    np.random.seed(seed)
+    X = np.random.normal(size=(500, 3))
+    y = (X[:, 0] > 0).astype(int)
+    return X, y
+
+
+def test_fit_or_load(tmpdir):
+    registry_dir = str(tmpdir)
+    X, y = get_X_y()
+    model_dict = fit_or_load(pipeline_str, X, y, feature_list=['a', 'b', 'c'],
+                             split_seed=2, registry_dir=registry_dir,
+                             return_metadata=True)
+    assert len(os.listdir(registry_dir)) == 1
+    assert model_dict['training_features'] == ('a', 'b', 'c')
+
+    # Second call loads the stored model
+    cached_dict = fit_or_load(pipeline_str, X, y, feature_list=['a', 'b', 'c'],
+                              split_seed=2, registry_dir=registry_dir,
+                              return_metadata=True)
+    assert cached_dict['key'] == model_dict['key']
+    np.testing.assert_array_equal(cached_dict['pipeline'].predict(X),
+                                  model_dict['pipeline'].predict(X))
+
+    # Changing the hyperparameters, data, or split seed trains a new model
+    fit_or_load(pipeline_str, X, y, feature_list=['a', 'b', 'c'],
+                params={'classifier__max_depth': 2}, split_seed=2,
+                registry_dir=registry_dir)
+    fit_or_load(pipeline_str, X, y, feature_list=['a', 'b', 'c'],
+                split_seed=3, registry_dir=registry_dir)
+    X_2, y_2 = get_X_y(seed=3)
+    fit_or_load(pipeline_str, X_2, y_2, feature_list=['a', 'b', 'c'],
+                split_seed=2, registry_dir=registry_dir)
+    assert len(os.listdir(registry_dir)) == 4
+
+
+def test_get_model_key_sample_weight():
+    X, y = get_X_y()
+    pipeline = get_pipeline(pipeline_str)
+    key = get_model_key(pipeline, X, y)
+    assert key == get_model_key(get_pipeline(pipeline_str), X.copy(), y)
+    sample_weight = np.ones(len(y))
+    assert key != get_model_key(
+        pipeline, X, y, fit_params={'classifier__sample_weight': sample_weight})
+    assert key != get_model_key(pipeline, X, y, feature_list=['a', 'b', 'c'])
+
+
+def test_evict_models(tmpdir):
+    registry_dir = str(tmpdir)
+    X, y = get_X_y()
+    for split_seed in range(3):
+        fit_or_load(pipeline_str, X, y, split_seed=split_seed,
+                    registry_dir=registry_dir)
+    model_files = sorted(os.listdir(registry_dir))
+    # Make the first entry the least recently used
+    now = os.path.getmtime(os.path.join(registry_dir, model_files[0]))
+    for idx, model_file in enumerate(model_files):
+        os.utime(os.path.join(registry_dir, model_file),
+                 (now + idx, now + idx))
+    stale_file = tmpdir.join('{}_sklearn-0.0_0000.pkl'.format(pipeline_str))
+    stale_file.write('')
+
+    removed = evict_models(registry_dir=registry_dir, max_entries=2)
+    assert removed == [os.path.join(registry_dir, model_files[0])]
+    # Entries of other scikit-learn versions are left alone
+    assert sorted(os.listdir(registry_dir)) == sorted(model_files[1:] +
+                                                      [stale_file.basename])
+
+    # fit_or_load evicts old entries of its pipeline when adding a new one
+    other_pipeline_str = 'HistBDT_comp_IC86.2012_4-groups'
+    fit_or_load(other_pipeline_str, X, y, registry_dir=registry_dir)
+    fit_or_load(pipeline_str, X, y, split_seed=3, registry_dir=registry_dir,
+                max_entries=1)
+    model_files = os.listdir(registry_dir)
+    assert len(model_files) == 3
+    assert stale_file.basename in model_files
+    assert any(f.startswith(other_pipeline_str + '_') for f in model_files)
+
+
+def test_get_model_key_params():
+    X, y = get_X_y()
+    pipeline = get_pipeline(pipeline_str)
+    key = get_model_key(pipeline.set_params(classifier__max_depth=3), X, y)
+    # Equal values of different types give the same key
+    assert key == get_model_key(
+        get_pipeline(pipeline_str).set_params(
+            classifier__max_depth=np.int64(3)), X, y)
+
+    pipeline = Pipeline([('classifier', DecisionTreeClassifier(
+        random_state=np.random.RandomState(2)))])
+    with pytest.raises(TypeError):
+        get_model_key(pipeline, X, y)
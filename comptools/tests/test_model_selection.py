@@ -0,0 +1,134 @@
+import os
+import pytest
+import numpy as np
+from sklearn.pipeline import Pipeline
+from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.tree import DecisionTreeClassifier
+from comptools.model_selection import (SuccessiveHalvingSearchCV,
+                                        supports_staged_predict)
+
+
+@pytest.fixture
+def X_y():
+    np.random.seed(2)
+    n_samples = 2000
+    X = np.random.normal(size=(n_samples, 2))
+    y = (X[:, 0] + X[:, 1] ** 2 > 1).astype(int)
+    return X, y
+
+
+def test_successive_halving_n_samples(X_y):
+    X, y = X_y
+    pipeline = Pipeline([('classifier',
+                          DecisionTreeClassifier(random_state=2))])
+    param_grid = {'classifier__max_depth': list(range(1, 10)),
+                  'classifier__min_samples_leaf': [1, 20, 50]}
+    search = SuccessiveHalvingSearchCV(pipeline, param_grid, factor=3, cv=3)
+    search.fit(X, y)
+
+    n_resources = search.cv_results_['n_resources']
+    iterations = search.cv_results_['iter']
+    # 27 candidates are reduced to 9, 3, and 1
+    assert search.n_iterations_ == 4
+    assert [np.sum(iterations == i) for i in range(4)] == [27, 9, 3, 1]
+    assert n_resources[-1] == len(X)
+    assert np.all(np.diff(n_resources) >= 0)
+    assert search.best_params_['classifier__max_depth'] > 1
+    assert search.best_estimator_.score(X, y) > 0.9
+    np.testing.assert_array_equal(search.predict(X),
+                                  search.best_estimator_.predict(X))
+
+
+def test_successive_halving_n_estimators(X_y):
+    X, y = X_y
+    pipeline = Pipeline([('classifier',
+                          GradientBoostingClassifier(random_state=2))])
+    param_grid = {'classifier__n_estimators': [10, 30, 90],
+                  'classifier__max_depth': [1, 2, 3],
+                  'classifier__learning_rate': [0.1, 0.5, 1.0]}
+    search = SuccessiveHalvingSearchCV(pipeline, param_grid,
+                                       resource='classifier__n_estimators',
+                                       cv=3)
+    search.fit(X, y)
+
+    assert set(search.cv_results_['n_resources']) == {10, 30, 90}
+    assert search.best_params_['classifier__n_estimators'] == 90
+    assert search.best_estimator_.named_steps['classifier'].n_estimators == 90
+
+
+def test_successive_halving_invalid_resource_fail(X_y):
+    X, y = X_y
+    pipeline = Pipeline([('classifier',
+                          DecisionTreeClassifier(random_state=2))])
+    search = SuccessiveHalvingSearchCV(pipeline,
+                                       {'classifier__max_depth': [1, 2]},
+                                       resource='classifier__n_estimators')
+    with pytest.raises(ValueError):
+        search.fit(X, y)
+
+
+def test_stratified_subsample_rare_class(X_y):
+    from comptools.model_selection import _stratified_subsample
+
+    X, y = X_y
+    # Few enough events of one class that an unstratified subsample would
+    # leave some folds without any
+    y = y.copy()
+    y[np.flatnonzero(y == 1)[20:]] = 0
+    permutation = np.random.RandomState(2).permutation(len(y))
+    small_index = _stratified_subsample(y, 200, permutation, min_per_class=10)
+    large_index = _stratified_subsample(y, 600, permutation, min_per_class=10)
+
+    assert np.bincount(y[small_index]).min() >= 10
+    assert abs(len(small_index) - 200) <= 10
+    # Larger subsamples contain the smaller ones
+    assert set(small_index) <= set(large_index)
+
+
+def test_successive_halving_early_stopping(X_y):
+    xgboost = pytest.importorskip('xgboost')
+    X, y = X_y
+    pipeline = Pipeline([('classifier',
+                          xgboost.XGBClassifier(n_estimators=500,
+                                                learning_rate=0.5))])
+    param_grid = {'classifier__max_depth': [1, 2, 3]}
+    search = SuccessiveHalvingSearchCV(pipeline, param_grid, cv=3,
+                                       early_stopping_rounds=5)
+    search.fit(X, y)
+
+    booster = search.best_estimator_.named_steps['classifier'].get_booster()
+    assert booster.num_boosted_rounds() < 500
+
+
+def test_successive_halving_early_stopping_fail(X_y):
+    X, y = X_y
+    pipeline = Pipeline([('classifier',
+                          DecisionTreeClassifier(random_state=2))])
+    search = SuccessiveHalvingSearchCV(pipeline,
+                                       {'classifier__max_depth': [1, 2]},
+                                       early_stopping_rounds=5)
+    with pytest.raises(ValueError):
+        search.fit(X, y)
+
+
+def test_supports_staged_predict():
+    assert supports_staged_predict(GradientBoostingClassifier())
+    assert not supports_staged_predict(DecisionTreeClassifier())
+    xgboost = pytest.importorskip('xgboost')
+    assert supports_staged_predict(xgboost.XGBClassifier())
+
+
+@pytest.mark.parametrize('processes', [True, False])
+def test_fold_data(X_y, processes):
+    from comptools.model_selection import (_dump_fold_data, _load_fold_data,
+                                           _remove_fold_data)
+
+    X, y = X_y
+    data_file = _dump_fold_data({'X': X, 'y': y}, processes=processes)
+    # Only process-based schedulers need the arrays in a file
+    assert os.path.exists(data_file) == processes
+    data = _load_fold_data(data_file)
+    np.testing.assert_array_equal(data['X'], X)
+    np.testing.assert_array_equal(data['y'], y)
+    _remove_fold_data(data_file)
+    assert not os.path.exists(data_file)
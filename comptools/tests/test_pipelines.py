@@ -0,0 +1,101 @@
+import pytest
+import numpy as np
+import xgboost
+from comptools.pipelines import (get_pipeline, get_hist_dmatrix, fit_hist_bdt,
+                                 line, LineCutClassifier)
+
+
+@pytest.fixture
+def X():
+    np.random.seed(2)
+    X = np.random.normal(size=(1000, 3))
+    X[::100, 1] = np.nan
+    return X
+
+
+@pytest.mark.parametrize('pipeline_str', ['HistBDT_comp_IC86.2012_2-groups',
+                                          'HistBDT_comp_IC86.2012_4-groups',
+                                          'HistBDT_energy_IC86.2012'])
+def test_hist_bdt(X, pipeline_str):
+    y = (np.nan_to_num(X[:, 0]) > 0).astype(int)
+    if pipeline_str.endswith('4-groups'):
+        y = np.digitize(X[:, 0], [-0.5, 0, 0.5])
+    elif 'energy' in pipeline_str:
+        y = X[:, 0] + 6
+
+    # Features are binned by xgboost, so the same (unbinned) features are
+    # used for fitting and predicting
+    pipeline = get_pipeline(pipeline_str).fit(X, y)
+    classifier = pipeline.named_steps['classifier']
+    assert classifier.get_params()['tree_method'] == 'hist'
+    if 'energy' in pipeline_str:
+        assert np.corrcoef(pipeline.predict(X), y)[0, 1] > 0.95
+    else:
+        assert np.mean(pipeline.predict(X) == y) > 0.9
+
+
+@pytest.mark.parametrize('pipeline_str', ['HistBDT_comp_IC86.2012_2-groups',
+                                          'HistBDT_comp_IC86.2012_4-groups',
+                                          'HistBDT_energy_IC86.2012'])
+def test_fit_hist_bdt(X, pipeline_str):
+    y = (np.nan_to_num(X[:, 0]) > 0).astype(int)
+    if pipeline_str.endswith('4-groups'):
+        y = np.digitize(X[:, 0], [-0.5, 0, 0.5])
+    elif 'energy' in pipeline_str:
+        y = X[:, 0] + 6
+
+    # Boosters trained on binned features match the pipeline
+    dtrain = get_hist_dmatrix(X, y)
+    dtest = get_hist_dmatrix(X, ref=dtrain)
+    for max_depth in [2, 3]:
+        pipeline = get_pipeline(pipeline_str)
+        pipeline.named_steps['classifier'].set_params(max_depth=max_depth)
+        pipeline.fit(X, y)
+        booster = fit_hist_bdt(pipeline_str, dtrain, max_depth=max_depth)
+        if 'energy' in pipeline_str:
+            expected = pipeline.predict(X)
+        elif pipeline_str.endswith('2-groups'):
+            expected = pipeline.predict_proba(X)[:, 1]
+        else:
+            expected = pipeline.predict_proba(X)
+        np.testing.assert_allclose(booster.predict(dtest), expected,
+                                   atol=1e-5)
+
+
+def test_fit_hist_bdt_fail(X):
+    y = (np.nan_to_num(X[:, 0]) > 0).astype(int)
+    with pytest.raises(ValueError):
+        fit_hist_bdt('BDT_comp_IC86.2012_2-groups', get_hist_dmatrix(X, y))
+    # Features binned differently can't be used
+    with pytest.raises(xgboost.core.XGBoostError):
+        fit_hist_bdt('HistBDT_comp_IC86.2012_2-groups',
+                     get_hist_dmatrix(X, y, max_bin=16))
+
+
+def test_linecut_classifier_predict():
+    np.random.seed(2)
+    X = np.column_stack([np.random.normal(size=1000),
+                         np.random.uniform(-1, 3, 1000),
+                         np.random.uniform(0, 3, 1000)])
+    # Events exactly on the oxygen boundary
+    X[:100, 2] = line(X[:100, 1], 0, 0.9, 2, 2.4)
+    classifier = LineCutClassifier().fit(X[:8], np.arange(8) % 4)
+
+    expected = []
+    for log_s125, log_dEdX in X[:, (1, 2)]:
+        if log_dEdX <= line(log_s125, 0, 0.75, 2, 2.3):
+            expected.append(0)
+        elif log_dEdX <= line(log_s125, 0, 0.9, 2, 2.4):
+            expected.append(1)
+        elif log_dEdX <= line(log_s125, 0, 1.1, 2, 2.5):
+            expected.append(2)
+        else:
+            expected.append(3)
+    np.testing.assert_array_equal(classifier.predict(X), expected)
+
+    # Arbitrary number of boundaries
+    boundaries = [(0, 1, 2, 1), (0, 2, 2, 2)]
+    classifier = LineCutClassifier(boundaries=boundaries).fit(
+        X[:6], np.arange(6) % 3)
+    np.testing.assert_array_equal(classifier.predict(X),
+                                  np.digitize(X[:, 2], [1, 2], right=True))
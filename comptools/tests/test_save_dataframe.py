@@ -0,0 +1,84 @@
+import os
+import sys
+import pytest
+import numpy as np
+import pandas as pd
+from comptools.event_keys import encode_event_keys
+from comptools.bitmap_index import QUALITY_CUTS_COLUMN, read_bitmap_index
+
+# processing/ holds scripts, not a package
+processing_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir,
+                              'processing')
+sys.path.insert(0, os.path.abspath(processing_dir))
+save_dataframe = pytest.importorskip('save_dataframe')
+
+
+def process_i3_hdf_file(input_file, config, datatype):
+    # One run of events per input file
+    run = int(os.path.basename(input_file).split('_')[1])
+    n_events = 10 * run
+    np.random.seed(run)
+    df = pd.DataFrame({'lap_log_energy': np.random.uniform(5, 9, n_events),
+                       'passed_IceTopQualityCuts': np.random.randint(
+                           0, 2, n_events).astype(bool),
+                       QUALITY_CUTS_COLUMN: np.random.randint(
+                           0, 2**10, n_events).astype(np.uint16)})
+    df.index = encode_event_keys(config, np.full(n_events, run),
+                                 np.arange(n_events), np.zeros(n_events))
+    return df
+
+
+@pytest.fixture
+def input_files(tmpdir, monkeypatch):
+    monkeypatch.setattr(save_dataframe, 'process_i3_hdf_file',
+                        process_i3_hdf_file)
+    input_files = []
+    for run in range(1, 4):
+        input_file = str(tmpdir.join('run_{}_.hdf5'.format(run)))
+        with open(input_file, 'w') as f_obj:
+            f_obj.write(str(run))
+        input_files.append(input_file)
+
+    return input_files
+
+
+def test_incremental_matches_full_rebuild(tmpdir, input_files):
+    incremental_file = str(tmpdir.join('incremental_dataframe.hdf5'))
+    records = save_dataframe.write_dataframe_file(incremental_file,
+                                                  input_files[:2],
+                                                  datatype='data')
+    records = save_dataframe.write_dataframe_file(incremental_file,
+                                                  input_files,
+                                                  datatype='data',
+                                                  records=records)
+    full_file = str(tmpdir.join('full_dataframe.hdf5'))
+    full_records = save_dataframe.write_dataframe_file(full_file, input_files,
+                                                       datatype='data')
+
+    assert records == full_records
+    pd.testing.assert_frame_equal(pd.read_hdf(incremental_file, 'dataframe'),
+                                  pd.read_hdf(full_file, 'dataframe'))
+    bitmap_index, n_rows = read_bitmap_index(incremental_file)
+    full_bitmap_index, full_n_rows = read_bitmap_index(full_file)
+    assert n_rows == full_n_rows
+    assert list(bitmap_index) == list(full_bitmap_index)
+    for key in bitmap_index:
+        np.testing.assert_array_equal(bitmap_index[key],
+                                      full_bitmap_index[key])
+
+
+def test_append_different_schema_fail(tmpdir, input_files, monkeypatch):
+    outfile = str(tmpdir.join('dataframe.hdf5'))
+    records = save_dataframe.write_dataframe_file(outfile, input_files[:2],
+                                                  datatype='data')
+
+    def process_other_schema(input_file, config, datatype):
+        df = process_i3_hdf_file(input_file, config, datatype)
+        df['passed_IceTopQualityCuts'] = df['lap_log_energy']
+        return df
+    monkeypatch.setattr(save_dataframe, 'process_i3_hdf_file',
+                        process_other_schema)
+    with pytest.raises(ValueError) as excinfo:
+        save_dataframe.write_dataframe_file(outfile, input_files,
+                                            datatype='data', records=records)
+    assert 'schema' in str(excinfo.value)
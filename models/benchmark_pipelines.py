@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+from __future__ import division, print_function
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from sklearn.metrics import accuracy_score
+
+import comptools as comp
+
+
+def time_pipeline(pipeline_str, X_train, y_train, X_test, n_repeats=3):
+    '''Returns the training time and prediction latencies of a pipeline
+    '''
+    pipeline = comp.get_pipeline(pipeline_str)
+    try:
+        pipeline.named_steps['classifier'].set_params(n_jobs=1)
+    except ValueError:
+        pass
+
+    start = time.time()
+    pipeline.fit(X_train, y_train)
+    fit_time = time.time() - start
+
+    # Best of several repeats for prediction timings
+    predict_times, event_times = [], []
+    for _ in range(n_repeats):
+        start = time.time()
+        y_pred = pipeline.predict(X_test)
+        predict_times.append(time.time() - start)
+        start = time.time()
+        pipeline.predict(X_test[:1])
+        event_times.append(time.time() - start)
+
+    return {'pipeline': pipeline_str,
+            'fit_time [s]': fit_time,
+            'predict_time [s]': min(predict_times),
+            'single_event_latency [ms]': 1e3 * min(event_times)}, y_pred
+
+
+def time_hist_bdt_sweep(pipeline_str, X_train, y_train, max_depths):
+    '''Returns the training time of a max_depth sweep of a HistBDT pipeline
+
+    The sweep is trained both by fitting the pipeline for each value,
+    which bins the features in every fit, and by binning the features
+    once and reusing them for every value (see comp.fit_hist_bdt).
+    '''
+    start = time.time()
+    for max_depth in max_depths:
+        pipeline = comp.get_pipeline(pipeline_str)
+        pipeline.named_steps['classifier'].set_params(max_depth=max_depth,
+                                                      n_jobs=1)
+        pipeline.fit(X_train, y_train)
+    refit_time = time.time() - start
+
+    start = time.time()
+    dtrain = comp.get_hist_dmatrix(X_train, y_train)
+    for max_depth in max_depths:
+        comp.fit_hist_bdt(pipeline_str, dtrain, max_depth=max_depth,
+                          n_jobs=1)
+    reuse_time = time.time() - start
+
+    return {'pipeline': pipeline_str,
+            'refit_time [s]': refit_time,
+            'binned_once_time [s]': reuse_time}
+
+
+if __name__ == '__main__':
+
+    description = ('Benchmarks training time and prediction latency of the '
+                   'histogram-binned boosting pipelines against the '
+                   'current composition and energy models')
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-c', '--config', dest='config',
+                        default='IC86.2012',
+                        choices=comp.simfunctions.get_sim_configs(),
+                        help='Detector configuration')
+    parser.add_argument('--num_groups', dest='num_groups', type=int,
+                        default=4, choices=[2, 3, 4],
+                        help='Number of composition groups')
+    parser.add_argument('--n_events', dest='n_events', type=int,
+                        default=None,
+                        help='Number of training events to use (default is '
+                             'all of them)')
+    args = parser.parse_args()
+
+    feature_list, _ = comp.get_training_features()
+    target = 'comp_target_{}'.format(args.num_groups)
+    df_sim_train, df_sim_test = comp.load_sim(config=args.config,
+                                              energy_reco=False,
+                                              log_energy_min=None,
+                                              log_energy_max=None,
+                                              test_size=0.5)
+    if args.n_events is not None:
+        df_sim_train = df_sim_train.iloc[:args.n_events]
+    X_train, y_train = comp.dataframe_to_X_y(df_sim_train, feature_list,
+                                             target=target)
+    X_test, y_test = comp.dataframe_to_X_y(df_sim_test, feature_list,
+                                           target=target)
+    X_train_energy, y_train_energy = comp.dataframe_to_X_y(
+        df_sim_train, feature_list, target='MC_log_energy')
+    X_test_energy, y_test_energy = comp.dataframe_to_X_y(
+        df_sim_test, feature_list, target='MC_log_energy')
+    print('Training on {} events, testing on {} events'.format(len(X_train),
+                                                               len(X_test)))
+
+    results = []
+    comp_pipelines = ['BDT_comp_{}_{}-groups', 'HistBDT_comp_{}_{}-groups']
+    for pipeline_str in comp_pipelines:
+        pipeline_str = pipeline_str.format(args.config, args.num_groups)
+        result, y_pred = time_pipeline(pipeline_str, X_train, y_train, X_test)
+        result['accuracy'] = accuracy_score(y_test, y_pred)
+        results.append(result)
+
+    for pipeline_str in ['RF_energy_{}', 'HistBDT_energy_{}']:
+        pipeline_str = pipeline_str.format(args.config)
+        result, y_pred = time_pipeline(pipeline_str, X_train_energy,
+                                       y_train_energy, X_test_energy)
+        result['energy_resolution'] = np.std(y_pred - y_test_energy)
+        results.append(result)
+
+    df_results = pd.DataFrame.from_records(results, index='pipeline')
+    print(df_results.to_string(float_format='{:0.4g}'.format))
+
+    # Hyperparameter sweeps can reuse the binned training features
+    max_depths = [2, 3, 4, 5]
+    print('\nTraining time of a max_depth sweep over {}'.format(max_depths))
+    comp_pipeline_str = 'HistBDT_comp_{}_{}-groups'.format(args.config,
+                                                           args.num_groups)
+    energy_pipeline_str = 'HistBDT_energy_{}'.format(args.config)
+    sweeps = [time_hist_bdt_sweep(comp_pipeline_str, X_train, y_train,
+                                  max_depths),
+              time_hist_bdt_sweep(energy_pipeline_str, X_train_energy,
+                                  y_train_energy, max_depths)]
+    df_sweeps = pd.DataFrame.from_records(sweeps, index='pipeline')
+    print(df_sweeps.to_string(float_format='{:0.4g}'.format))
@@ -30,6 +30,10 @@ if __name__ == '__main__':
                         default=False,
                         help=('Perform a grid search to find optimal '
                               'hyperparameter values.'))
+    parser.add_argument('--search', dest='search',
+                        default='grid', choices=['grid', 'halving'],
+                        help=('Hyperparameter search strategy. Ignored if '
+                              'gridsearch=False.'))
     parser.add_argument('--n_jobs', dest='n_jobs', type=int,
                         default=1, choices=list(range(1, 21)),
                         help='Number of jobs to run in parallel for the '
@@ -65,9 +69,12 @@ if __name__ == '__main__':
         pipeline = comp.gridsearch_optimize(pipeline=pipeline,
                                             param_grid=param_grid,
                                             X_train=X_train,
-                                            y_train=y_train)
+                                            y_train=y_train,
+                                            search=args.search)
     else:
-        pipeline.fit(X_train, y_train)
+        pipeline = comp.fit_or_load(pipeline_str, X_train, y_train,
+                                    feature_list=feature_list, split_seed=2,
+                                    verbose=True)
 
     # Construct dictionary containing fitted pipeline along with metadata
     # For information on why this metadata is needed see:
@@ -59,6 +59,12 @@ if __name__ == "__main__":
                                               test_size=0.5,
                                               verbose=True)
 
+    # Boosting pipelines can score an n_estimators sweep from the staged
+    # predictions of a single fit per fold
+    classifier = comp.get_pipeline(pipeline_str).named_steps['classifier']
+    staged = (args.param_name == 'n_estimators' and
+              comp.supports_staged_predict(classifier))
+
     # Calculate CV scores for each composition
     params = np.asarray(args.param_values).astype(args.param_type)
     df_cv = comp.cross_validate_comp(
@@ -68,7 +74,8 @@ if __name__ == "__main__":
                             target='comp_target_{}'.format(args.num_groups),
                             scoring=zero_one_loss, num_groups=args.num_groups,
                             n_splits=args.cv, verbose=True,
-                            n_jobs=min(len(params), 15))
+                            n_jobs=min(len(params), 15),
+                            staged=staged)
 
     # Plot validation curve for hyperparameter
     fig, ax = plt.subplots()
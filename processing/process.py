@@ -21,7 +21,10 @@ if 'cvmfs' not in os.getenv('ROOTSYS'):
     raise ComputingEnvironemtError('CVMFS ROOT must be used for i3 file processing')
 
 
-def gen_sim_jobs(save_hdf5_ex, save_df_ex, save_efficiencies_ex, config, sims, n=1000, testing=False):
+def gen_sim_jobs(save_hdf5_ex, save_df_ex, save_efficiencies_ex, config, sims, n=1000,
+                 df_batch_size=None, df_merge_batch_size=None, df_n_jobs=1,
+                 testing=False, error=None, output=None, log=None,
+                 submit=None):
     """Yields pycondor Jobs for simulation processing
 
     Parameters
@@ -36,8 +39,20 @@ def gen_sim_jobs(save_hdf5_ex, save_df_ex, save_efficiencies_ex, config, sims, n
         Iterable of detector configurations.
     n : int, optional
         Batch size (default is 1000).
+    df_batch_size : int, optional
+        Number of hdf5 files converted by each save_dataframe.py process
+        before the partial DataFrames are merged (default is None, all
+        files are converted by a single process).
+    df_merge_batch_size : int, optional
+        Maximum number of partial DataFrame files merged by each merge
+        process (default is None, all partial files are merged at once).
+    df_n_jobs : int, optional
+        Number of worker processes used by save_dataframe.py (default is 1).
     testing : bool, optional
         Option to run in testing mode (default is False).
+    error, output, log, submit : str, optional
+        pycondor Job error, output, log, and submit directories
+        (default is None).
 
     Yields
     ------
@@ -102,21 +117,28 @@ def gen_sim_jobs(save_hdf5_ex, save_df_ex, save_efficiencies_ex, config, sims, n
     df_outfile = os.path.join(comp.paths.comp_data_dir,
                               config,
                               'sim_dataframe.hdf5')
-    df_input_files_str = ' '.join(save_df_input_files)
-    df_arg = '--input {} --output {} --type sim --config {}'.format(df_input_files_str,
-                                                                    df_outfile,
-                                                                    config)
-    save_df_job.add_arg(df_arg)
+    merge_jobs = add_save_df_args(save_df_job, save_df_ex, save_df_input_files,
+                                  df_outfile, 'sim', config,
+                                  batch_size=df_batch_size,
+                                  merge_batch_size=df_merge_batch_size,
+                                  n_jobs=df_n_jobs, error=error, output=output,
+                                  log=log, submit=submit)
 
     # Job for calculating detection efficiencies based on simulation
-    efficiencies_job = get_efficiencies_jobs(save_efficiencies_ex, config=config)
-    efficiencies_job.add_parent(save_df_job)
+    efficiencies_job = get_efficiencies_jobs(save_efficiencies_ex, config=config,
+                                             error=error, output=output,
+                                             log=log, submit=submit)
+    efficiencies_job.add_parent((merge_jobs or [save_df_job])[-1])
 
     yield save_df_job
+    for merge_job in merge_jobs:
+        yield merge_job
     yield efficiencies_job
 
 
-def gen_data_jobs(save_hdf5_ex, save_df_ex, config, n=50, testing=False):
+def gen_data_jobs(save_hdf5_ex, save_df_ex, config, n=50, df_batch_size=None,
+                  df_merge_batch_size=None, df_n_jobs=1, testing=False,
+                  error=None, output=None, log=None, submit=None):
     """Yields pycondor Jobs for data processing
 
     Parameters
@@ -129,8 +151,20 @@ def gen_data_jobs(save_hdf5_ex, save_df_ex, config, n=50, testing=False):
         Detector configuration.
     n : int, optional
         Batch size (default is 50).
+    df_batch_size : int, optional
+        Number of hdf5 files converted by each save_dataframe.py process
+        before the partial DataFrames are merged (default is None, all
+        files are converted by a single process).
+    df_merge_batch_size : int, optional
+        Maximum number of partial DataFrame files merged by each merge
+        process (default is None, all partial files are merged at once).
+    df_n_jobs : int, optional
+        Number of worker processes used by save_dataframe.py (default is 1).
     testing : bool, optional
         Option to run in testing mode (default is False).
+    error, output, log, submit : str, optional
+        pycondor Job error, output, log, and submit directories
+        (default is None).
 
     Yields
     ------
@@ -187,15 +221,121 @@ def gen_data_jobs(save_hdf5_ex, save_df_ex, config, n=50, testing=False):
 
     df_outfile = os.path.join(comp.paths.comp_data_dir, config,
                               'data_dataframe.hdf5')
-    df_input_files_str = ' '.join(save_df_input_files)
-    df_arg = '--input {} --output {} --type data --config {}'.format(
-        df_input_files_str, df_outfile, config)
-    save_df_job.add_arg(df_arg)
+    merge_jobs = add_save_df_args(save_df_job, save_df_ex, save_df_input_files,
+                                  df_outfile, 'data', config,
+                                  batch_size=df_batch_size,
+                                  merge_batch_size=df_merge_batch_size,
+                                  n_jobs=df_n_jobs, error=error, output=output,
+                                  log=log, submit=submit)
 
     yield save_df_job
+    for merge_job in merge_jobs:
+        yield merge_job
 
 
-def get_efficiencies_jobs(executable, config):
+def add_save_df_args(save_df_job, save_df_ex, input_files, df_outfile,
+                     datatype, config, batch_size=None, merge_batch_size=None,
+                     n_jobs=1, error=None, output=None, log=None, submit=None):
+    """Adds the save_dataframe.py arguments that produce df_outfile
+
+    If batch_size is given, input_files are split into batches that are
+    each converted into a partial DataFrame file by save_df_job. The
+    partial files are then merged into df_outfile by merge Jobs. If
+    merge_batch_size is also given, each merge process merges at most
+    merge_batch_size files, so merging takes several levels of merge Jobs
+    (each level merging the outputs of the previous one).
+
+    Parameters
+    ----------
+    save_df_job : pycondor.Job
+        Job running save_dataframe.py on save_hdf5.py output files.
+    save_df_ex : str
+        Path to script to save dataframe.
+    input_files : list
+        Paths to save_hdf5.py output files.
+    df_outfile : str
+        Path to the final DataFrame file.
+    datatype : {'sim', 'data'}
+        Whether the input files are simulation or data.
+    config : str
+        Detector configuration.
+    batch_size : int, optional
+        Number of input files to convert in each save_df_job process
+        (default is None, all files are converted by a single process).
+    merge_batch_size : int, optional
+        Maximum number of files merged by each merge process. Ignored if
+        batch_size is None (default is None, all partial files are merged
+        by a single process).
+    n_jobs : int, optional
+        Number of worker processes each conversion uses (default is 1).
+    error, output, log, submit : str, optional
+        pycondor Job error, output, log, and submit directories of the
+        merge Jobs (default is None).
+
+    Returns
+    -------
+    merge_jobs : list
+        Merge Jobs, one per merge level, in dependency order. The last
+        one writes df_outfile. Empty if batch_size is None, in which case
+        save_df_job writes df_outfile.
+    """
+    if merge_batch_size is not None and merge_batch_size < 2:
+        raise ValueError('merge_batch_size must be at least 2, '
+                         'got {}'.format(merge_batch_size))
+    base_arg = '--type {} --config {} --n_jobs {}'.format(datatype, config,
+                                                          n_jobs)
+    if batch_size is None:
+        arg = '--input {} --output {} {}'.format(' '.join(input_files),
+                                                 df_outfile, base_arg)
+        save_df_job.add_arg(arg)
+        return []
+
+    parts_dir = os.path.join(os.path.dirname(df_outfile),
+                             '{}_dataframe_parts'.format(datatype))
+    part_files = []
+    for idx, files in enumerate(comp.partition(input_files, batch_size)):
+        part_file = os.path.join(parts_dir,
+                                 'dataframe_part_{:04d}.hdf5'.format(idx))
+        arg = '--input {} --output {} {}'.format(' '.join(files), part_file,
+                                                 base_arg)
+        save_df_job.add_arg(arg)
+        part_files.append(part_file)
+
+    merge_jobs = []
+    parent_job = save_df_job
+    merge_arg = '--merge --input {} --output {} --type {} --config {}'
+    while True:
+        level = len(merge_jobs)
+        merge_job = pycondor.Job(name='{}_merge_{}'.format(save_df_job.name,
+                                                           level),
+                                 executable=save_df_ex,
+                                 error=error,
+                                 output=output,
+                                 log=log,
+                                 submit=submit)
+        merge_job.add_parent(parent_job)
+        merge_jobs.append(merge_job)
+        if merge_batch_size is None or len(part_files) <= merge_batch_size:
+            merge_job.add_arg(merge_arg.format(' '.join(part_files),
+                                               df_outfile, datatype, config))
+            break
+
+        merged_files = []
+        for idx, files in enumerate(comp.partition(part_files,
+                                                   merge_batch_size)):
+            merged_file = os.path.join(
+                parts_dir, 'dataframe_merge_{}_{:04d}.hdf5'.format(level, idx))
+            merge_job.add_arg(merge_arg.format(' '.join(files), merged_file,
+                                               datatype, config))
+            merged_files.append(merged_file)
+        part_files = merged_files
+        parent_job = merge_job
+
+    return merge_jobs
+
+
+def get_efficiencies_jobs(executable, config, error=None, output=None,
+                          log=None, submit=None):
     """Returns pycondor Job saving simulation detection efficiencies
 
     Parameters
@@ -204,6 +344,9 @@ def get_efficiencies_jobs(executable, config):
         Path to executable.
     config : str
         Detector configuration.
+    error, output, log, submit : str, optional
+        pycondor Job error, output, log, and submit directories
+        (default is None).
 
     Returns
     ------
@@ -258,6 +401,27 @@ if __name__ == "__main__":
                         type=int,
                         default=50,
                         help='Number of files to run per batch for data processing')
+    parser.add_argument('--df_batch_size',
+                        dest='df_batch_size',
+                        type=int,
+                        default=None,
+                        help=('Number of hdf5 files to convert in each '
+                              'save_dataframe.py job before merging. By '
+                              'default a single job converts all files.'))
+    parser.add_argument('--df_merge_batch_size',
+                        dest='df_merge_batch_size',
+                        type=int,
+                        default=None,
+                        help=('Maximum number of partial DataFrame files '
+                              'merged by each merge job. Larger numbers of '
+                              'files are merged over several levels of '
+                              'merge jobs. By default a single job merges '
+                              'all files.'))
+    parser.add_argument('--df_n_jobs',
+                        dest='df_n_jobs',
+                        type=int,
+                        default=1,
+                        help='Number of processes each save_dataframe.py job uses')
     parser.add_argument('--testing',
                         dest='testing',
                         action='store_true',
@@ -316,13 +480,23 @@ if __name__ == "__main__":
                                config=args.config,
                                sims=args.sim,
                                n=args.n_sim,
-                               testing=args.testing)
+                               df_batch_size=args.df_batch_size,
+                               df_merge_batch_size=args.df_merge_batch_size,
+                               df_n_jobs=args.df_n_jobs,
+                               testing=args.testing,
+                               error=error, output=output, log=log,
+                               submit=submit)
         jobs.append(sim_gen)
     if 'data' in process_types:
         data_gen = gen_data_jobs(save_hdf5_ex, save_df_ex,
                                  config=args.config,
                                  n=args.n_data,
-                                 testing=args.testing)
+                                 df_batch_size=args.df_batch_size,
+                                 df_merge_batch_size=args.df_merge_batch_size,
+                                 df_n_jobs=args.df_n_jobs,
+                                 testing=args.testing,
+                                 error=error, output=output, log=log,
+                                 submit=submit)
         jobs.append(data_gen)
 
     for job in chain.from_iterable(jobs):
@@ -2,12 +2,67 @@
 
 import os
 import argparse
+import json
+import warnings
+from collections import OrderedDict, deque
+from multiprocessing import Pool
 import numpy as np
 import pandas as pd
 import shutil
 
 import comptools as comp
 from comptools.composition_encoding import composition_group_labels, encode_composition_groups
+from comptools.dataframe_schema import compact_dataframe, save_schema, read_schema
+from comptools.event_keys import encode_event_keys
+from comptools.cuts import evaluate_cuts, compile_cuts
+from comptools.derived_columns import add_derived_columns
+from comptools.bitmap_index import (QUALITY_CUTS_COLUMN, pack_cut_masks,
+                                    save_cut_names, read_cut_names,
+                                    build_bitmap_index, save_bitmap_index)
+
+
+def extract_tank_charges(tank_charges, dataset):
+    """Reshapes the tank charge vs. distance vectors into ldf_* columns
+
+    Parameters
+    ----------
+    tank_charges : pandas.DataFrame
+        The 'tank_charge_v_dist' table written by save_hdf5.py, with one
+        row per distance bin per event.
+    dataset : int or str
+        Simulation set number or data detector configuration.
+
+    Returns
+    -------
+    df_tank_charges : pandas.DataFrame
+        DataFrame with an ``ldf_{i}`` column for each distance bin, indexed
+        by event key (see comptools.event_keys). Events with fewer bins
+        than others are padded with NaN.
+    """
+    keys = encode_event_keys(dataset, tank_charges['Run'].values,
+                             tank_charges['Event'].values,
+                             tank_charges['SubEvent'].values)
+    items = tank_charges['item'].values
+    # Stable sort groups the bins of each event while keeping their order
+    order = np.argsort(keys, kind='mergesort')
+    keys, items = keys[order], items[order]
+    event_keys, counts = np.unique(keys, return_counts=True)
+
+    if len(counts) and np.all(counts == counts[0]):
+        # Every event has the same number of distance bins (the usual case)
+        charges = items.reshape(-1, counts[0])
+    else:
+        n_bins = counts.max() if len(counts) else 0
+        starts = np.cumsum(counts) - counts
+        rows = np.repeat(np.arange(len(event_keys)), counts)
+        bins = np.arange(len(keys)) - np.repeat(starts, counts)
+        charges = np.full((len(event_keys), n_bins), np.nan)
+        charges[rows, bins] = items
+
+    columns = ['ldf_{}'.format(i) for i in range(charges.shape[1])]
+    df_tank_charges = pd.DataFrame(charges, index=event_keys, columns=columns)
+
+    return df_tank_charges
 
 
 def extract_dataframe(input_file, config, datatype):
@@ -112,35 +167,22 @@ def extract_dataframe(input_file, config, datatype):
         series_dict['mil_qtot_measured'] = store['MillipedeFitParams']['qtotal']
         series_dict['mil_qtot_predicted'] = store['MillipedeFitParams']['predicted_qtotal']
 
-        # Construct unique index from run/event/subevent info in I3EventHeader
-        runs = store['I3EventHeader']['Run']
-        events = store['I3EventHeader']['Event']
-        sub_events = store['I3EventHeader']['SubEvent']
-        if datatype == 'sim':
-            index = ['{}_{}_{}_{}'.format(sim_num, run, event, sub_event)
-                     for run, event, sub_event in zip(runs, events, sub_events)]
-        else:
-            index = ['{}_{}_{}_{}'.format(config, run, event, sub_event)
-                     for run, event, sub_event in zip(runs, events, sub_events)]
-
-        # Extract measured charge for each DOM
-        charges_list, columns, tank_charges_index = [], [], []
-        grouped = store['tank_charge_v_dist'].groupby(['Run', 'Event', 'SubEvent'])
-        for name, group in grouped:
-            # if not columns:
-            #     columns = ['ldf_{}'.format(i) for i in range(len(group['item']))]
-            charges_list.append(group['item'].values)
-            if datatype == 'sim':
-                tank_charges_index.append('{}_{}_{}_{}'.format(sim_num, *name))
-            else:
-                tank_charges_index.append('{}_{}_{}_{}'.format(config, *name))
-        df_tank_charges = pd.DataFrame(charges_list)
-        df_tank_charges.index = tank_charges_index
+        # Construct unique integer event key from run/event/subevent info
+        # in I3EventHeader (see comptools.event_keys)
+        dataset = sim_num if datatype == 'sim' else config
+        header = store['I3EventHeader']
+        index = encode_event_keys(dataset, header['Run'].values,
+                                  header['Event'].values,
+                                  header['SubEvent'].values)
+
+        # Extract measured charge in each lateral distance bin
+        df_tank_charges = extract_tank_charges(store['tank_charge_v_dist'],
+                                               dataset)
 
     df = pd.DataFrame(series_dict)
     df.index = index
-    for col in df_tank_charges:
-        df['ldf_{}'.format(col)] = df_tank_charges[col]
+    # Attach all ldf_* columns as a single block
+    df = pd.concat([df, df_tank_charges.reindex(df.index)], axis=1)
 
     return df
 
@@ -163,7 +205,7 @@ def add_extra_columns(df, datatype='sim'):
         Returns DataFrame with added columns
     '''
     if datatype == 'sim':
-        df['MC_log_energy'] = np.nan_to_num(np.log10(df['MC_energy']))
+        df = add_derived_columns(df, ['MC_log_energy'])
         # Add composition group labels
         for num_groups in [2, 3, 4]:
             label_key = 'comp_group_{}'.format(num_groups)
@@ -172,25 +214,372 @@ def add_extra_columns(df, datatype='sim'):
             target_key = 'comp_target_{}'.format(num_groups)
             df[target_key] = encode_composition_groups(df[label_key],
                                                        num_groups=num_groups)
-    # Add log-scale columns to df
-    df['lap_log_energy'] = np.nan_to_num(np.log10(df['lap_energy']))
-    df['lap_cos_zenith'] = np.cos(df['lap_zenith'])
-    for dist in ['50', '80', '125', '180', '250', '500']:
-        df['log_s'+dist] = np.log10(df['lap_s'+dist])
-    df['log_dEdX'] = np.log10(df['eloss_1500_standard'])
+    # Add log-scale columns to df (see comptools.derived_columns)
+    df = add_derived_columns(df, ['lap_log_energy', 'lap_cos_zenith'] +
+                             ['log_s' + dist for dist in ['50', '80', '125',
+                                                          '180', '250', '500']] +
+                             ['log_dEdX'])
+
+    return df
+
+
+def process_i3_hdf_file(input_file, config, datatype):
+    df = extract_dataframe(input_file, config, datatype)
+    # Evaluate the quality cuts once, both to select events and to store
+    # whether each selected event passes each named cut, so analyses can
+    # select events with bitwise operations (see comptools.bitmap_index)
+    selection_mask, cut_masks, _ = evaluate_cuts(
+        df, comp.io.get_quality_cuts(),
+        cut_flow=comp.io.get_quality_cut_flow())
+    df = df[selection_mask].copy()
+    df[QUALITY_CUTS_COLUMN] = pack_cut_masks(
+        OrderedDict((name, mask[selection_mask])
+                    for name, mask in cut_masks.items()))
+    df = add_extra_columns(df, datatype=datatype)
 
     return df
 
 
-def process_i3_hdf(files, config, datatype):
+def process_i3_hdf(files, config, datatype, n_jobs=1, max_pending=None):
+    '''Yields a processed DataFrame for each input file, in input order
+
+    Parameters
+    ----------
+    files : list
+        Input hdf5 files (from save_hdf5.py).
+    config : str
+        Detector configuration.
+    datatype : {'sim', 'data'}
+        Whether the input files are simulation or data.
+    n_jobs : int, optional
+        Number of worker processes to convert files with. Results are
+        still yielded in the same order as ``files`` (default is 1).
+    max_pending : int, optional
+        Maximum number of files submitted to the workers but not yet
+        yielded. Bounds the memory used by converted DataFrames waiting
+        to be written (default is None, 2 * n_jobs).
+
+    Yields
+    ------
+    df : pandas.DataFrame
+        Processed DataFrame.
+    '''
+    if n_jobs > 1:
+        if max_pending is None:
+            max_pending = 2 * n_jobs
+        pool = Pool(processes=n_jobs)
+        try:
+            pending = deque()
+            for input_file in files:
+                pending.append(pool.apply_async(process_i3_hdf_file,
+                                                (input_file, config, datatype)))
+                # Wait for the oldest file before submitting more
+                if len(pending) >= max_pending:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        except BaseException:
+            # Don't convert the remaining files if the caller stopped
+            pool.terminate()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for input_file in files:
+            yield process_i3_hdf_file(input_file, config, datatype)
+
+
+def append_dataframe(store, df, legacy_schema=False, compact=True,
+                     expected_schema=None):
+    '''Appends a processed DataFrame to the 'dataframe' table in store
+
+    Parameters
+    ----------
+    store : pandas.HDFStore
+        Output HDFStore.
+    df : pandas.DataFrame
+        Processed DataFrame.
+    legacy_schema : bool, optional
+        Option to store all columns with their in-memory dtypes instead of
+        the compact schema (default is False).
+    compact : bool, optional
+        Whether df still needs to be converted to the compact schema. Set
+        to False for DataFrames read from compact files (default is True).
+    expected_schema : dict, optional
+        Schema of the DataFrames already in store. If given, df must
+        convert to the same schema (default is None).
+
+    Returns
+    -------
+    schema : dict or None
+        Schema of the appended DataFrame (see comptools.dataframe_schema).
+        None if legacy_schema is True or compact is False.
+
+    Raises
+    ------
+    ValueError
+        If the schema of df is different from expected_schema.
+    '''
+    if legacy_schema:
+        store.append('dataframe', df, format='table', data_columns=True,
+                     min_itemsize=30)
+        return None
+
+    schema = None
+    if compact:
+        df, schema = compact_dataframe(df)
+        if expected_schema is not None and schema != expected_schema:
+            raise ValueError('Can\'t append a DataFrame whose schema is '
+                             'different from the stored schema')
+    store.append('dataframe', df, format='table', data_columns=True)
+
+    return schema
+
+
+def merge_dataframe_files(files, store, chunksize=1000000):
+    '''Appends the DataFrames in files, in order, to store
+
+    Used to merge the partial outputs of several save_dataframe.py jobs
+    (see the --merge option).
+
+    Parameters
+    ----------
+    files : list
+        Processed DataFrame files (outputs of save_dataframe.py).
+    store : pandas.HDFStore
+        Output HDFStore.
+    chunksize : int, optional
+        Number of rows to copy at a time (default is 1000000).
+
+    Returns
+    -------
+    schema : dict or None
+        Schema shared by all input files (see comptools.dataframe_schema).
+    '''
+    schema = read_schema(files[0]) if files else None
+    for input_file in files:
+        if read_schema(input_file) != schema:
+            raise ValueError('The DataFrame in {} was saved with a different '
+                             'schema than {}'.format(input_file, files[0]))
+        with pd.HDFStore(input_file, mode='r') as input_store:
+            if 'dataframe' not in input_store:
+                continue
+            for df in input_store.select('dataframe', chunksize=chunksize):
+                append_dataframe(store, df, legacy_schema=schema is None,
+                                 compact=False)
+
+    return schema
+
+
+def get_manifest_file(outfile):
+    """Returns the path to the manifest of input files for a DataFrame file
+    """
+    return os.path.splitext(outfile)[0] + '_manifest.json'
+
+
+def get_file_record(input_file, n_rows):
+    """Returns a manifest record describing an input file
+
+    Parameters
+    ----------
+    input_file : str
+        Path to input hdf5 file.
+    n_rows : int
+        Number of rows the input file contributed to the output DataFrame.
+
+    Returns
+    -------
+    record : dict
+        Dictionary with the input path, size, modification time, and
+        number of rows.
+    """
+    input_file = os.path.abspath(input_file)
+    record = {'path': input_file,
+              'size': os.path.getsize(input_file),
+              'mtime': os.path.getmtime(input_file),
+              'n_rows': int(n_rows),
+              }
+
+    return record
+
+
+def read_manifest(manifest_file):
+    with open(manifest_file, 'r') as f_obj:
+        records = json.load(f_obj)
+    return records
+
+
+def write_manifest(manifest_file, records):
+    # Write to a temporary file first so an interrupted job never leaves
+    # behind a truncated manifest
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as f_obj:
+        json.dump(records, f_obj, indent=1)
+    os.rename(tmp_file, manifest_file)
+
+
+def _is_unchanged(record):
+    path = record['path']
+    return (os.path.exists(path) and
+            os.path.getsize(path) == record['size'] and
+            os.path.getmtime(path) == record['mtime'])
+
+
+def remove_stale_inputs(store, records, input_files):
+    """Removes rows from inputs that have vanished or changed since conversion
+
+    Rows in the output DataFrame are grouped by input file in the order
+    listed in the manifest, so the rows of each input can be located from
+    the n_rows of the records before it.
+
+    Parameters
+    ----------
+    store : pandas.HDFStore
+        Output HDFStore opened in append mode.
+    records : list
+        Manifest records of the output DataFrame.
+    input_files : list
+        Current input hdf5 files.
+
+    Returns
+    -------
+    kept_records : list
+        Records of inputs whose rows are still in the output DataFrame.
+    """
+    input_files = set(os.path.abspath(f) for f in input_files)
+    kept_records, stale_ranges = [], []
+    start = 0
+    for record in records:
+        stop = start + record['n_rows']
+        if record['path'] in input_files and _is_unchanged(record):
+            kept_records.append(record)
+        elif stop > start:
+            stale_ranges.append((start, stop))
+        start = stop
+
+    # Remove from the end so the offsets of earlier ranges stay valid
+    for start, stop in reversed(stale_ranges):
+        store.remove('dataframe', start=start, stop=stop)
+
+    return kept_records
+
+
+def merge_manifests(files):
+    """Concatenates the manifests of partial DataFrame files
+
+    Returns None if any of the files doesn't have a manifest.
+    """
+    records = []
     for input_file in files:
-        df = extract_dataframe(input_file, config, datatype)
-        df = comp.io.apply_quality_cuts(
-                df, datatype=datatype, log_energy_min=None,
-                log_energy_max=None, verbose=False)
-        df = add_extra_columns(df, datatype=datatype)
+        manifest_file = get_manifest_file(input_file)
+        if not os.path.exists(manifest_file):
+            return None
+        records.extend(read_manifest(manifest_file))
+
+    return records
+
 
-        yield df
+def write_dataframe_file(outfile, input_files, config='IC86.2012',
+                         datatype='sim', merge=False, records=None,
+                         legacy_schema=False, n_jobs=1):
+    """Converts (or merges) input files into a processed DataFrame file
+
+    Parameters
+    ----------
+    outfile : str
+        Path to output hdf5 file.
+    input_files : list
+        Input hdf5 files (from save_hdf5.py), or DataFrame files from
+        previous save_dataframe.py jobs if merge is True.
+    config : str, optional
+        Detector configuration (default is 'IC86.2012').
+    datatype : {'sim', 'data'}
+        Whether the input files are simulation or data (default is 'sim').
+    merge : bool, optional
+        Option to merge input DataFrame files instead of converting
+        save_hdf5.py output files (default is False).
+    records : list, optional
+        Manifest records of an existing outfile to update. Only input
+        files that aren't in records are converted, and rows from inputs
+        that have vanished or changed are removed (default is None,
+        outfile is rewritten).
+    legacy_schema : bool, optional
+        Option to store all columns with their in-memory dtypes instead of
+        the compact schema (default is False).
+    n_jobs : int, optional
+        Number of worker processes used to convert input files
+        (default is 1).
+
+    Returns
+    -------
+    records : list or None
+        Manifest records of the output file. None if they can't be
+        rebuilt, i.e. if any merged file doesn't have a manifest.
+    """
+    incremental = records is not None
+    # This process is the only writer, so DataFrames are appended in the
+    # same order as the input files
+    with pd.HDFStore(outfile, mode='a' if incremental else 'w') as output_store:
+        schema = None
+        cut_names = list(compile_cuts(comp.io.get_quality_cuts()))
+        if merge:
+            schema = merge_dataframe_files(input_files, output_store)
+            records = merge_manifests(input_files)
+            cut_names = read_cut_names(input_files[0])
+        else:
+            if incremental:
+                records = remove_stale_inputs(output_store, records,
+                                              input_files)
+                converted = set(record['path'] for record in records)
+                input_files = [f for f in input_files
+                               if os.path.abspath(f) not in converted]
+                print('Converting {} new input files ({} already '
+                      'converted)'.format(len(input_files), len(records)))
+                # Append new inputs with the existing file's schema
+                if 'dataframe' in output_store:
+                    attrs = output_store.get_storer('dataframe').attrs
+                    schema = getattr(attrs, 'comp_schema', None)
+                    legacy_schema = schema is None
+                    if getattr(attrs, 'comp_cut_names', None) != cut_names:
+                        raise ValueError('The quality cuts have changed since '
+                                         '{} was saved. Rebuild it without '
+                                         '--incremental.'.format(outfile))
+            else:
+                records = []
+            dataframes = process_i3_hdf(input_files, config, datatype,
+                                        n_jobs=n_jobs)
+            for input_file, df in zip(input_files, dataframes):
+                df_schema = append_dataframe(output_store, df,
+                                             legacy_schema=legacy_schema,
+                                             expected_schema=schema)
+                if schema is None:
+                    schema = df_schema
+                records.append(get_file_record(input_file, n_rows=len(df)))
+        if schema is not None:
+            save_schema(output_store, schema)
+        if 'dataframe' in output_store:
+            if cut_names is not None:
+                save_cut_names(output_store, cut_names)
+            bitmap_index, n_rows = build_bitmap_index(output_store,
+                                                      schema=schema,
+                                                      cut_names=cut_names)
+            save_bitmap_index(output_store, bitmap_index, n_rows)
+
+    return records
+
+
+def has_cut_names(df_file):
+    """Checks whether a DataFrame file can be updated with --incremental
+
+    Files saved before the quality cut names were stored alongside the
+    packed cut bits can't be, since their cut bits can't be checked.
+    """
+    with pd.HDFStore(df_file, mode='r') as store:
+        if 'dataframe' not in store:
+            return True
+        attrs = store.get_storer('dataframe').attrs
+        return getattr(attrs, 'comp_cut_names', None) is not None
 
 
 if __name__ == "__main__":
@@ -208,6 +597,33 @@ if __name__ == "__main__":
                         help='Path to input hdf5 files')
     parser.add_argument('-o', '--output', dest='output',
                         help='Path to output hdf5 file')
+    parser.add_argument('--legacy_schema', dest='legacy_schema',
+                        action='store_true', default=False,
+                        help='Option to store all columns with their '
+                             'in-memory dtypes instead of the compact schema')
+    parser.add_argument('--n_jobs', dest='n_jobs', type=int, default=1,
+                        help='Number of worker processes used to convert '
+                             'input files in parallel')
+    parser.add_argument('--merge', dest='merge', action='store_true',
+                        default=False,
+                        help='Option to merge input DataFrame files (from '
+                             'previous save_dataframe.py jobs) instead of '
+                             'converting save_hdf5.py output files')
+    parser.add_argument('--incremental', dest='incremental',
+                        action='store_true', default=False,
+                        help='Option to only convert input files that are '
+                             'not in the manifest of an existing output '
+                             'file, and to drop rows from input files that '
+                             'have vanished or changed')
+    parser.add_argument('--cache', dest='cache', action='store_true',
+                        default=False,
+                        help='Option to also build a Parquet cache of the '
+                             'output DataFrame for faster loading')
+    parser.add_argument('--cache_sort_key', dest='cache_sort_key',
+                        default=None,
+                        help='Energy column to sort the Parquet cache by, '
+                             'so energy ranges of it can be read as '
+                             'contiguous slices (e.g. lap_log_energy)')
     args = parser.parse_args()
 
     # Validate input config
@@ -230,20 +646,41 @@ if __name__ == "__main__":
         comp.check_output_dir(args.output)
         outfile = args.output
 
-    # Open HDFStore for output hdf5 file
-    with pd.HDFStore(outfile, mode='w') as output_store:
-        for df in process_i3_hdf(args.input, args.config, args.type):
-            # min_itemsize = {'index': 30}
-            # if args.type == 'sim':
-            #     min_itemsize['MC_comp'] = 15
-            #     for num_groups in [2, 3, 4]:
-            #         min_itemsize['comp_group_{}'.format(num_groups)] = 15
-            # Add dataframe to output_store
-            output_store.append('dataframe', df, format='table',
-                                data_columns=True, min_itemsize=30)
-                                # data_columns=True, min_itemsize=min_itemsize)
+    # The manifest records the input files (in output row order) that have
+    # been converted into the output DataFrame
+    manifest_file = get_manifest_file(args.output)
+    incremental = (args.incremental and not args.merge and
+                   os.path.exists(args.output) and
+                   os.path.exists(manifest_file))
+    if incremental and not has_cut_names(args.output):
+        warnings.warn('{} was saved without quality cut names, rebuilding '
+                      'it from all input files'.format(args.output))
+        incremental = False
+    records = None
+    if incremental:
+        records = read_manifest(manifest_file)
+        if on_condor:
+            shutil.copy(args.output, outfile)
+    elif os.path.exists(manifest_file):
+        # The output file is rewritten, so its manifest is out of date
+        # (and is only replaced if it can be rebuilt)
+        os.remove(manifest_file)
+
+    records = write_dataframe_file(outfile, args.input, config=args.config,
+                                   datatype=args.type, merge=args.merge,
+                                   records=records,
+                                   legacy_schema=args.legacy_schema,
+                                   n_jobs=args.n_jobs)
 
     # If on condor, transfer from worker machine to desired destination
     if on_condor:
         comp.check_output_dir(args.output)
         shutil.move(outfile, args.output)
+
+    if records is not None:
+        write_manifest(manifest_file, records)
+
+    if args.cache:
+        comp.io.save_dataframe_cache(args.output,
+                                     sort_key=args.cache_sort_key,
+                                     overwrite=True)
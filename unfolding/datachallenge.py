@@ -650,7 +650,6 @@ if __name__ == '__main__':
         compositon_weights = args.compositon_weights
 
         pipeline_str = '{}_comp_{}_{}-groups'.format(args.pipeline, config, num_groups)
-        pipeline = comp.get_pipeline(pipeline_str)
         compositions = df_sim_train['comp_group_{}'.format(num_groups)].values
         energies = df_sim_train['reco_energy'].values
         sample_weight = calculate_sample_weights(compositions, energies, model=model,
@@ -659,7 +658,10 @@ if __name__ == '__main__':
         X = df_sim_train[feature_list].values
         y = df_sim_train['comp_target_{}'.format(num_groups)].values
         fit_params = {'classifier__sample_weight': sample_weight}
-        pipeline.fit(X, y, **fit_params)
+        pipeline = comp.fit_or_load(pipeline_str, X, y,
+                                    feature_list=feature_list,
+                                    fit_params=fit_params, split_seed=2,
+                                    verbose=True)
     elif p is None:
         pipeline_str = '{}_comp_{}_{}-groups'.format(args.pipeline, config, num_groups)
         pipeline = comp.load_trained_model(pipeline_str)